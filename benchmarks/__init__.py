@@ -0,0 +1 @@
+"""Benchmarks and simulations of transfer cycles, not part of the package."""
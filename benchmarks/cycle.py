@@ -0,0 +1,226 @@
+"""Benchmark full transfer cycles against synthetic run trees.
+
+    python -m benchmarks.cycle --runs-per-sequencer 500 --cycles 2
+
+Each cycle runs transfer_runs over all sequencers, with statusdb served by
+an in-process fake and rsync/run-one replaced by scripts that exit at once.
+The results are appended to a history file and compared with the last
+entry run with the same parameters.
+"""
+
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from benchmarks.fakes import ForkCounter, fake_couchdb, write_fake_binaries
+from benchmarks.synthetic import build_config, generate_tree, seed_statusdb
+from dataflow_transfer.dataflow_transfer import transfer_runs
+
+DEFAULT_HISTORY_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "results", "history.jsonl"
+)
+# Lower is better for all of them
+METRIC_NAMES = (
+    "wall_seconds",
+    "statusdb_requests_per_run",
+    "forks_per_run",
+    "peak_rss_kib",
+)
+# Differences in wall time below this are noise, whatever the relative change
+_MIN_WALL_SECONDS_CHANGE = 0.05
+
+
+def run_cycle(config, fake, run_count):
+    """Run one transfer cycle and return its measurements."""
+    requests_before = sum(fake.requests.values())
+    with ForkCounter() as forks:
+        start_time = time.perf_counter()
+        transfer_runs(config)
+        wall_seconds = time.perf_counter() - start_time
+    # Let the fake rsyncs write their exit codes before the next cycle
+    forks.wait()
+    requests = sum(fake.requests.values()) - requests_before
+    return {
+        "wall_seconds": round(wall_seconds, 4),
+        "statusdb_requests_per_run": round(requests / run_count, 3),
+        "forks_per_run": round(forks.count / run_count, 3),
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_benchmark(parameters, base_dir):
+    """Generate a tree under base_dir and run the configured number of cycles."""
+    run_one_path = write_fake_binaries(os.path.join(base_dir, "bin"))
+    runs = generate_tree(
+        base_dir, parameters["runs_per_sequencer"], seed=parameters["seed"]
+    )
+    extra_config = {"concurrency": {"workers": parameters["workers"]}}
+    if parameters["state_index"]:
+        extra_config["state_index"] = {
+            "path": os.path.join(base_dir, "state_index.sqlite")
+        }
+    if parameters["write_behind"]:
+        extra_config["statusdb"] = {"write_behind": True}
+    config = build_config(base_dir, run_one_path, runs, extra_config)
+    run_count = sum(len(run_dirs) for run_dirs in runs.values())
+    original_path = os.environ.get("PATH", "")
+    os.environ["PATH"] = os.path.join(base_dir, "bin") + os.pathsep + original_path
+    try:
+        with fake_couchdb() as fake:
+            for run_dirs in runs.values():
+                seed_statusdb(fake, run_dirs)
+            return [
+                run_cycle(config, fake, run_count) for _ in range(parameters["cycles"])
+            ]
+    finally:
+        os.environ["PATH"] = original_path
+
+
+def _git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(history_file):
+    try:
+        with open(history_file) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def find_regressions(previous, cycles, tolerance):
+    """Compare cycles with the cycles of the previous entry.
+
+    Returns a list of (cycle number, metric, previous value, new value) for
+    every metric that got worse by more than tolerance (a fraction).
+    """
+    regressions = []
+    for number, (old, new) in enumerate(zip(previous["cycles"], cycles), start=1):
+        for metric in METRIC_NAMES:
+            old_value, new_value = old.get(metric), new.get(metric)
+            if old_value is None or new_value is None:
+                continue
+            if new_value <= old_value * (1 + tolerance):
+                continue
+            if (
+                metric == "wall_seconds"
+                and new_value - old_value < _MIN_WALL_SECONDS_CHANGE
+            ):
+                continue
+            regressions.append((number, metric, old_value, new_value))
+    return regressions
+
+
+def print_cycles(cycles, previous=None):
+    click.echo(f"{'cycle':>5}  " + "  ".join(f"{name:>26}" for name in METRIC_NAMES))
+    for number, cycle in enumerate(cycles, start=1):
+        values = []
+        for metric in METRIC_NAMES:
+            value = f"{cycle[metric]}"
+            if previous and number <= len(previous["cycles"]):
+                value += f" ({previous['cycles'][number - 1].get(metric)})"
+            values.append(f"{value:>26}")
+        click.echo(f"{number:>5}  " + "  ".join(values))
+
+
+@click.command()
+@click.option("--runs-per-sequencer", type=click.IntRange(min=1), default=500)
+@click.option("--cycles", type=click.IntRange(min=1), default=2)
+@click.option("--workers", type=click.IntRange(min=1), default=1)
+@click.option("--seed", type=int, default=0)
+@click.option("--state-index", is_flag=True, help="Use a state index of finished runs.")
+@click.option(
+    "--write-behind", is_flag=True, help="Queue status updates in write-behind mode."
+)
+@click.option(
+    "--history-file",
+    type=click.Path(dir_okay=False),
+    default=DEFAULT_HISTORY_FILE,
+    show_default=True,
+)
+@click.option("--no-history", is_flag=True, help="Do not record the results.")
+@click.option(
+    "--tolerance",
+    type=click.FloatRange(min=0),
+    default=0.2,
+    show_default=True,
+    help="Fraction by which a metric may get worse before it counts as a regression.",
+)
+@click.option("--fail-on-regression", is_flag=True)
+@click.option("--verbose", is_flag=True, help="Show the log of the transfer cycles.")
+def cli(
+    runs_per_sequencer,
+    cycles,
+    workers,
+    seed,
+    state_index,
+    write_behind,
+    history_file,
+    no_history,
+    tolerance,
+    fail_on_regression,
+    verbose,
+):
+    """Benchmark transfer cycles against a synthetic run tree."""
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
+    parameters = {
+        "runs_per_sequencer": runs_per_sequencer,
+        "cycles": cycles,
+        "workers": workers,
+        "seed": seed,
+        "state_index": state_index,
+        "write_behind": write_behind,
+    }
+    with tempfile.TemporaryDirectory(prefix="dataflow_transfer_benchmark_") as base:
+        results = run_benchmark(parameters, base)
+
+    previous = next(
+        (
+            entry
+            for entry in reversed(load_history(history_file))
+            if entry["parameters"] == parameters
+        ),
+        None,
+    )
+    print_cycles(results, previous)
+    regressions = find_regressions(previous, results, tolerance) if previous else []
+    for number, metric, old_value, new_value in regressions:
+        click.echo(
+            f"Regression in cycle {number}: {metric} went from {old_value} to "
+            f"{new_value} (previous run at {previous['commit']})",
+            err=True,
+        )
+    if not no_history:
+        os.makedirs(os.path.dirname(os.path.abspath(history_file)), exist_ok=True)
+        entry = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "parameters": parameters,
+            "cycles": results,
+        }
+        with open(history_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    if regressions and fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
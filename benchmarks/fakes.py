@@ -0,0 +1,163 @@
+"""In-process stand-ins for CouchDB, rsync and run-one."""
+
+import os
+import stat
+import subprocess
+from collections import Counter
+from contextlib import contextmanager
+
+from dataflow_transfer.utils import statusdb
+
+
+class FakeResponse:
+    def __init__(self, result):
+        self.result = result
+
+    def get_result(self):
+        return self.result
+
+
+class FakeCouchDB:
+    """Stand-in for cloudant_v1.CloudantV1 serving the views used by statusdb.
+
+    Documents are kept in memory and indexed by runfolder_id, so lookups
+    cost the same for ten runs as for ten thousand. Every request is counted
+    per method in `requests`.
+    """
+
+    def __init__(self, authenticator=None):
+        self.docs = {}
+        self.doc_ids = {}  # runfolder_id -> document IDs
+        self.requests = Counter()
+
+    # Called by StatusdbSession.__init__
+    def set_service_url(self, url):
+        pass
+
+    def get_http_client(self):
+        class Adapter:
+            def init_poolmanager(self, connections, maxsize):
+                pass
+
+        class Client:
+            def get_adapter(self, url):
+                return Adapter()
+
+        return Client()
+
+    def get_server_information(self):
+        self.requests["get_server_information"] += 1
+        return FakeResponse({"couchdb": "Welcome"})
+
+    def add_document(self, document):
+        doc_id = document.get("_id") or f"doc{len(self.docs) + 1}"
+        revision = document.get("_rev")
+        if doc_id in self.docs:
+            if self.docs[doc_id].get("_rev") != revision:
+                return {"id": doc_id, "error": "conflict"}
+            revision = f"{int(revision.split('-')[0]) + 1}-fake"
+        else:
+            revision = "1-fake"
+        self.docs[doc_id] = dict(document, _id=doc_id, _rev=revision)
+        run_ids = self.doc_ids.setdefault(document.get("runfolder_id"), [])
+        if doc_id not in run_ids:
+            run_ids.append(doc_id)
+        return {"id": doc_id, "ok": True, "rev": revision}
+
+    def post_view(self, db, ddoc, view, key=None, keys=None, **kwargs):
+        self.requests["post_view"] += 1
+        rows = []
+        for run_id in [key] if keys is None else keys:
+            for doc_id in self.doc_ids.get(run_id, []):
+                doc = self.docs[doc_id]
+                if view == "current_status_per_runfolder":
+                    value = {
+                        event["event_type"]: event.get("timestamp") or True
+                        for event in doc.get("events", [])
+                    }
+                    rows.append({"id": doc_id, "key": run_id, "value": value})
+                    continue
+                row = {"id": doc_id, "key": run_id, "value": None}
+                if kwargs.get("include_docs"):
+                    row["doc"] = dict(doc, events=list(doc.get("events", [])))
+                rows.append(row)
+        return FakeResponse({"rows": rows})
+
+    def post_document(self, db, document):
+        self.requests["post_document"] += 1
+        return FakeResponse(self.add_document(document))
+
+    def post_bulk_docs(self, db, bulk_docs):
+        self.requests["post_bulk_docs"] += 1
+        return FakeResponse([self.add_document(doc) for doc in bulk_docs.docs])
+
+
+@contextmanager
+def fake_couchdb():
+    """Make StatusdbSession connect to a new FakeCouchDB, which is yielded."""
+    fake = FakeCouchDB()
+    original_client = statusdb.cloudant_v1.CloudantV1
+    original_sessions = dict(statusdb._SESSIONS)
+    statusdb.cloudant_v1.CloudantV1 = lambda authenticator=None: fake
+    statusdb._SESSIONS.clear()
+    try:
+        yield fake
+    finally:
+        statusdb.cloudant_v1.CloudantV1 = original_client
+        statusdb._SESSIONS.clear()
+        statusdb._SESSIONS.update(original_sessions)
+
+
+FAKE_RUN_ONE = '#!/bin/sh\nexec "$@"\n'
+# Exits like a successful rsync with nothing to send. FAKE_RSYNC_SECONDS
+# makes it take a while, so that it shows up as running in the process table.
+FAKE_RSYNC = '#!/bin/sh\nsleep "${FAKE_RSYNC_SECONDS:-0}"\nexit 0\n'
+
+
+def write_fake_binaries(bin_dir):
+    """Write fake run-one and rsync scripts to bin_dir.
+
+    Returns the path of the fake run-one, for `run_one_path`. bin_dir has
+    to be put first on PATH for the fake rsync to be used.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, content in (("run-one", FAKE_RUN_ONE), ("rsync", FAKE_RSYNC)):
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP)
+    return os.path.join(bin_dir, "run-one")
+
+
+class ForkCounter:
+    """Count the processes started through subprocess.Popen while active.
+
+    The started processes are kept, so that the caller can wait for them.
+    """
+
+    def __init__(self):
+        self.processes = []
+
+    def __enter__(self):
+        original_popen = subprocess.Popen
+        processes = self.processes
+
+        class CountingPopen(original_popen):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                processes.append(self)
+
+        self._original_popen = original_popen
+        subprocess.Popen = CountingPopen
+        return self
+
+    def __exit__(self, *exc_info):
+        subprocess.Popen = self._original_popen
+
+    @property
+    def count(self):
+        return len(self.processes)
+
+    def wait(self):
+        for process in self.processes:
+            process.wait()
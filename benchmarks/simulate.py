@@ -0,0 +1,430 @@
+"""Simulate a day of sequencer activity and measure the latency of transfers.
+
+    python -m benchmarks.simulate --cron-interval 60 --cron-interval 300 \\
+        --max-rsyncs 0 --max-rsyncs 4
+
+Run folders are created and finished over simulated time following the
+SEQUENCER_PROFILES, and the real process_run state machine is run on them
+once per cron interval. Transfers are not run: a fake backend takes the
+rsync commands, and writes their exit codes once the time the transfer
+would take has passed. Statusdb is served by an in-process fake.
+
+For every combination of the given cron intervals and rsync limits, the
+latency from the run folder appearing, or from its final file being
+written, until statusdb shows each status is reported as percentiles.
+"""
+
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import re
+import tempfile
+
+import click
+
+from benchmarks.fakes import fake_couchdb
+from benchmarks.synthetic import RUN_ID_GENERATORS, build_config, create_run_folder
+from dataflow_transfer.dataflow_transfer import process_run_safely
+from dataflow_transfer.run_classes import RUN_CLASS_REGISTRY
+from dataflow_transfer.utils import filesystem as fs
+from dataflow_transfer.utils.scheduler import open_transfer_scheduler
+from dataflow_transfer.utils.statusdb import get_statusdb_session
+
+HOUR = 3600
+DAY = 24 * HOUR
+GB = 1000**3
+
+# Runs started per day, hours from the run folder appearing until the final
+# file, and size of the finished run in GB. Both ranges are sampled uniformly.
+SEQUENCER_PROFILES = {
+    "NovaSeqXPlus": {"runs_per_day": 2, "sequencing_hours": (13, 44), "size_gb": (800, 3000)},
+    "NextSeq": {"runs_per_day": 3, "sequencing_hours": (12, 30), "size_gb": (40, 120)},
+    "MiSeq": {"runs_per_day": 3, "sequencing_hours": (4, 56), "size_gb": (2, 15)},
+    "MiSeqi100": {"runs_per_day": 4, "sequencing_hours": (4, 30), "size_gb": (5, 30)},
+    "PromethION": {"runs_per_day": 6, "sequencing_hours": (24, 72), "size_gb": (200, 1500)},
+    "MinION": {"runs_per_day": 2, "sequencing_hours": (6, 48), "size_gb": (5, 50)},
+    "AVITI": {"runs_per_day": 2, "sequencing_hours": (20, 60), "size_gb": (300, 1200)},
+}  # fmt: skip
+
+# (event, status): latency from the event until statusdb shows the status
+TRANSITIONS = (
+    ("created", "sequencing_started"),
+    ("final_file", "sequencing_finished"),
+    ("final_file", "final_transfer_started"),
+    ("final_file", "transferred_to_hpc"),
+)
+
+_LOG_FILE = re.compile(r"--log-file=(\S+)/rsync_(remote|metadata)_log\.txt")
+_EXIT_CODE_FILE = re.compile(r"echo \$\S+ > (\S+)\s*$")
+
+
+class SimulatedRun:
+    def __init__(self, run_type, index, created_at, final_at, size_bytes):
+        self.run_type = run_type
+        self.index = index
+        self.created_at = created_at
+        self.final_at = final_at
+        self.size_bytes = size_bytes
+        self.run_dir = None
+        self.synced_bytes = 0  # Sent by completed syncs
+        self.status_times = {}
+
+    @property
+    def transferred(self):
+        return "transferred_to_hpc" in self.status_times
+
+    def bytes_written(self, now):
+        """Data written by the instrument at now, growing linearly until the final file."""
+        if now >= self.final_at:
+            return self.size_bytes
+        return (
+            self.size_bytes
+            * (now - self.created_at)
+            / (self.final_at - self.created_at)
+        )
+
+
+class FakeProcess:
+    def __init__(self, pid):
+        self.pid = pid
+
+
+class SimulatedTransfers(fs.RsyncProcessIndex):
+    """Transfer backend that completes rsyncs after their simulated duration.
+
+    Takes the place of both submit_background_process and the process index
+    of a cycle. A transfer takes `overhead` seconds plus the bytes it has to
+    send divided by `throughput` (bytes per second). Final transfers fail
+    with exit code 23 with probability failure_rate.
+    """
+
+    def __init__(self, proc_root, throughput, overhead, failure_rate, rng):
+        super().__init__(proc_root=proc_root)
+        self.runs = {}  # run_dir -> SimulatedRun
+        self.throughput = throughput
+        self.overhead = overhead
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self.now = 0
+        self._next_pid = 1000
+        self._transfers = {}  # pid -> transfer
+
+    def register(self, run):
+        self.runs[run.run_dir] = run
+
+    def submit(self, command_str):
+        run_dir, kind = _LOG_FILE.search(command_str).groups()
+        exit_code_file = _EXIT_CODE_FILE.search(command_str)
+        run = self.runs[run_dir]
+        if kind == "metadata":
+            final, bytes_to_send = False, 0
+        else:
+            final = ".final_rsync_exitcode" in command_str
+            bytes_to_send = max(0, run.bytes_written(self.now) - run.synced_bytes)
+        self._next_pid += 1
+        self._transfers[self._next_pid] = {
+            "run": run,
+            "final": final,
+            "sent_bytes": run.synced_bytes + bytes_to_send,
+            "exit_code_file": exit_code_file.group(1) if exit_code_file else None,
+            "end": self.now + self.overhead + bytes_to_send / self.throughput,
+            "destination": None,
+        }
+        return FakeProcess(self._next_pid)
+
+    def add(self, src, dst, pid=None, start_time=None, bwlimit=None):
+        super().add(src, dst, pid=pid, start_time=start_time, bwlimit=bwlimit)
+        if pid in self._transfers:
+            self._transfers[pid]["destination"] = dst
+
+    def next_completion(self):
+        return min((t["end"] for t in self._transfers.values()), default=math.inf)
+
+    def complete_until(self, now):
+        """Finish the transfers that end by now. Returns the number finished."""
+        done = [pid for pid, t in self._transfers.items() if t["end"] <= now]
+        for pid in done:
+            transfer = self._transfers.pop(pid)
+            failed = transfer["final"] and self.rng.random() < self.failure_rate
+            if not failed:
+                transfer["run"].synced_bytes = max(
+                    transfer["run"].synced_bytes, transfer["sent_bytes"]
+                )
+            if transfer["exit_code_file"]:
+                with open(transfer["exit_code_file"], "w") as f:
+                    f.write("23\n" if failed else "0\n")
+            if transfer["destination"]:
+                self.remove(transfer["run"].run_dir, transfer["destination"])
+        return len(done)
+
+
+def plan_runs(sequencers, days, rng):
+    """Draw the runs started over days, following SEQUENCER_PROFILES."""
+    runs = []
+    for run_type in sequencers:
+        profile = SEQUENCER_PROFILES[run_type]
+        expected = profile["runs_per_day"] * days
+        count = int(expected) + (rng.random() < expected - int(expected))
+        for index in range(count):
+            created_at = rng.uniform(0, days * DAY)
+            duration = rng.uniform(*profile["sequencing_hours"]) * HOUR
+            size = rng.uniform(*profile["size_gb"]) * GB
+            runs.append(
+                SimulatedRun(run_type, index, created_at, created_at + duration, size)
+            )
+    return sorted(runs, key=lambda run: run.created_at)
+
+
+def simulate(runs, config, base_dir, cron_interval, max_days, backend_options, rng):
+    """Run cycles every cron_interval seconds until all runs are transferred.
+
+    Cycles in which nothing happened since the previous one (no new run
+    folder, final file or finished transfer) are skipped, as they would not
+    change anything. The simulation ends when all runs are transferred, when
+    nothing can change any more, e.g. after a failed final transfer, or
+    after max_days. Returns the runs, with the simulated time at which each
+    status was first seen in statusdb.
+    """
+    empty_proc = os.path.join(base_dir, "proc")
+    os.makedirs(empty_proc, exist_ok=True)
+    backend = SimulatedTransfers(empty_proc, rng=rng, **backend_options)
+    original_submit = fs.submit_background_process
+    fs.submit_background_process = backend.submit
+    try:
+        with fake_couchdb() as fake:
+            db = get_statusdb_session(config["statusdb"])
+            pending = list(runs)
+            active = []
+            now = 0.0
+            while (pending or active) and now <= max_days * DAY:
+                backend.now = now
+                changed = backend.complete_until(now) > 0
+                while pending and pending[0].created_at <= now:
+                    run = pending.pop(0)
+                    path = config["sequencers"][run.run_type]["sequencing_path"]
+                    run.run_dir = create_run_folder(path, run.run_type, run.index)
+                    backend.register(run)
+                    active.append(run)
+                    changed = True
+                for run in active:
+                    final_file = os.path.join(
+                        run.run_dir, RUN_CLASS_REGISTRY[run.run_type].final_file
+                    )
+                    if run.final_at <= now and not os.path.exists(final_file):
+                        open(final_file, "w").close()
+                        changed = True
+                if changed:
+                    run_cycle(active, config, db, backend, fake, now)
+                    active = [run for run in active if not run.transferred]
+                now = _next_cycle(now, cron_interval, pending, active, backend)
+    finally:
+        fs.submit_background_process = original_submit
+    return runs
+
+
+def _next_cycle(now, cron_interval, pending, active, backend):
+    """Return the time of the next cycle in which something can have changed.
+
+    Returns math.inf if nothing is left to happen.
+    """
+    next_event = min(
+        [backend.next_completion()]
+        + [run.created_at for run in pending[:1]]
+        + [run.final_at for run in active if run.final_at > now],
+        default=math.inf,
+    )
+    if next_event == math.inf:
+        return math.inf
+    cycles_ahead = max(1, math.ceil((next_event - now) / cron_interval))
+    return now + cycles_ahead * cron_interval
+
+
+def run_cycle(active, config, db, backend, fake, now):
+    scheduler = open_transfer_scheduler(config, backend)
+    if scheduler:
+        scheduler.prune([run.run_dir for run in active])
+    for run in active:
+        process_run_safely(
+            run.run_dir,
+            run.run_type,
+            config,
+            db=db,
+            process_index=backend,
+            scheduler=scheduler,
+        )
+        doc_ids = fake.doc_ids.get(os.path.basename(run.run_dir), [])
+        for doc_id in doc_ids:
+            for event in fake.docs[doc_id].get("events", []):
+                run.status_times.setdefault(event["event_type"], now)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(runs):
+    """Return latency percentiles in minutes per transition and sequencer."""
+    summary = {}
+    for event, status in TRANSITIONS:
+        per_sequencer = {}
+        for run in runs:
+            if status not in run.status_times:
+                continue
+            start = run.created_at if event == "created" else run.final_at
+            latency = (run.status_times[status] - start) / 60
+            per_sequencer.setdefault(run.run_type, []).append(latency)
+            per_sequencer.setdefault("all", []).append(latency)
+        summary[f"{event} -> {status}"] = {
+            sequencer: {
+                "count": len(latencies),
+                "p50": round(percentile(latencies, 0.5), 1),
+                "p90": round(percentile(latencies, 0.9), 1),
+                "p99": round(percentile(latencies, 0.99), 1),
+                "max": round(max(latencies), 1),
+            }
+            for sequencer, latencies in per_sequencer.items()
+        }
+    return summary
+
+
+def print_summary(summary, unfinished):
+    for transition, per_sequencer in summary.items():
+        click.echo(f"  {transition} (minutes)")
+        click.echo(
+            f"    {'sequencer':<14}{'runs':>6}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}"
+        )
+        for sequencer, stats in sorted(per_sequencer.items()):
+            click.echo(
+                f"    {sequencer:<14}{stats['count']:>6}{stats['p50']:>9}"
+                f"{stats['p90']:>9}{stats['p99']:>9}{stats['max']:>9}"
+            )
+    if unfinished:
+        click.echo(
+            f"  {unfinished} runs were not transferred by the end of the simulation"
+        )
+
+
+@click.command()
+@click.option(
+    "--cron-interval",
+    "cron_intervals",
+    type=click.FloatRange(min=1),
+    multiple=True,
+    default=[60],
+    show_default=True,
+    help="Seconds between cycles. Can be given more than once to compare.",
+)
+@click.option(
+    "--max-rsyncs",
+    "max_rsyncs_values",
+    type=click.IntRange(min=0),
+    multiple=True,
+    default=[0],
+    show_default=True,
+    help="scheduler.max_rsyncs, 0 for no limit. Can be given more than once to compare.",
+)
+@click.option(
+    "--sequencer",
+    "sequencers",
+    type=click.Choice(sorted(SEQUENCER_PROFILES)),
+    multiple=True,
+    help="Only simulate these sequencers. Defaults to all of them.",
+)
+@click.option("--days", type=click.FloatRange(min=0, min_open=True), default=1.0)
+@click.option("--max-days", type=click.FloatRange(min=1), default=10.0)
+@click.option(
+    "--throughput-mbps",
+    type=click.FloatRange(min=0, min_open=True),
+    default=200.0,
+    show_default=True,
+    help="MB/s of a single rsync.",
+)
+@click.option(
+    "--transfer-overhead",
+    type=click.FloatRange(min=0),
+    default=60.0,
+    show_default=True,
+    help="Seconds every rsync takes on top of sending data, e.g. to scan the run.",
+)
+@click.option("--failure-rate", type=click.FloatRange(0, 1), default=0.02)
+@click.option("--seed", type=int, default=0)
+@click.option(
+    "--json-output",
+    type=click.Path(dir_okay=False),
+    help="Also write the results as JSON.",
+)
+def cli(
+    cron_intervals,
+    max_rsyncs_values,
+    sequencers,
+    days,
+    max_days,
+    throughput_mbps,
+    transfer_overhead,
+    failure_rate,
+    seed,
+    json_output,
+):
+    """Compare transfer latencies for cron intervals and rsync limits."""
+    logging.basicConfig(level=logging.ERROR)
+    sequencers = [
+        sequencer
+        for sequencer in sequencers or SEQUENCER_PROFILES
+        if sequencer in RUN_CLASS_REGISTRY and sequencer in RUN_ID_GENERATORS
+    ]
+    backend_options = {
+        "throughput": throughput_mbps * 1000**2,
+        "overhead": transfer_overhead,
+        "failure_rate": failure_rate,
+    }
+    results = []
+    for cron_interval, max_rsyncs in itertools.product(
+        cron_intervals, max_rsyncs_values
+    ):
+        # The same runs, transfer failures included, for every combination
+        runs = plan_runs(sequencers, days, random.Random(seed))
+        with tempfile.TemporaryDirectory(prefix="dataflow_transfer_sim_") as base_dir:
+            extra_config = {}
+            if max_rsyncs:
+                extra_config["scheduler"] = {
+                    "max_rsyncs": max_rsyncs,
+                    "state_file": os.path.join(base_dir, "queue.json"),
+                }
+            config = build_config(base_dir, "run-one", sequencers, extra_config)
+            simulate(
+                runs,
+                config,
+                base_dir,
+                cron_interval,
+                max_days,
+                backend_options,
+                random.Random(seed),
+            )
+        summary = summarize(runs)
+        unfinished = sum(1 for run in runs if not run.transferred)
+        click.echo(
+            f"cron interval {cron_interval:g}s, max_rsyncs "
+            f"{max_rsyncs or 'unlimited'}: {len(runs)} runs"
+        )
+        print_summary(summary, unfinished)
+        results.append(
+            {
+                "cron_interval": cron_interval,
+                "max_rsyncs": max_rsyncs,
+                "runs": len(runs),
+                "unfinished": unfinished,
+                "latency_minutes": summary,
+            }
+        )
+    if json_output:
+        with open(json_output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    cli()
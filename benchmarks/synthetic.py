@@ -0,0 +1,199 @@
+"""Synthetic sequencing_path trees with runs in mixed transfer states."""
+
+import json
+import os
+import random
+
+from dataflow_transfer.run_classes import RUN_CLASS_REGISTRY
+
+
+# Run IDs matching the run_id_format of each run class, numbered by i
+def _illumina_id(i):
+    return f"2025{1 + i % 12:02d}{1 + i % 28:02d}_LH00202_{i % 10000:04d}_B{i:09d}LT"
+
+
+RUN_ID_GENERATORS = {
+    "NovaSeqXPlus": _illumina_id,
+    "NextSeq": lambda i: f"25{1 + i % 12:02d}15_VH00203_{i % 1000:03d}_AAH{i:07d}",
+    "MiSeq": lambda i: f"251015_M01548_{i % 10000:04d}_000000000-M{i:06d}",
+    "MiSeqi100": lambda i: f"20260128_SH01140_{i % 10000:04d}_ASC{i:07d}-SC3",
+    "PromethION": lambda i: f"20251015_1051_3B_PBG{i:06d}_{i:08x}",
+    "MinION": lambda i: f"20240229_1404_MN19414_ASH{i:06d}_{i:08x}",
+    "AVITI": lambda i: f"20251007_AV242106_A{i:010d}",
+}
+
+# Metadata files written to each run and uploaded to statusdb, per final file
+METADATA_FILES = {
+    "CopyComplete.txt": "RunInfo.xml",
+    "RunUploaded.json": "RunParameters.json",
+    "final_summary.txt": "report.json",
+}
+
+# State of a run: (share of runs, final file written, final rsync exit code,
+# metadata rsync exit code, statuses already in statusdb)
+RUN_STATES = {
+    "new": (0.05, False, None, None, []),
+    "sequencing": (0.10, False, None, None, ["sequencing_started"]),
+    "final_pending": (0.10, True, None, None, ["sequencing_started"]),
+    "final_failed": (
+        0.05,
+        True,
+        23,
+        0,
+        ["sequencing_started", "sequencing_finished", "transfer_started"],
+    ),
+    "transferred_unmarked": (
+        0.10,
+        True,
+        0,
+        0,
+        ["sequencing_started", "sequencing_finished", "transfer_started"],
+    ),
+    "finished": (
+        0.60,
+        True,
+        0,
+        0,
+        [
+            "sequencing_started",
+            "sequencing_finished",
+            "transfer_started",
+            "transferred_to_hpc",
+        ],
+    ),
+}
+
+
+def _write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _metadata_content(file_name, run_id):
+    if file_name.endswith(".xml"):
+        return (
+            '<?xml version="1.0"?>\n<RunInfo Version="6">'
+            f'<Run Id="{run_id}" Number="1"><Flowcell>{run_id[-9:]}</Flowcell>'
+            "</Run></RunInfo>\n"
+        )
+    return json.dumps({"run_id": run_id, "instrument": "synthetic"})
+
+
+def create_run_folder(sequencing_path, run_type, index):
+    """Write a run folder of run_type, numbered index, with data and metadata files.
+
+    Returns the path of the run folder.
+    """
+    run_id = RUN_ID_GENERATORS[run_type](index)
+    run_dir = os.path.join(sequencing_path, run_id)
+    metadata_file = METADATA_FILES[RUN_CLASS_REGISTRY[run_type].final_file]
+    os.makedirs(os.path.join(run_dir, "data"), exist_ok=True)
+    for tile in range(4):
+        _write(os.path.join(run_dir, "data", f"tile_{tile}.bin"), "x" * 512)
+    _write(
+        os.path.join(run_dir, metadata_file), _metadata_content(metadata_file, run_id)
+    )
+    return run_dir
+
+
+def generate_runs(sequencing_path, run_type, run_count, rng, first_index=0):
+    """Write run_count run folders of run_type to sequencing_path.
+
+    Every run is given a random state from RUN_STATES. Returns a list of
+    (run_dir, state) tuples.
+    """
+    run_class = RUN_CLASS_REGISTRY[run_type]
+    states = list(RUN_STATES)
+    weights = [RUN_STATES[state][0] for state in states]
+    runs = []
+    for i in range(first_index, first_index + run_count):
+        run_dir = create_run_folder(sequencing_path, run_type, i)
+        state = rng.choices(states, weights)[0]
+        _, final_file, final_exit_code, metadata_exit_code, _ = RUN_STATES[state]
+        if final_file:
+            _write(os.path.join(run_dir, run_class.final_file), "")
+        if final_exit_code is not None:
+            _write(
+                os.path.join(run_dir, ".final_rsync_exitcode"), f"{final_exit_code}\n"
+            )
+        if metadata_exit_code is not None:
+            _write(
+                os.path.join(run_dir, ".metadata_rsync_exitcode"),
+                f"{metadata_exit_code}\n",
+            )
+        runs.append((run_dir, state))
+    return runs
+
+
+def seed_statusdb(fake_couchdb, runs):
+    """Add the statusdb documents of runs in the state given for each of them."""
+    for run_dir, state in runs:
+        statuses = RUN_STATES[state][4]
+        if not statuses:
+            continue
+        run_id = os.path.basename(run_dir)
+        fake_couchdb.add_document(
+            {
+                "runfolder_id": run_id,
+                "flowcell_id": run_id.split("_")[-1],
+                "events": [
+                    {
+                        "event_type": status,
+                        "timestamp": "2025-10-01T12:00:00Z",
+                        "data": {},
+                    }
+                    for status in statuses
+                ],
+                "files": {},
+            }
+        )
+
+
+def build_config(base_dir, run_one_path, run_types, extra_config=None):
+    """Return a configuration with one sequencer per run type under base_dir."""
+    sequencers = {}
+    for run_type in run_types:
+        metadata_file = METADATA_FILES[RUN_CLASS_REGISTRY[run_type].final_file]
+        sequencers[run_type] = {
+            "sequencing_path": os.path.join(base_dir, "sequencing", run_type),
+            "remote_destination": f"/remote/{run_type}",
+            "metadata_archive": os.path.join(base_dir, "metadata", run_type),
+            "metadata_for_statusdb": [metadata_file],
+        }
+    config = {
+        "run_one_path": run_one_path,
+        "transfer_details": {"user": "benchmark", "host": "localhost"},
+        "statusdb": {
+            "username": "benchmark",
+            "password": "benchmark",
+            "url": "fake-couchdb",
+            "database": "sequencing_runs",
+        },
+        "sequencers": sequencers,
+    }
+    for key, value in (extra_config or {}).items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key] = {**config[key], **value}
+        else:
+            config[key] = value
+    return config
+
+
+def generate_tree(base_dir, runs_per_sequencer, seed=0, run_types=None):
+    """Generate runs for every run class with a run ID generator.
+
+    Returns a dict mapping each run type to its list of (run_dir, state).
+    """
+    rng = random.Random(seed)
+    run_types = run_types or [
+        run_type for run_type in RUN_CLASS_REGISTRY if run_type in RUN_ID_GENERATORS
+    ]
+    return {
+        run_type: generate_runs(
+            os.path.join(base_dir, "sequencing", run_type),
+            run_type,
+            runs_per_sequencer,
+            rng,
+        )
+        for run_type in run_types
+    }
@@ -0,0 +1,19 @@
+from benchmarks.cycle import find_regressions
+
+
+def test_find_regressions():
+    previous = {
+        "cycles": [
+            {"wall_seconds": 1.0, "forks_per_run": 1.0, "peak_rss_kib": 1000},
+            {"wall_seconds": 0.01, "forks_per_run": 0.5},
+        ]
+    }
+    cycles = [
+        {"wall_seconds": 1.1, "forks_per_run": 2.0, "peak_rss_kib": 1000},
+        # Wall time tripled, but by less than the noise threshold
+        {"wall_seconds": 0.03, "forks_per_run": 0.5},
+    ]
+    assert find_regressions(previous, cycles, tolerance=0.2) == [
+        (1, "forks_per_run", 1.0, 2.0)
+    ]
+    assert find_regressions(previous, cycles, tolerance=1.5) == []
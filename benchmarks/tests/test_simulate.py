@@ -0,0 +1,108 @@
+import math
+import random
+
+import pytest
+
+from benchmarks import simulate as simulate_module
+from benchmarks.simulate import (
+    HOUR,
+    SimulatedRun,
+    _next_cycle,
+    percentile,
+    plan_runs,
+    simulate,
+    summarize,
+)
+from benchmarks.synthetic import build_config
+
+
+class IdleBackend:
+    def __init__(self, next_completion=math.inf):
+        self._next_completion = next_completion
+
+    def next_completion(self):
+        return self._next_completion
+
+
+@pytest.mark.parametrize(
+    "fraction, expected", [(0.0, 1), (0.5, 5), (0.9, 9), (0.99, 10), (1.0, 10)]
+)
+def test_percentile(fraction, expected):
+    assert percentile(list(range(10, 0, -1)), fraction) == expected
+
+
+def test_next_cycle_skips_to_the_cycle_after_the_next_event():
+    run = SimulatedRun("MiSeq", 0, created_at=0, final_at=1000, size_bytes=1)
+    assert _next_cycle(0, 60, [], [run], IdleBackend()) == 1020
+    # A transfer ending sooner comes first, and the next cycle is at least one interval ahead
+    assert _next_cycle(0, 60, [], [run], IdleBackend(next_completion=10)) == 60
+    pending = SimulatedRun("MiSeq", 1, created_at=130, final_at=2000, size_bytes=1)
+    assert _next_cycle(0, 60, [pending], [run], IdleBackend()) == 180
+
+
+def test_next_cycle_when_nothing_is_left_to_happen():
+    run = SimulatedRun("MiSeq", 0, created_at=0, final_at=100, size_bytes=1)
+    assert _next_cycle(600, 60, [], [run], IdleBackend()) == math.inf
+
+
+def test_summarize():
+    runs = [
+        SimulatedRun("MiSeq", 0, created_at=0, final_at=600, size_bytes=1),
+        SimulatedRun("AVITI", 0, created_at=60, final_at=1200, size_bytes=1),
+    ]
+    runs[0].status_times = {"sequencing_started": 60, "transferred_to_hpc": 900}
+    runs[1].status_times = {"sequencing_started": 120}
+    summary = summarize(runs)
+    started = summary["created -> sequencing_started"]
+    assert started["MiSeq"] == {
+        "count": 1,
+        "p50": 1.0,
+        "p90": 1.0,
+        "p99": 1.0,
+        "max": 1.0,
+    }
+    assert started["all"]["count"] == 2
+    assert summary["final_file -> transferred_to_hpc"] == {
+        "MiSeq": {"count": 1, "p50": 5.0, "p90": 5.0, "p99": 5.0, "max": 5.0},
+        "all": {"count": 1, "p50": 5.0, "p90": 5.0, "p99": 5.0, "max": 5.0},
+    }
+    assert runs[0].transferred
+    assert not runs[1].transferred
+
+
+def run_simulation(tmp_path, failure_rate):
+    runs = plan_runs(["MiSeq"], 0.5, random.Random(1))
+    assert runs
+    config = build_config(str(tmp_path), "run-one", ["MiSeq"])
+    simulate(
+        runs,
+        config,
+        str(tmp_path),
+        cron_interval=60,
+        max_days=10,
+        backend_options={
+            "throughput": 200e6,
+            "overhead": 60,
+            "failure_rate": failure_rate,
+        },
+        rng=random.Random(1),
+    )
+    return runs
+
+
+def test_simulate_transfers_every_run_and_stops(tmp_path, monkeypatch):
+    cycle_times = []
+    original_next_cycle = simulate_module._next_cycle
+
+    def next_cycle(now, *args):
+        cycle_times.append(now)
+        return original_next_cycle(now, *args)
+
+    monkeypatch.setattr(simulate_module, "_next_cycle", next_cycle)
+    runs = run_simulation(tmp_path, failure_rate=0)
+    assert all(run.transferred for run in runs)
+    transferred_at = [run.status_times["transferred_to_hpc"] for run in runs]
+    for run, time in zip(runs, transferred_at):
+        assert time < run.final_at + HOUR
+    # No cycles once the last run is transferred
+    assert max(cycle_times) == max(transferred_at)
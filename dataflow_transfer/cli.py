@@ -2,21 +2,32 @@ import logging
 import os
 
 import click
-import yaml
 
-from dataflow_transfer import log
-from dataflow_transfer.dataflow_transfer import transfer_runs
 from dataflow_transfer.run_classes.registry import RUN_CLASS_REGISTRY
 
+# The rest of the package, statusdb client included, is imported when a
+# transfer is started, so that --help, --version and usage errors stay fast
+
 logger = logging.getLogger(__name__)
 
 
 def load_config(config_file_path):
+    import yaml
+
     with open(config_file_path) as file:
         config = yaml.safe_load(file)
     return config
 
 
+def setup_logging(config):
+    from dataflow_transfer import log
+
+    log_file = config.get("log", {}).get("file", None)
+    if log_file:
+        level = config.get("log").get("log_level", "INFO")
+        log.init_logger_file(log_file, level)
+
+
 @click.command()
 @click.version_option()
 @click.option(
@@ -43,7 +54,38 @@ def load_config(config_file_path):
     default=None,
     help="Sequencer type of the run, e.g., NovaSeqXPlus, MiSeq, AVITI. Only valid if --run is specified.",
 )
-def cli(config_file, run, sequencer):
+@click.option(
+    "--daemon",
+    is_flag=True,
+    default=False,
+    help="Keep running and transfer all runs on a schedule instead of once.",
+)
+@click.option(
+    "--interval",
+    required=False,
+    type=click.FloatRange(min=0),
+    default=None,
+    help="Seconds between transfer cycles in --daemon mode. Defaults to daemon.interval in the config, or 60.",
+)
+@click.option(
+    "--profile",
+    "profile_file",
+    required=False,
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write the time spent in each stage of the transfer, per run, as JSON to this file.",
+)
+@click.option(
+    "--profile-stats",
+    "profile_stats_file",
+    required=False,
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Also write cProfile statistics to this file. Only valid if --profile is specified.",
+)
+def cli(
+    config_file, run, sequencer, daemon, interval, profile_file, profile_stats_file
+):
     """
     Command line interface for dataflow_transfer.
     """
@@ -53,9 +95,36 @@ def cli(config_file, run, sequencer):
         )
     if run and not sequencer:
         raise click.UsageError("--run/-r requires --sequencer/-s to be specified.")
+    if daemon and run:
+        raise click.UsageError("--daemon can not be combined with --run/-r.")
+    if interval is not None and not daemon:
+        raise click.UsageError("--interval can only be used together with --daemon.")
+    if profile_file and daemon:
+        raise click.UsageError("--profile can not be combined with --daemon.")
+    if profile_stats_file and not profile_file:
+        raise click.UsageError(
+            "--profile-stats can only be used together with --profile."
+        )
+    if daemon:
+        from dataflow_transfer.daemon import TransferDaemon
+
+        def config_loader():
+            config = load_config(config_file.name)
+            setup_logging(config)
+            return config
+
+        transfer_daemon = TransferDaemon(config_loader, interval=interval)
+        transfer_daemon.install_signal_handlers()
+        transfer_daemon.run()
+        return
+    from dataflow_transfer.dataflow_transfer import transfer_runs
+
     config = load_config(config_file.name)
-    log_file = config.get("log", {}).get("file", None)
-    if log_file:
-        level = config.get("log").get("log_level", "INFO")
-        log.init_logger_file(log_file, level)
+    setup_logging(config)
+    if profile_file:
+        from dataflow_transfer.utils.profiling import PROFILER
+
+        with PROFILER.session(profile_file, profile_stats_file):
+            transfer_runs(config, run, sequencer)
+        return
     transfer_runs(config, run, sequencer)
@@ -0,0 +1,229 @@
+import logging
+import os
+import re
+import signal
+import threading
+import time
+
+from dataflow_transfer.dataflow_transfer import process_run_safely, transfer_runs
+from dataflow_transfer.run_classes.generic_runs import FINAL_RSYNC_EXITCODE_FILE
+from dataflow_transfer.run_classes.registry import RUN_CLASS_REGISTRY
+from dataflow_transfer.utils import filesystem as fs
+from dataflow_transfer.utils.bandwidth import open_bandwidth_manager
+from dataflow_transfer.utils.scheduler import open_transfer_scheduler
+from dataflow_transfer.utils.statusdb import get_statusdb_session
+from dataflow_transfer.utils.watcher import RunWatcher
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL_SECONDS = 60
+
+
+class TransferDaemon:
+    """Run transfer cycles on a schedule inside one long-running process.
+
+    The config, the statusdb session and the other process-wide state stay
+    loaded between cycles. SIGHUP reloads the config before the next cycle,
+    SIGTERM and SIGINT stop the daemon once the current cycle has finished.
+
+    With `watch.enabled` in the config, the time between cycles is spent
+    watching the sequencing directories and active run folders, and a run is
+    processed as soon as a new run folder, its final file or its final rsync
+    exit code file appears.
+    """
+
+    def __init__(self, config_loader, interval=None):
+        """
+        :param config_loader: Zero-arg callable that reads and returns the config
+        :param interval: Seconds between the start of two cycles. Defaults to
+            `daemon.interval` in the config, or 60 seconds.
+        """
+        self.config_loader = config_loader
+        self.config = config_loader()
+        self.interval_override = interval
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._reload = False
+        self.watcher = None
+
+    @property
+    def interval(self):
+        if self.interval_override is not None:
+            return self.interval_override
+        return self.config.get("daemon", {}).get("interval", DEFAULT_INTERVAL_SECONDS)
+
+    def request_reload(self):
+        """Reload the config and start the next cycle."""
+        self._reload = True
+        self._wake.set()
+
+    def stop(self):
+        """Stop after the current cycle."""
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Start the next cycle now instead of waiting for the interval."""
+        self._wake.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.request_reload())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+
+    def reload_config(self):
+        self._reload = False
+        try:
+            self.config = self.config_loader()
+            logger.info("Reloaded configuration")
+        except Exception as e:
+            logger.error(f"Failed to reload configuration, keeping the old one: {e}")
+        if self.watcher:
+            # Sequencing directories or watch settings may have changed
+            self.watcher.close()
+            self.watcher = None
+
+    def setup_watcher(self):
+        watch_config = self.config.get("watch", {})
+        if self.watcher or not watch_config.get("enabled"):
+            return
+        self.watcher = RunWatcher(
+            use_inotify=watch_config.get("mode", "auto") != "poll",
+            poll_interval=watch_config.get("poll_interval", 30),
+        )
+
+    def update_watches(self, results):
+        """Watch all sequencing directories and the run folders that are still active.
+
+        The run folders are taken from the RunResults of the cycle that just
+        ran, so the sequencing directories are not scanned again. Runs the
+        cycle skipped, as finished in the state index, or did not find any
+        more are no longer watched. With results None, e.g. after a failed
+        cycle, the watched run folders are left as they are.
+        """
+        for sequencer, sequencer_config in self.config.get("sequencers", {}).items():
+            sequencing_dir = sequencer_config.get("sequencing_path")
+            if not RUN_CLASS_REGISTRY.get(sequencer) or not os.path.isdir(
+                sequencing_dir or ""
+            ):
+                continue
+            poll = sequencer_config.get("watch_mode") == "poll"
+            self.watcher.watch_sequencing_dir(sequencing_dir, sequencer, poll=poll)
+        if results is None:
+            return
+        active_run_dirs = set()
+        for result in results:
+            if RUN_CLASS_REGISTRY.get(result.sequencer):
+                active_run_dirs.add(result.run_dir)
+                self.update_run_watch(result.run_dir, result.sequencer)
+        for run_dir in self.watcher.watched_runs():
+            if run_dir not in active_run_dirs:
+                self.watcher.unwatch(run_dir)
+
+    def update_run_watch(self, run_dir, sequencer):
+        run_class = RUN_CLASS_REGISTRY.get(sequencer)
+        final_file_present = os.path.exists(os.path.join(run_dir, run_class.final_file))
+        if final_file_present and fs.check_exit_status(
+            os.path.join(run_dir, FINAL_RSYNC_EXITCODE_FILE)
+        ):
+            self.watcher.unwatch(run_dir)
+            return
+        poll = self.config["sequencers"].get(sequencer, {}).get("watch_mode") == "poll"
+        self.watcher.watch_run(
+            run_dir,
+            sequencer,
+            [run_class.final_file, FINAL_RSYNC_EXITCODE_FILE],
+            poll=poll,
+        )
+
+    def process_triggered_runs(self, triggered):
+        """Process the runs in which the watcher saw a change, right away."""
+        db = get_statusdb_session(self.config.get("statusdb"))
+        process_index = fs.RsyncProcessIndex()
+        scheduler = open_transfer_scheduler(self.config, process_index)
+        bandwidth = open_bandwidth_manager(
+            self.config, process_index, RUN_CLASS_REGISTRY
+        )
+        try:
+            for run_dir, sequencer in sorted(triggered):
+                ignore_folders = (
+                    self.config["sequencers"]
+                    .get(sequencer, {})
+                    .get("ignore_folders", [])
+                )
+                run_id_format = getattr(
+                    RUN_CLASS_REGISTRY.get(sequencer), "run_id_format", None
+                )
+                if (
+                    not os.path.isdir(run_dir)
+                    or os.path.basename(run_dir) in ignore_folders
+                    or (
+                        run_id_format
+                        and not re.match(run_id_format, os.path.basename(run_dir))
+                    )
+                ):
+                    # Not a run folder, e.g. a new experiment folder of a
+                    # sequencer with run_depth > 1, found by the next cycle
+                    continue
+                logger.info(f"Change detected in {run_dir}, processing it now")
+                process_run_safely(
+                    run_dir,
+                    sequencer,
+                    self.config,
+                    db=db,
+                    process_index=process_index,
+                    scheduler=scheduler,
+                    bandwidth=bandwidth,
+                )
+                self.update_run_watch(run_dir, sequencer)
+        finally:
+            db.flush()
+
+    def wait_for_next_cycle(self, wait_time):
+        deadline = time.monotonic() + wait_time
+        while not self._wake.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.watcher:
+                self._wake.wait(remaining)
+                continue
+            # Short waits so that signals are handled without much delay
+            triggered = self.watcher.wait(min(remaining, 1))
+            if triggered:
+                try:
+                    self.process_triggered_runs(triggered)
+                except Exception as e:
+                    logger.error(f"Processing of changed runs failed: {e}")
+
+    def run_cycle(self):
+        """Run a transfer cycle and return its RunResults, or None if it failed."""
+        try:
+            return transfer_runs(self.config)
+        except Exception as e:
+            # A failing cycle should not take the daemon down, try again next time
+            logger.error(f"Transfer cycle failed: {e}")
+            return None
+
+    def run(self):
+        logger.info(
+            f"Starting dataflow_transfer daemon, cycle interval {self.interval}s"
+        )
+        while not self._stop.is_set():
+            if self._reload:
+                self.reload_config()
+            start_time = time.monotonic()
+            results = self.run_cycle()
+            if self.config.get("watch", {}).get("enabled"):
+                try:
+                    self.setup_watcher()
+                    self.update_watches(results)
+                except Exception as e:
+                    logger.error(f"Failed to update watched directories: {e}")
+            wait_time = self.interval - (time.monotonic() - start_time)
+            if wait_time > 0 and not self._stop.is_set():
+                self.wait_for_next_cycle(wait_time)
+            self._wake.clear()
+        if self.watcher:
+            self.watcher.close()
+        logger.info("dataflow_transfer daemon stopped")
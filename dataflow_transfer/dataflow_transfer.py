@@ -1,24 +1,58 @@
 import logging
+import os
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import NamedTuple
 
 from dataflow_transfer.run_classes.registry import RUN_CLASS_REGISTRY
-from dataflow_transfer.utils.filesystem import find_runs, get_run_dir
+from dataflow_transfer.utils.bandwidth import open_bandwidth_manager
+from dataflow_transfer.utils.discovery_index import open_discovery_index
+from dataflow_transfer.utils.filesystem import (
+    METADATA_CACHE,
+    RsyncProcessIndex,
+    find_runs,
+    get_run_dir,
+)
+from dataflow_transfer.utils.metrics import METRICS
+from dataflow_transfer.utils.profiling import PROFILER
+from dataflow_transfer.utils.scheduler import open_transfer_scheduler
+from dataflow_transfer.utils.state_index import open_state_index
+from dataflow_transfer.utils.statusdb import StatusSnapshot, get_statusdb_session
 
 logger = logging.getLogger(__name__)
 
+# Runs whose statuses are loaded from statusdb with one query
+STATUS_SNAPSHOT_BATCH_SIZE = 200
 
-def get_run_object(run_dir, sequencer, config):
+
+class RunResult(NamedTuple):
+    """Outcome of processing a single run during a transfer cycle."""
+
+    run_dir: str
+    sequencer: str
+    duration: float
+    error: Exception | None = None
+    state: str | None = None
+
+
+def get_run_object(run_dir, sequencer, config, **run_kwargs):
     run_class = RUN_CLASS_REGISTRY.get(sequencer)
     if run_class:
-        return run_class(run_dir, config)
+        return run_class(run_dir, config, **run_kwargs)
     else:
         raise ValueError(
             f"Unknown sequencer type: {sequencer}. Skipping run: {run_dir}"
         )
 
 
-def process_run(run_dir, sequencer, config):
-    run = get_run_object(run_dir, sequencer, config)
+def process_run(run_dir, sequencer, config, state_index=None, **run_kwargs):
+    """Take the next step in the transfer of a run.
+
+    Returns the state the run is in: "finished", "sequencing",
+    "final_transfer" or "transferred".
+    """
+    with PROFILER.span("run.init"):
+        run = get_run_object(run_dir, sequencer, config, **run_kwargs)
     run.confirm_run_type()
 
     ## Transfer already completed. Do nothing.
@@ -30,13 +64,17 @@ def process_run(run_dir, sequencer, config):
         # Check transfer success both in statusdb and via exit code file
         # To restart transfer, remove the exit code file
         logger.info(f"Transfer of {run_dir} is finished. No action needed.")
-        return
+        if state_index:
+            # Later cycles can skip the run until its directory changes
+            state_index.mark_finished(run_dir, sequencer)
+        METADATA_CACHE.forget(run_dir)
+        return "finished"
 
     ## Sequencing ongoing. Start background transfer if not already running.
     if run.sequencing_ongoing:
         run.update_statusdb(status="sequencing_started")
         run.start_transfer(final=False)
-        return
+        return "sequencing"
 
     ## Sequencing finished. Copy metadata in the background if not already done.
     if run.has_status("sequencing_finished"):
@@ -53,14 +91,15 @@ def process_run(run_dir, sequencer, config):
             )
         run.update_statusdb(status="sequencing_finished")
         run.start_transfer(final=True)
-        return
+        return "final_transfer"
 
     ## Final transfer completed successfully. Update statusdb.
     if run.final_sync_successful:
         if not run.has_status("transferred_to_hpc"):
             logger.info(f"Final transfer completed successfully for {run_dir}.")
             run.update_statusdb(status="transferred_to_hpc")
-        return
+            record_time_to_transferred(run, sequencer)
+        return "transferred"
 
     ## Unknown status of run. Log error and raise exception.
     else:
@@ -68,28 +107,356 @@ def process_run(run_dir, sequencer, config):
         raise RuntimeError(f"Unknown status for {run_dir}.")
 
 
+def record_time_to_transferred(run, sequencer):
+    """Record the time from the final file of a run to its transferred_to_hpc status."""
+    try:
+        final_file_time = os.path.getmtime(os.path.join(run.run_dir, run.final_file))
+    except OSError:
+        return
+    METRICS.observe(
+        "dataflow_transfer_final_file_to_transferred_seconds",
+        time.time() - final_file_time,
+        {"sequencer": sequencer},
+    )
+
+
+def process_run_safely(run_dir, sequencer, config, **run_kwargs):
+    """Process a run, timing it and isolating any error to this run."""
+    logger.info(f"Processing directory: {run_dir}")
+    start_time = time.monotonic()
+    try:
+        with PROFILER.run(run_dir, sequencer):
+            state = process_run(run_dir, sequencer, config, **run_kwargs)
+    except Exception as e:
+        logger.error(f"Error processing run {run_dir}: {e}")
+        return RunResult(run_dir, sequencer, time.monotonic() - start_time, e, "failed")
+    return RunResult(run_dir, sequencer, time.monotonic() - start_time, state=state)
+
+
+def get_worker_limits(conf):
+    """Return the global worker count and the per-sequencer worker limits.
+
+    The global count is read from `concurrency.workers` (default 1, i.e. runs
+    are processed one after another). A sequencer can be capped further with
+    `max_workers` in its own section of the config.
+    """
+    workers = max(1, int(conf.get("concurrency", {}).get("workers", 1)))
+    sequencer_limits = {}
+    for sequencer, sequencer_config in conf.get("sequencers", {}).items():
+        limit = (sequencer_config or {}).get("max_workers")
+        sequencer_limits[sequencer] = (
+            min(workers, max(1, int(limit))) if limit else workers
+        )
+    return workers, sequencer_limits
+
+
+def process_runs_concurrently(
+    runs_per_sequencer, conf, workers, sequencer_limits, **run_kwargs
+):
+    """Process runs in a bounded thread pool, respecting per-sequencer limits.
+
+    Runs are handed to the pool round-robin over the sequencers so that one
+    large sequencing_path can not starve the others. The runs of a sequencer
+    can be any iterable, and are only taken from it when a worker is free.
+    """
+    queues = {
+        sequencer: iter(run_dirs) for sequencer, run_dirs in runs_per_sequencer.items()
+    }
+    results = []
+    running = {}
+    active = dict.fromkeys(queues, 0)
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="transfer"
+    ) as executor:
+        while True:
+            submitted = True
+            while submitted and len(running) < workers:
+                submitted = False
+                for sequencer in list(queues):
+                    if len(running) >= workers:
+                        break
+                    if active[sequencer] >= sequencer_limits.get(sequencer, workers):
+                        continue
+                    run_dir = next(queues[sequencer], None)
+                    if run_dir is None:
+                        del queues[sequencer]
+                        continue
+                    future = executor.submit(
+                        process_run_safely, run_dir, sequencer, conf, **run_kwargs
+                    )
+                    running[future] = sequencer
+                    active[sequencer] += 1
+                    submitted = True
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                active[running.pop(future)] -= 1
+                results.append(future.result())
+    return results
+
+
+def finished_sequencing_first(run_dirs, sequencer):
+    """Order runs so that the ones ready for their final transfer come first."""
+    run_class = RUN_CLASS_REGISTRY.get(sequencer)
+    if not run_class or not run_class.final_file:
+        return run_dirs
+    return sorted(
+        run_dirs,
+        key=lambda run_dir: (
+            not os.path.exists(os.path.join(run_dir, run_class.final_file))
+        ),
+    )
+
+
+def load_status_snapshot(snapshot, run_dirs):
+    """Load the current statuses of runs into snapshot with a single statusdb query.
+
+    If the statuses could not be loaded, each of the runs falls back to
+    looking up its own statuses.
+    """
+    try:
+        snapshot.load([os.path.basename(run_dir) for run_dir in run_dirs])
+    except Exception as e:
+        logger.warning(
+            f"Could not load status snapshot, looking up runs one by one: {e}"
+        )
+
+
+def with_status_snapshot(run_dirs, snapshot, batch_size=STATUS_SNAPSHOT_BATCH_SIZE):
+    """Yield run_dirs, loading the statuses of each batch of runs before it."""
+    batch = []
+    for run_dir in run_dirs:
+        batch.append(run_dir)
+        if len(batch) >= batch_size:
+            load_status_snapshot(snapshot, batch)
+            yield from batch
+            batch = []
+    if batch:
+        load_status_snapshot(snapshot, batch)
+        yield from batch
+
+
+def discover_runs(
+    sequencer,
+    sequencer_config,
+    found_run_dirs,
+    skipped_runs,
+    state_index=None,
+    discovery_index=None,
+):
+    """Yield the run directories of a sequencer that need to be processed.
+
+    Run folders are looked for `run_depth` levels below the sequencing path
+    (default 1), using the discovery index if there is one. Folders whose
+    name does not match the run_id_format of the sequencer's run class are
+    passed over without creating a Run. Every run found is added to
+    found_run_dirs, and runs recorded as finished in the state index, and
+    unchanged since, are counted in skipped_runs instead of being yielded.
+    """
+    run_class = RUN_CLASS_REGISTRY.get(sequencer)
+    skipped_runs[sequencer] = 0
+    finder = discovery_index.find_runs if discovery_index else find_runs
+    for run_dir in finder(
+        sequencer_config.get("sequencing_path"),
+        sequencer_config.get("ignore_folders", []),
+        run_id_format=getattr(run_class, "run_id_format", None),
+        depth=int(sequencer_config.get("run_depth", 1)),
+    ):
+        found_run_dirs.append(run_dir)
+        if state_index and state_index.is_finished(run_dir):
+            skipped_runs[sequencer] += 1
+            continue
+        yield run_dir
+
+
+def log_cycle_summary(results, elapsed_time):
+    """Log a summary of the cycle with per-run durations, slowest first."""
+    failed = [result for result in results if result.error]
+    logger.info(
+        f"Cycle summary: processed {len(results)} runs ({len(failed)} failed) "
+        f"in {elapsed_time:.2f} seconds."
+    )
+    for result in sorted(results, key=lambda r: r.duration, reverse=True):
+        outcome = f"failed: {result.error}" if result.error else "ok"
+        logger.info(
+            f"  {result.sequencer} {result.run_dir}: {result.duration:.2f}s ({outcome})"
+        )
+
+
+def record_cycle_metrics(conf, results, skipped_runs, elapsed_time):
+    """Update the cycle metrics and write them to `metrics.textfile`, if set.
+
+    skipped_runs maps each sequencer to its number of runs skipped as finished.
+    """
+    METRICS.set("dataflow_transfer_cycle_duration_seconds", elapsed_time)
+    METRICS.set("dataflow_transfer_last_cycle_timestamp_seconds", time.time())
+    run_counts = {}
+    for sequencer, skipped in skipped_runs.items():
+        run_counts[(sequencer, "finished")] = skipped
+    for result in results:
+        key = (result.sequencer, result.state or "unknown")
+        run_counts[key] = run_counts.get(key, 0) + 1
+    METRICS.clear("dataflow_transfer_runs")
+    for (sequencer, state), count in run_counts.items():
+        METRICS.set(
+            "dataflow_transfer_runs", count, {"sequencer": sequencer, "state": state}
+        )
+    textfile = conf.get("metrics", {}).get("textfile")
+    if textfile:
+        METRICS.write_textfile(textfile)
+
+
 def transfer_runs(conf, run=None, sequencer=None):
+    """Run a transfer cycle over all runs, or over a single run if one is given.
+
+    Returns the RunResult of every run processed by a cycle over all runs,
+    and None for a single run.
+    """
     start_time = time.time()
-    if run:
-        logger.info(f"Transferring specific run: {run}")
-        run_dir = get_run_dir(run)
-        process_run(run_dir, sequencer, conf)
-        end_time = time.time()
-    else:
-        logger.info("Transferring all runs as per configuration")
-        sequencers = conf.get("sequencers", {})
-        for sequencer in sequencers.keys():
-            logger.info(f"Processing data from: {sequencer}")
-            sequencing_dir = sequencers.get(sequencer).get("sequencing_path")
-            for run_dir in find_runs(
-                sequencing_dir, sequencers.get(sequencer).get("ignore_folders", [])
-            ):
-                logger.info(f"Processing directory: {run_dir}")
-                try:
-                    process_run(run_dir, sequencer, conf)
-                except Exception as e:
-                    logger.error(f"Error processing run {run_dir}: {e}")
-                    continue  # Continue with the next run
-        end_time = time.time()
+    db = get_statusdb_session(conf.get("statusdb"))
+    write_counts_before = db.write_counts()
+    try:
+        if run:
+            logger.info(f"Transferring specific run: {run}")
+            run_dir = get_run_dir(run)
+            state_index = open_state_index(conf)
+            if state_index:
+                # A run given explicitly is always checked in full
+                state_index.forget(run_dir)
+            process_index = RsyncProcessIndex()
+            with PROFILER.run(run_dir, sequencer):
+                process_run(
+                    run_dir,
+                    sequencer,
+                    conf,
+                    state_index=state_index,
+                    db=db,
+                    process_index=process_index,
+                    scheduler=open_transfer_scheduler(conf, process_index),
+                    bandwidth=open_bandwidth_manager(
+                        conf, process_index, RUN_CLASS_REGISTRY
+                    ),
+                )
+        else:
+            logger.info("Transferring all runs as per configuration")
+            state_index = open_state_index(conf)
+            discovery_index = open_discovery_index(conf)
+            try:
+                results, skipped_runs = transfer_all_runs(
+                    conf, db, state_index, discovery_index
+                )
+            finally:
+                if state_index:
+                    state_index.close()
+                if discovery_index:
+                    discovery_index.close()
+    finally:
+        # Send any status changes queued in write-behind mode
+        db.flush()
+    end_time = time.time()
+    if not run:
+        log_cycle_summary(results, end_time - start_time)
+        record_cycle_metrics(conf, results, skipped_runs, end_time - start_time)
+    write_counts = db.write_counts()
+    logger.info(
+        f"Statusdb writes: {write_counts['written'] - write_counts_before['written']} "
+        f"written, {write_counts['skipped'] - write_counts_before['skipped']} "
+        "skipped as unchanged."
+    )
     elapsed_time = end_time - start_time
     logger.info(f"Data transfer process completed in {elapsed_time:.2f} seconds.")
+    return None if run else results
+
+
+def transfer_all_runs(conf, db, state_index=None, discovery_index=None):
+    """Process all runs in the configured sequencing directories.
+
+    Runs are discovered lazily and processed as they are found. Runs
+    recorded as finished in the state index, and unchanged since, are
+    skipped without being looked at any further.
+
+    Returns the RunResult of each processed run, and the number of skipped
+    runs per sequencer.
+    """
+    results, skipped_runs, found_run_dirs = _process_discovered_runs(
+        conf, db, state_index, discovery_index
+    )
+    if discovery_index:
+        discovery_index.prune()
+    if state_index:
+        state_index.prune(found_run_dirs)
+        logger.info(
+            f"Skipped {sum(skipped_runs.values())} finished runs recorded in the state index"
+        )
+    return results, skipped_runs
+
+
+def _process_discovered_runs(conf, db, state_index, discovery_index):
+    sequencers = conf.get("sequencers", {})
+    workers, sequencer_limits = get_worker_limits(conf)
+    skipped_runs = {}
+    found_run_dirs = []
+    runs_per_sequencer = {
+        sequencer: discover_runs(
+            sequencer,
+            sequencer_config,
+            found_run_dirs,
+            skipped_runs,
+            state_index,
+            discovery_index,
+        )
+        for sequencer, sequencer_config in sequencers.items()
+    }
+    # One scan of the process table for all rsync checks in this cycle
+    process_index = RsyncProcessIndex()
+    bandwidth = open_bandwidth_manager(conf, process_index, RUN_CLASS_REGISTRY)
+    if bandwidth:
+        # Stopped intermediate syncs are started again below with a new limit
+        bandwidth.rebalance()
+    scheduler = open_transfer_scheduler(conf, process_index)
+    if scheduler:
+        # Ordering the runs for the scheduler needs all of them up front
+        runs_per_sequencer = {
+            sequencer: finished_sequencing_first(list(run_dirs), sequencer)
+            for sequencer, run_dirs in runs_per_sequencer.items()
+        }
+        scheduler.prune(found_run_dirs)
+    status_snapshot = StatusSnapshot(db)
+    runs_per_sequencer = {
+        sequencer: with_status_snapshot(run_dirs, status_snapshot)
+        for sequencer, run_dirs in runs_per_sequencer.items()
+    }
+    if workers > 1:
+        logger.info(f"Processing runs with {workers} workers")
+        results = process_runs_concurrently(
+            runs_per_sequencer,
+            conf,
+            workers,
+            sequencer_limits,
+            state_index=state_index,
+            db=db,
+            status_snapshot=status_snapshot,
+            process_index=process_index,
+            scheduler=scheduler,
+            bandwidth=bandwidth,
+        )
+        return results, skipped_runs, found_run_dirs
+    results = []
+    for sequencer, run_dirs in runs_per_sequencer.items():
+        logger.info(f"Processing data from: {sequencer}")
+        for run_dir in run_dirs:
+            results.append(
+                process_run_safely(
+                    run_dir,
+                    sequencer,
+                    conf,
+                    state_index=state_index,
+                    db=db,
+                    status_snapshot=status_snapshot,
+                    process_index=process_index,
+                    scheduler=scheduler,
+                    bandwidth=bandwidth,
+                )
+            )
+    return results, skipped_runs, found_run_dirs
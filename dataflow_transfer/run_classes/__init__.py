@@ -1,12 +1,15 @@
-# This adds the run classes to the registry. Do not remove.
-
-from dataflow_transfer.run_classes.element_runs import AVITIRun  # noqa: F401, I001
-from dataflow_transfer.run_classes.illumina_runs import (
-    MiSeqRun,  # noqa: F401
-    NextSeqRun,  # noqa: F401
-    NovaSeqXPlusRun,  # noqa: F401
-    MiSeqi100Run,  # noqa: F401
-)
-from dataflow_transfer.run_classes.ont_runs import MinIONRun, PromethIONRun  # noqa: F401
-
-from .registry import RUN_CLASS_REGISTRY  # noqa: F401
+# Run classes are imported when they are first looked up in the registry,
+# see _RUN_CLASS_MODULES in registry.py.
+
+from .registry import _RUN_CLASS_MODULES, RUN_CLASS_REGISTRY  # noqa: F401
+
+_RUN_CLASS_TYPES = {
+    class_name: run_type for run_type, (_, class_name) in _RUN_CLASS_MODULES.items()
+}
+
+
+def __getattr__(name):
+    # Keeps `from dataflow_transfer.run_classes import NovaSeqXPlusRun` working
+    if name in _RUN_CLASS_TYPES:
+        return RUN_CLASS_REGISTRY[_RUN_CLASS_TYPES[name]]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
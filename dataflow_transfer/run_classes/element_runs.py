@@ -6,9 +6,7 @@ from .registry import register_run_class
 class ElementRun(Run):
     """Defines an Element sequencing run"""
 
-    def __init__(self, run_dir, configuration):
-        super().__init__(run_dir, configuration)
-        self.final_file = "RunUploaded.json"
+    final_file = "RunUploaded.json"
 
 
 @register_run_class
@@ -16,12 +14,10 @@ class AVITIRun(ElementRun):
     """Defines an AVITI sequencing run"""
 
     run_type = "AVITI"
+    run_id_format = r"^\d{8}_AV\d{6}_(A|B)\d{10}$"  # 20251007_AV242106_A2507535225
 
-    def __init__(self, run_dir, configuration):
-        self.run_id_format = (
-            r"^\d{8}_AV\d{6}_(A|B)\d{10}$"  # 20251007_AV242106_A2507535225
-        )
-        super().__init__(run_dir, configuration)
+    def __init__(self, run_dir, configuration, **kwargs):
+        super().__init__(run_dir, configuration, **kwargs)
         self.flowcell_id = self.run_id.split("_")[-1][1:]  # 2507535225
 
 
@@ -4,22 +4,55 @@ import re
 from datetime import datetime
 
 import dataflow_transfer.utils.filesystem as fs
-from dataflow_transfer.utils.statusdb import StatusdbSession
+from dataflow_transfer.utils.manifest import MANIFEST_FILE_PATTERNS, RunManifest
+from dataflow_transfer.utils.metrics import METRICS
+from dataflow_transfer.utils.profiling import profiled
+from dataflow_transfer.utils.progress import (
+    DEFAULT_WRITE_INTERVAL_SECONDS,
+    PROGRESS_FILE_PATTERN,
+    RSYNC_LOG_FILE_FORMAT,
+    ProgressCollector,
+)
+from dataflow_transfer.utils.statusdb import (
+    StatusdbSession,
+    StatusSnapshot,
+    content_hash,
+)
 
 logger = logging.getLogger(__name__)
 
+FINAL_RSYNC_EXITCODE_FILE = ".final_rsync_exitcode"
+# Written to the run folder for the tool's own use, and left out of the
+# transfers to remote storage so that they do not end up in delivered runs
+SHARD_FILE_LIST = ".rsync_shard_{index}.files"
+INTERNAL_FILE_PATTERNS = (
+    SHARD_FILE_LIST.format(index="*"),
+    *MANIFEST_FILE_PATTERNS,
+    PROGRESS_FILE_PATTERN,
+)
+
 
 class Run:
     """Defines a generic sequencing run"""
 
-    def __init__(self, run_dir, configuration):
+    final_file = ""
+
+    def __init__(
+        self,
+        run_dir,
+        configuration,
+        db=None,
+        status_snapshot=None,
+        process_index=None,
+        scheduler=None,
+        bandwidth=None,
+    ):
         self.run_dir = run_dir
         self.run_id = os.path.basename(run_dir)
         self.configuration = configuration
         self.sequencer_config = self.configuration.get("sequencers").get(
             getattr(self, "run_type", None)
         )
-        self.final_file = ""
         self.transfer_details = self.configuration.get("transfer_details", {})
         self.metadata_rsync_exitcode_file = os.path.join(
             self.run_dir, ".metadata_rsync_exitcode"
@@ -29,11 +62,23 @@ class Run:
             self.run_id,
         )
         self.final_rsync_exitcode_file = os.path.join(
-            self.run_dir, ".final_rsync_exitcode"
+            self.run_dir, FINAL_RSYNC_EXITCODE_FILE
         )
         self.remote_destination = self.sequencer_config.get("remote_destination")
-        self.db = StatusdbSession(self.configuration.get("statusdb"))
+        # Number of parallel rsync streams for the final transfer
+        self.rsync_shards = int(self.sequencer_config.get("rsync_shards", 1))
+        # Intermediate syncs only send files that are new since the last one
+        self.incremental_sync = bool(
+            self.sequencer_config.get("incremental_sync", False)
+        )
+        self.db = db or StatusdbSession(self.configuration.get("statusdb"))
+        # Without a shared snapshot the statuses are still only fetched once per run
+        self.status_snapshot = status_snapshot or StatusSnapshot(self.db)
+        self.process_index = process_index
+        self.scheduler = scheduler
+        self.bandwidth = bandwidth
 
+    @profiled("run.confirm_run_type")
     def confirm_run_type(self):
         """Compare run ID with expected format for the run type."""
         if not re.match(self.run_id_format, self.run_id):
@@ -42,6 +87,7 @@ class Run:
             )
 
     @property
+    @profiled("run.sequencing_ongoing")
     def sequencing_ongoing(self):
         """Check if sequencing is still ongoing by looking for the absence of the final file."""
         final_file_path = os.path.join(self.run_dir, self.final_file)
@@ -50,23 +96,27 @@ class Run:
         return True
 
     @property
+    @profiled("run.metadata_synced")
     def metadata_synced(self):
         """Check if the metadata rsync was successful by reading the exit code file."""
         return fs.check_exit_status(self.metadata_rsync_exitcode_file)
 
+    @profiled("run.sync_metadata")
     def sync_metadata(self):
         """Start background rsync transfer for metadata files."""
         metadata_rsync_command = self.generate_rsync_command(
             metadata_only=True, with_exit_code_file=True
         )
 
-        if fs.rsync_is_running(src=self.run_dir, dst=self.metadata_destination):
+        if self.rsync_is_running(dst=self.metadata_destination):
             logger.info(
                 f"Metadata rsync is already running for {self.run_dir} to destination {self.metadata_destination}. Skipping background metadata sync initiation."
             )
             return
         try:
-            fs.submit_background_process(metadata_rsync_command)
+            process = fs.submit_background_process(metadata_rsync_command)
+            self.record_rsync(self.metadata_destination, process)
+            self.count_rsync_started("metadata")
             logger.info(
                 f"{self.run_id}: Started metadata rsync to {self.metadata_destination}"
                 + f" with the following command: '{metadata_rsync_command}'"
@@ -75,8 +125,63 @@ class Run:
             logger.error(f"Failed to start metadata rsync for {self.run_id}: {e}")
             raise e
 
-    def generate_rsync_command(self, metadata_only=False, with_exit_code_file=False):
-        """Generate an rsync command string."""
+    def rsync_is_running(self, dst):
+        """Check if an rsync from the run directory to dst is running.
+
+        Uses the cycle's process index when there is one, instead of scanning
+        the process table for every check.
+        """
+        if self.process_index is not None:
+            return self.process_index.is_running(src=self.run_dir, dst=dst)
+        return fs.rsync_is_running(src=self.run_dir, dst=dst)
+
+    def count_rsync_started(self, kind):
+        METRICS.inc(
+            "dataflow_transfer_rsync_started_total",
+            {"sequencer": getattr(self, "run_type", "unknown"), "kind": kind},
+        )
+
+    def record_rsync(self, dst, process, bwlimit=None):
+        """Add a newly started rsync to the cycle's process index."""
+        if self.process_index is not None:
+            self.process_index.add(
+                src=self.run_dir,
+                dst=dst,
+                pid=getattr(process, "pid", None),
+                bwlimit=bwlimit,
+            )
+
+    def transfer_slot_available(self, final):
+        """Ask the cycle's transfer scheduler, if any, for a slot to start an rsync.
+
+        A run that has to wait gets the transfer_queued status when it is
+        first queued.
+        """
+        if self.scheduler is None:
+            return True
+        already_queued = self.scheduler.is_queued(self.run_dir)
+        if self.scheduler.request_slot(
+            self.run_dir, getattr(self, "run_type", None), final
+        ):
+            return True
+        logger.info(
+            f"{self.run_id}: Concurrent transfer limit reached, queued the "
+            f"{'final' if final else 'intermediate'} transfer"
+        )
+        if not already_queued:
+            self.update_statusdb(
+                status="transfer_queued", additional_info={"final": final}
+            )
+        return False
+
+    def generate_rsync_command(
+        self, metadata_only=False, with_exit_code_file=False, bwlimit=None
+    ):
+        """Generate an rsync command string.
+
+        bwlimit (KiB/s) is added after the configured rsync options, so it
+        overrides a static --bwlimit given there.
+        """
         if metadata_only:
             source = self.run_dir + "/"
             destination = self.metadata_destination + "/"
@@ -97,7 +202,7 @@ class Run:
             log_file_option = "--log-file=" + os.path.join(
                 self.run_dir, "rsync_remote_log.txt"
             )
-            rsync_options = self.sequencer_config.get("remote_rsync_options", [])
+            rsync_options = self.remote_rsync_options
             exit_code_file = self.final_rsync_exitcode_file
 
         run_one_bin = self.configuration.get("run_one_path", "run-one")
@@ -107,6 +212,7 @@ class Run:
             "-au",
             log_file_option,
             *(rsync_options),
+            f"--bwlimit={bwlimit}" if bwlimit else "",
             "--exclude='*'" if metadata_only else "",
             source,
             destination,
@@ -116,25 +222,161 @@ class Run:
             command_str += f"; echo $? > {exit_code_file}"
         return command_str
 
+    @property
+    def remote_rsync_options(self):
+        """Configured options for rsyncs to remote storage.
+
+        With progress tracking enabled, the log format is set so that the
+        log shows the number of bytes sent for each file. The tool's own
+        files in the run folder are excluded.
+        """
+        options = list(self.sequencer_config.get("remote_rsync_options", []))
+        if self.configuration.get("progress", {}).get("enabled"):
+            options.append(RSYNC_LOG_FILE_FORMAT)
+        options.extend(f"--exclude='{pattern}'" for pattern in INTERNAL_FILE_PATTERNS)
+        return options
+
+    @property
+    def remote_run_destination(self):
+        """rsync destination of the run folder itself on remote storage."""
+        return (
+            self.transfer_details.get("user")
+            + "@"
+            + self.transfer_details.get("host")
+            + ":"
+            + os.path.join(self.remote_destination, self.run_id)
+            + "/"
+        )
+
+    def generate_incremental_rsync_command(self, bwlimit=None):
+        """Generate an rsync command sending only the files listed by the run manifest.
+
+        The exit code is written to the intermediate exit code file, so that
+        the manifest is only updated with the files when the rsync succeeded.
+        """
+        manifest = RunManifest(self.run_dir, exclude=INTERNAL_FILE_PATTERNS)
+        command = [
+            self.configuration.get("run_one_path", "run-one"),
+            "rsync",
+            "-au",
+            "--log-file=" + os.path.join(self.run_dir, "rsync_remote_log.txt"),
+            *(self.remote_rsync_options),
+            f"--bwlimit={bwlimit}" if bwlimit else "",
+            "--from0",
+            f"--files-from={manifest.file_list}",
+            self.run_dir + "/",
+            self.remote_run_destination,
+        ]
+        return (
+            " ".join(part for part in command if part)
+            + f"; echo $? > {manifest.exit_code_file}"
+        )
+
+    def generate_sharded_rsync_command(self, bwlimit=None):
+        """Generate a command that runs the final transfer as parallel rsync streams.
+
+        The files of the run are split into rsync_shards sets of similar size,
+        each transferred by its own rsync with --files-from. When all of them
+        succeed, a regular rsync of the whole run picks up anything that was
+        not in the file lists, such as empty directories. The exit code file
+        gets the last non-zero exit code, or 0 if everything succeeded.
+        """
+        list_files = [
+            os.path.join(self.run_dir, SHARD_FILE_LIST.format(index=index))
+            for index in range(self.rsync_shards)
+        ]
+        shards = fs.split_into_shards(
+            self.run_dir,
+            self.rsync_shards,
+            exclude={os.path.basename(list_file) for list_file in list_files},
+        )
+        shards = [shard for shard in shards if shard]
+        destination = self.remote_run_destination
+        log_file_option = "--log-file=" + os.path.join(
+            self.run_dir, "rsync_remote_log.txt"
+        )
+        # The streams share the bandwidth given to the transfer
+        shard_bwlimit = max(1, bwlimit // len(shards)) if bwlimit and shards else None
+        run_one_bin = self.configuration.get("run_one_path", "run-one")
+        commands = []
+        for index, (list_file, shard) in enumerate(zip(list_files, shards)):
+            fs.write_file_list(list_file, shard)
+            command = [
+                run_one_bin,
+                "rsync",
+                "-au",
+                log_file_option,
+                *(self.remote_rsync_options),
+                f"--bwlimit={shard_bwlimit}" if shard_bwlimit else "",
+                "--from0",
+                f"--files-from={list_file}",
+                self.run_dir + "/",
+                destination,
+            ]
+            commands.append(
+                " ".join(part for part in command if part) + f" & pid{index}=$!"
+            )
+        full_command = self.generate_rsync_command(
+            metadata_only=False, with_exit_code_file=False, bwlimit=bwlimit
+        )
+        pids = " ".join(f"$pid{index}" for index in range(len(commands)))
+        return (
+            "; ".join(commands + ["rc=0"])
+            + f"; for pid in {pids}; do wait $pid || rc=$?; done"
+            + f"; if [ $rc -eq 0 ]; then {full_command}; rc=$?; fi"
+            + f"; echo $rc > {self.final_rsync_exitcode_file}"
+        )
+
+    @profiled("run.start_transfer")
     def start_transfer(self, final=False):
         """Start background rsync transfer to storage."""
-        transfer_command = self.generate_rsync_command(
-            metadata_only=False, with_exit_code_file=final
-        )
-        if fs.rsync_is_running(src=self.run_dir, dst=self.remote_destination):
+        if self.rsync_is_running(dst=self.remote_destination):
             logger.info(
                 f"Rsync is already running for {self.run_dir} to destination {self.remote_destination}. Skipping background transfer initiation."
             )
+            self.record_progress()
+            return
+        incremental = not final and self.incremental_sync
+        manifest = None
+        if incremental:
+            manifest = RunManifest(self.run_dir, exclude=INTERNAL_FILE_PATTERNS)
+            if not manifest.prepare():
+                logger.info(f"{self.run_id}: No new or changed files to sync")
+                return
+        if not self.transfer_slot_available(final):
+            if manifest:
+                # Otherwise the next cycle takes the sync as started and failed
+                manifest.discard()
             return
         try:
-            fs.submit_background_process(transfer_command)
-            logger.info(
-                f"{self.run_id}: Started rsync to {self.remote_destination}"
-                + f" with the following command: '{transfer_command}'"
+            bwlimit = (
+                self.bandwidth.allocate(self.run_dir, final) if self.bandwidth else None
             )
+            if final and self.rsync_shards > 1:
+                transfer_command = self.generate_sharded_rsync_command(bwlimit=bwlimit)
+            elif incremental:
+                transfer_command = self.generate_incremental_rsync_command(
+                    bwlimit=bwlimit
+                )
+            else:
+                transfer_command = self.generate_rsync_command(
+                    metadata_only=False, with_exit_code_file=final, bwlimit=bwlimit
+                )
+            process = fs.submit_background_process(transfer_command)
         except Exception as e:
             logger.error(f"Failed to start rsync for {self.run_id}: {e}")
+            if self.scheduler is not None:
+                # Otherwise the slot stays taken for the rest of the cycle
+                self.scheduler.release_slot(
+                    self.run_dir, getattr(self, "run_type", None)
+                )
             raise e
+        self.record_rsync(self.remote_destination, process, bwlimit=bwlimit)
+        self.count_rsync_started("final" if final else "intermediate")
+        logger.info(
+            f"{self.run_id}: Started rsync to {self.remote_destination}"
+            + f" with the following command: '{transfer_command}'"
+        )
         rsync_info = {
             "command": transfer_command,
             "destination_path": self.remote_destination,
@@ -147,16 +389,86 @@ class Run:
             self.update_statusdb(status="transfer_started", additional_info=rsync_info)
 
     @property
+    @profiled("run.final_sync_successful")
     def final_sync_successful(self):
         """Check if the final rsync transfer was successful by reading the exit code file."""
         return fs.check_exit_status(self.final_rsync_exitcode_file)
 
+    @profiled("run.has_status")
     def has_status(self, status_name):
-        """Check if a specific status exists in the statusdb events for this run."""
-        events = self.db.get_events(self.run_id)["rows"]
-        current_statuses = events[0].get("value", {}) if events else {}
+        """Check if a specific status exists in the statusdb events for this run.
+
+        The statuses are read from the cycle's status snapshot when there is
+        one, and only fetched from the database if the run is not in it.
+        """
+        current_statuses = self.status_snapshot.get(self.run_id)
+        if current_statuses is None:
+            events = self.db.get_events(self.run_id)["rows"]
+            current_statuses = events[0].get("value", {}) if events else {}
+            self.status_snapshot.set(self.run_id, current_statuses)
         return True if current_statuses.get(status_name) else False
 
+    def is_duplicate_write(self, db_doc, status, additional_info, changed_checksums):
+        """Check if a status update would write the same content as the latest event.
+
+        Only applies when `statusdb.dedup_window` is set, and only if the
+        latest event is at most that many seconds old. The event type, its data
+        and the checksums of the metadata files are compared by content hash.
+        """
+        dedup_window = self.configuration.get("statusdb", {}).get("dedup_window")
+        events = db_doc.get("events", [])
+        if not dedup_window or not events:
+            return False
+        latest = events[-1]
+        try:
+            latest_time = datetime.strptime(latest["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
+        except (KeyError, TypeError, ValueError):
+            return False
+        if (datetime.now() - latest_time).total_seconds() > float(dedup_window):
+            return False
+        known_checksums = db_doc.get("file_checksums", {})
+        return content_hash(
+            latest["event_type"], latest.get("data"), known_checksums
+        ) == content_hash(
+            status, additional_info, {**known_checksums, **changed_checksums}
+        )
+
+    @profiled("run.record_progress")
+    def record_progress(self):
+        """Read the progress of the running transfer from its rsync log.
+
+        The summary is written to the transfer_progress field of the run
+        document at most once per `progress.write_interval` seconds. Failures
+        are logged and do not affect the transfer.
+        """
+        progress_config = self.configuration.get("progress", {})
+        if not progress_config.get("enabled"):
+            return
+        collector = ProgressCollector(self.run_dir)
+        try:
+            summary = collector.collect()
+            interval = progress_config.get(
+                "write_interval", DEFAULT_WRITE_INTERVAL_SECONDS
+            )
+            if summary is None or not collector.should_write(interval):
+                return
+            db_doc = self.db.get_db_doc(
+                ddoc="lookup", view="runfolder_id", run_id=self.run_id
+            )
+            if not db_doc:
+                return
+            db_doc["transfer_progress"] = summary
+            self.db.update_db_doc(db_doc)
+            collector.mark_written()
+            logger.info(
+                f"{self.run_id}: {summary['files_sent']} files and "
+                f"{summary['bytes_sent']} bytes sent, "
+                f"{summary['throughput_bytes_per_second']} bytes/s"
+            )
+        except Exception as e:
+            logger.warning(f"Could not record transfer progress for {self.run_id}: {e}")
+
+    @profiled("run.update_statusdb")
     def update_statusdb(self, status, additional_info=None):
         """Update the statusdb document for this run with the given status
         and associated metadata files."""
@@ -181,12 +493,22 @@ class Run:
                 "events": [],
                 "files": {},
             }
-        files_to_include = fs.locate_metadata(
-            self.sequencer_config.get("metadata_for_statusdb", []),
-            self.run_dir,
+        metadata_for_statusdb = self.sequencer_config.get("metadata_for_statusdb", [])
+        files_to_include = fs.locate_metadata(metadata_for_statusdb, self.run_dir)
+        # Only files whose content changed since the last write are parsed and updated
+        parsed_files, checksums = fs.parse_changed_metadata_files(
+            files_to_include,
+            db_doc.get("file_checksums", {}),
+            projections=fs.metadata_projections(metadata_for_statusdb),
         )
-        parsed_files = fs.parse_metadata_files(files_to_include)
+        if self.is_duplicate_write(db_doc, status, additional_info, checksums):
+            logger.info(
+                f"Status {status} for {self.run_dir} is unchanged since the last write, skipping it"
+            )
+            self.db.count_write("skipped")
+            return
         db_doc["files"].update(parsed_files)
+        db_doc.setdefault("file_checksums", {}).update(checksums)
         db_doc["events"].append(
             {
                 "event_type": status,
@@ -195,4 +517,7 @@ class Run:
             }
         )
         logger.info(f"Setting status {status} for {self.run_dir}")
-        self.db.update_db_doc(db_doc)
+        try:
+            self.db.update_db_doc(db_doc, status=status)
+        finally:
+            self.status_snapshot.invalidate(self.run_id)
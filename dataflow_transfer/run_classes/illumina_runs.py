@@ -6,9 +6,10 @@ from .registry import register_run_class
 class IlluminaRun(Run):
     """Defines an Illumina sequencing run"""
 
-    def __init__(self, run_dir, configuration):
-        super().__init__(run_dir, configuration)
-        self.final_file = "CopyComplete.txt"
+    final_file = "CopyComplete.txt"
+
+    def __init__(self, run_dir, configuration, **kwargs):
+        super().__init__(run_dir, configuration, **kwargs)
         self.flowcell_id = self.run_id.split("_")[-1]
 
 
@@ -17,12 +18,12 @@ class NovaSeqXPlusRun(IlluminaRun):
     """Defines a NovaSeq X Plus sequencing run"""
 
     run_type = "NovaSeqXPlus"
+    run_id_format = (
+        r"^\d{8}_[A-Z0-9]+_\d{4}_[A-Z0-9]+$"  # 20251010_LH00202_0284_B22CVHTLT1
+    )
 
-    def __init__(self, run_dir, configuration):
-        self.run_id_format = (
-            r"^\d{8}_[A-Z0-9]+_\d{4}_[A-Z0-9]+$"  # 20251010_LH00202_0284_B22CVHTLT1
-        )
-        super().__init__(run_dir, configuration)
+    def __init__(self, run_dir, configuration, **kwargs):
+        super().__init__(run_dir, configuration, **kwargs)
         self.flowcell_id = self.run_id.split("_")[-1][1:]  # 22CVHTLT1
 
 
@@ -31,12 +32,7 @@ class NextSeqRun(IlluminaRun):
     """Defines a NextSeq sequencing run"""
 
     run_type = "NextSeq"
-
-    def __init__(self, run_dir, configuration):
-        self.run_id_format = (
-            r"^\d{6}_[A-Z0-9]+_\d{3}_[A-Z0-9]+$"  # 251015_VH00203_572_AAHFHCCM5
-        )
-        super().__init__(run_dir, configuration)
+    run_id_format = r"^\d{6}_[A-Z0-9]+_\d{3}_[A-Z0-9]+$"  # 251015_VH00203_572_AAHFHCCM5
 
 
 @register_run_class
@@ -44,12 +40,9 @@ class MiSeqRun(IlluminaRun):
     """Defines a MiSeq sequencing run"""
 
     run_type = "MiSeq"
-
-    def __init__(self, run_dir, configuration):
-        self.run_id_format = (
-            r"^\d{6}_[A-Z0-9]+_\d{4}_[A-Z0-9\-]+$"  # 251015_M01548_0646_000000000-M6D7K
-        )
-        super().__init__(run_dir, configuration)
+    run_id_format = (
+        r"^\d{6}_[A-Z0-9]+_\d{4}_[A-Z0-9\-]+$"  # 251015_M01548_0646_000000000-M6D7K
+    )
 
 
 @register_run_class
@@ -57,8 +50,8 @@ class MiSeqi100Run(IlluminaRun):
     """Defines a MiSeqi100 sequencing run"""
 
     run_type = "MiSeqi100"
+    run_id_format = r"^\d{8}_[A-Z0-9]+_\d{4}_[A-Z0-9]{10}-SC3$"  # 20260128_SH01140_0002_ASC2150561-SC3
 
-    def __init__(self, run_dir, configuration):
-        self.run_id_format = r"^\d{8}_[A-Z0-9]+_\d{4}_[A-Z0-9]{10}-SC3$"  # 20260128_SH01140_0002_ASC2150561-SC3
-        super().__init__(run_dir, configuration)
+    def __init__(self, run_dir, configuration, **kwargs):
+        super().__init__(run_dir, configuration, **kwargs)
         self.flowcell_id = self.run_id.split("_")[-1][1:]  # SC2150561-SC3
@@ -1,4 +1,20 @@
-from types import MappingProxyType
+import importlib
+from collections.abc import Mapping
+
+# Module and class name of the run classes shipped with the package, by run
+# type. A module is only imported the first time one of its run types is
+# looked up, so that e.g. `--help` or a transfer for one sequencer does not
+# import every run class. Keep this in sync with the @register_run_class
+# classes, test_run_classes checks that it is.
+_RUN_CLASS_MODULES = {
+    "NovaSeqXPlus": ("dataflow_transfer.run_classes.illumina_runs", "NovaSeqXPlusRun"),
+    "NextSeq": ("dataflow_transfer.run_classes.illumina_runs", "NextSeqRun"),
+    "MiSeq": ("dataflow_transfer.run_classes.illumina_runs", "MiSeqRun"),
+    "MiSeqi100": ("dataflow_transfer.run_classes.illumina_runs", "MiSeqi100Run"),
+    "PromethION": ("dataflow_transfer.run_classes.ont_runs", "PromethIONRun"),
+    "MinION": ("dataflow_transfer.run_classes.ont_runs", "MinIONRun"),
+    "AVITI": ("dataflow_transfer.run_classes.element_runs", "AVITIRun"),
+}
 
 
 class RunClassRegistry:
@@ -13,11 +29,40 @@ class RunClassRegistry:
 
     @classmethod
     def get(cls, run_type):
+        if run_type not in cls._registry and run_type in _RUN_CLASS_MODULES:
+            # Registers the run class as a side effect
+            importlib.import_module(_RUN_CLASS_MODULES[run_type][0])
         return cls._registry.get(run_type)
 
+    @classmethod
+    def run_types(cls):
+        return list(dict.fromkeys([*_RUN_CLASS_MODULES, *cls._registry]))
+
     @classmethod
     def view(cls):
-        return MappingProxyType(cls._registry)
+        return _RegistryView(cls)
+
+
+class _RegistryView(Mapping):
+    """Read-only mapping of run type to run class, importing run classes on lookup."""
+
+    def __init__(self, registry):
+        self._registry = registry
+
+    def __getitem__(self, run_type):
+        run_cls = self._registry.get(run_type)
+        if run_cls is None:
+            raise KeyError(run_type)
+        return run_cls
+
+    def __iter__(self):
+        return iter(self._registry.run_types())
+
+    def __len__(self):
+        return len(self._registry.run_types())
+
+    def __contains__(self, run_type):
+        return run_type in self._registry.run_types()
 
 
 # Decorator for registering run classes
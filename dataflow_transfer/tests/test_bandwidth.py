@@ -0,0 +1,121 @@
+import pytest
+
+from dataflow_transfer.utils import bandwidth
+from dataflow_transfer.utils.filesystem import RsyncProcessIndex
+
+
+class FinalFileRun:
+    final_file = "CopyComplete.txt"
+
+
+class OtherFinalFileRun:
+    final_file = "RunUploaded.json"
+
+
+@pytest.fixture
+def seq(tmp_path):
+    return tmp_path / "seq"
+
+
+@pytest.fixture
+def conf(seq):
+    return {
+        "bandwidth": {"link_budget": 1200},
+        "sequencers": {
+            "NovaSeqXPlus": {
+                "sequencing_path": str(seq),
+                "remote_destination": "/Illumina/NovaSeqXPlus",
+            },
+        },
+    }
+
+
+@pytest.fixture
+def process_index(tmp_path):
+    return RsyncProcessIndex(proc_root=str(tmp_path / "proc"))
+
+
+def make_manager(conf, process_index):
+    return bandwidth.open_bandwidth_manager(
+        conf,
+        process_index,
+        {"NovaSeqXPlus": FinalFileRun, "AVITI": OtherFinalFileRun},
+    )
+
+
+def make_finished_run(path, final_file="CopyComplete.txt"):
+    path.mkdir(parents=True)
+    (path / final_file).touch()
+    return str(path)
+
+
+def test_open_bandwidth_manager_without_budget(conf, process_index):
+    del conf["bandwidth"]
+    assert make_manager(conf, process_index) is None
+
+
+def test_allocate_weights_final_transfers(conf, process_index, seq):
+    finished_run = make_finished_run(seq / "finished_run")
+    manager = make_manager(conf, process_index)
+    assert manager.allocate(f"{seq}/run1", final=False) == 1200
+
+    process_index.add(src=f"{seq}/run1", dst="user@host:/Illumina/NovaSeqXPlus")
+    assert manager.allocate(f"{seq}/run2", final=False) == 600
+    # Final transfers weigh twice as much as intermediate ones by default
+    assert manager.allocate(finished_run, final=True) == 800
+    process_index.add(src=finished_run, dst="/Illumina/NovaSeqXPlus")
+    assert manager.allocate(f"{seq}/run2", final=False) == 300
+
+
+def test_rebalance_restarts_intermediate_syncs(conf, process_index, seq, monkeypatch):
+    killed = []
+    monkeypatch.setattr(bandwidth.os, "kill", lambda pid, sig: killed.append(pid))
+    finished_run = make_finished_run(seq / "finished_run")
+    dst = "/Illumina/NovaSeqXPlus"
+    process_index.add(src=f"{seq}/run1", dst=dst, pid=10, bwlimit=300)
+    process_index.add(src=f"{seq}/run2", dst=dst, pid=20, bwlimit=1200)
+    process_index.add(src=f"{seq}/run3", dst=dst, pid=30)
+    process_index.add(src=finished_run, dst=dst, pid=40, bwlimit=100)
+
+    manager = make_manager(conf, process_index)
+    # Weights 1 + 1 + 1 + 2, an intermediate sync's share is 240 KiB/s
+    assert sorted(manager.rebalance()) == [f"{seq}/run2", f"{seq}/run3"]
+    assert sorted(killed) == [20, 30]
+    assert not process_index.is_running(f"{seq}/run2", dst)
+    assert process_index.is_running(f"{seq}/run1", dst)
+    assert process_index.is_running(finished_run, dst)
+
+
+def test_rebalance_leaves_other_rsyncs_alone(
+    conf, process_index, seq, tmp_path, monkeypatch
+):
+    killed = []
+    monkeypatch.setattr(bandwidth.os, "kill", lambda pid, sig: killed.append(pid))
+    dst = "/Illumina/NovaSeqXPlus"
+    # An operator's copy to the same destination, without --bwlimit
+    process_index.add(src="/home/user/data", dst=dst, pid=10)
+    process_index.add(src=f"{seq}/sub/dir", dst=dst, pid=11)
+    manager = make_manager(conf, process_index)
+    assert manager.rebalance() == []
+    assert manager.allocate(f"{seq}/run1", final=False) == 1200
+    assert killed == []
+
+
+def test_shared_destination_uses_final_file_of_source_sequencer(
+    conf, process_index, tmp_path, monkeypatch
+):
+    killed = []
+    monkeypatch.setattr(bandwidth.os, "kill", lambda pid, sig: killed.append(pid))
+    aviti_path = tmp_path / "aviti"
+    conf["sequencers"]["AVITI"] = {
+        "sequencing_path": str(aviti_path),
+        "remote_destination": "/Illumina/NovaSeqXPlus",
+    }
+    aviti_run = make_finished_run(aviti_path / "run1", "RunUploaded.json")
+    process_index.add(src=aviti_run, dst="/Illumina/NovaSeqXPlus", pid=10)
+    manager = make_manager(conf, process_index)
+    transfer = manager.active_transfers()[aviti_run]
+    assert transfer["sequencer"] == "AVITI"
+    assert transfer["final"]
+    assert manager.rebalance() == []
+    assert killed == []
@@ -0,0 +1,65 @@
+import json
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from dataflow_transfer.cli import cli
+
+# Modules that should only be imported once a transfer is started
+DEFERRED_MODULES = [
+    "ibmcloudant",
+    "xmltodict",
+    "yaml",
+    "dataflow_transfer.dataflow_transfer",
+    "dataflow_transfer.daemon",
+    "dataflow_transfer.run_classes.generic_runs",
+    "dataflow_transfer.run_classes.illumina_runs",
+    "dataflow_transfer.run_classes.ont_runs",
+    "dataflow_transfer.run_classes.element_runs",
+    "dataflow_transfer.utils.statusdb",
+]
+
+
+_PRINT_IMPORTED = (
+    "\nimport json, sys\n"
+    f"print(json.dumps([m for m in {DEFERRED_MODULES!r} if m in sys.modules]))\n"
+)
+
+
+def run_python(code):
+    """Run code in a new interpreter, and return the deferred modules it imported."""
+    result = subprocess.run(
+        [sys.executable, "-c", code + _PRINT_IMPORTED],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_cli_import_does_not_import_transfer_modules():
+    _, imported = run_python("import dataflow_transfer.cli")
+    assert imported == []
+
+
+def test_cli_help_does_not_import_transfer_modules():
+    stdout, imported = run_python(
+        "from dataflow_transfer.cli import cli\n"
+        "try:\n"
+        "    cli(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+    )
+    assert "--config-file" in stdout
+    assert imported == []
+
+
+def test_cli_usage_error(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text("sequencers: {}\n")
+    result = CliRunner().invoke(
+        cli, ["-c", str(config_file), "--run", "20250528_LH00217_0219_A22TT52LT4"]
+    )
+    assert result.exit_code == 2
+    assert "--run/-r requires --sequencer/-s" in result.output
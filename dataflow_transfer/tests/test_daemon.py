@@ -0,0 +1,103 @@
+from dataflow_transfer import daemon
+from dataflow_transfer.dataflow_transfer import RunResult
+
+
+def test_daemon_runs_cycles_and_reloads_config(monkeypatch):
+    configs = iter([{"name": "first"}, {"name": "second"}])
+    cycles = []
+
+    def mock_transfer_runs(config):
+        cycles.append(config["name"])
+        if len(cycles) == 1:
+            transfer_daemon.request_reload()
+        elif len(cycles) == 2:
+            raise RuntimeError("cycle failed")
+        else:
+            transfer_daemon.stop()
+
+    monkeypatch.setattr(daemon, "transfer_runs", mock_transfer_runs)
+    transfer_daemon = daemon.TransferDaemon(lambda: next(configs), interval=0)
+    transfer_daemon.run()
+
+    assert cycles == ["first", "second", "second"]
+
+
+def test_daemon_keeps_config_when_reload_fails():
+    def config_loader():
+        if config_loader.loaded:
+            raise ValueError("invalid yaml")
+        config_loader.loaded = True
+        return {"daemon": {"interval": 5}}
+
+    config_loader.loaded = False
+    transfer_daemon = daemon.TransferDaemon(config_loader)
+    transfer_daemon.reload_config()
+    assert transfer_daemon.config == {"daemon": {"interval": 5}}
+    assert transfer_daemon.interval == 5
+
+
+def test_daemon_processes_runs_when_final_file_appears(tmp_path, monkeypatch):
+    sequencing_path = tmp_path / "NovaSeqXPlus"
+    run_dir = sequencing_path / "20251010_LH00202_0284_B22CVHTLT1"
+    run_dir.mkdir(parents=True)
+    config = {
+        "watch": {"enabled": True, "mode": "poll", "poll_interval": 0.05},
+        "sequencers": {"NovaSeqXPlus": {"sequencing_path": str(sequencing_path)}},
+    }
+    processed = []
+
+    class MockDB:
+        def flush(self):
+            pass
+
+    monkeypatch.setattr(daemon, "get_statusdb_session", lambda config: MockDB())
+    monkeypatch.setattr(
+        daemon,
+        "process_run_safely",
+        lambda run_dir, sequencer, config, **kwargs: processed.append(run_dir),
+    )
+    transfer_daemon = daemon.TransferDaemon(lambda: config)
+    transfer_daemon.setup_watcher()
+    transfer_daemon.update_watches([RunResult(str(run_dir), "NovaSeqXPlus", 0.1)])
+
+    (run_dir / "CopyComplete.txt").write_text("")
+    transfer_daemon.wait_for_next_cycle(0.5)
+    assert processed == [str(run_dir)]
+    transfer_daemon.watcher.close()
+
+
+def test_update_watches_uses_cycle_results(tmp_path, monkeypatch):
+    sequencing_path = tmp_path / "NovaSeqXPlus"
+    active_run = sequencing_path / "20251010_LH00202_0284_B22CVHTLT1"
+    finished_run = sequencing_path / "20251010_LH00202_0285_B22CVHTLT2"
+    for run_dir in (active_run, finished_run):
+        run_dir.mkdir(parents=True)
+    config = {
+        "watch": {"enabled": True, "mode": "poll"},
+        "sequencers": {"NovaSeqXPlus": {"sequencing_path": str(sequencing_path)}},
+    }
+
+    def fail_find_runs(*args, **kwargs):
+        raise AssertionError("the sequencing directory should not be scanned")
+
+    monkeypatch.setattr(daemon.fs, "find_runs", fail_find_runs)
+    transfer_daemon = daemon.TransferDaemon(lambda: config)
+    transfer_daemon.setup_watcher()
+    transfer_daemon.update_watches(
+        [
+            RunResult(str(active_run), "NovaSeqXPlus", 0.1),
+            RunResult(str(finished_run), "NovaSeqXPlus", 0.1),
+        ]
+    )
+    assert sorted(transfer_daemon.watcher.watched_runs()) == [
+        str(active_run),
+        str(finished_run),
+    ]
+
+    # The finished run is skipped by the next cycle, through the state index
+    transfer_daemon.update_watches([RunResult(str(active_run), "NovaSeqXPlus", 0.1)])
+    assert transfer_daemon.watcher.watched_runs() == [str(active_run)]
+    # A failed cycle leaves the watches as they are
+    transfer_daemon.update_watches(None)
+    assert transfer_daemon.watcher.watched_runs() == [str(active_run)]
+    transfer_daemon.watcher.close()
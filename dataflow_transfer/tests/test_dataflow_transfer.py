@@ -0,0 +1,237 @@
+import threading
+import time
+
+import pytest
+
+from dataflow_transfer import dataflow_transfer
+from dataflow_transfer.utils.discovery_index import DiscoveryIndex
+from dataflow_transfer.utils.state_index import RunStateIndex
+from dataflow_transfer.utils.statusdb import StatusSnapshot
+
+
+def run_id(sequencer, i):
+    if sequencer == "NovaSeqXPlus":
+        return f"20251010_LH00202_028{i}_B22CVHTLT{i}"
+    return f"20251015_1051_3B_PBG6068{i}_0af3a2e{i}"
+
+
+@pytest.fixture
+def config(tmp_path):
+    sequencers = {}
+    for sequencer in ["NovaSeqXPlus", "PromethION"]:
+        sequencing_path = tmp_path / sequencer
+        sequencing_path.mkdir()
+        for i in range(4):
+            (sequencing_path / run_id(sequencer, i)).mkdir()
+        sequencers[sequencer] = {"sequencing_path": str(sequencing_path)}
+    return {"sequencers": sequencers}
+
+
+def test_get_worker_limits(config):
+    assert dataflow_transfer.get_worker_limits(config) == (
+        1,
+        {"NovaSeqXPlus": 1, "PromethION": 1},
+    )
+    config["concurrency"] = {"workers": 4}
+    config["sequencers"]["PromethION"]["max_workers"] = 2
+    assert dataflow_transfer.get_worker_limits(config) == (
+        4,
+        {"NovaSeqXPlus": 4, "PromethION": 2},
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_transfer_runs_isolates_errors(config, workers, monkeypatch):
+    config["concurrency"] = {"workers": workers}
+    processed = []
+
+    def mock_process_run(run_dir, sequencer, conf, **run_kwargs):
+        processed.append(run_dir)
+        if run_dir.endswith(run_id(sequencer, 1)):
+            raise RuntimeError("boom")
+
+    summaries = []
+    monkeypatch.setattr(dataflow_transfer, "process_run", mock_process_run)
+
+    class MockDB:
+        def flush(self):
+            return {}
+
+        def write_counts(self):
+            return {"written": 0, "skipped": 0}
+
+    monkeypatch.setattr(
+        dataflow_transfer, "get_statusdb_session", lambda config: MockDB()
+    )
+    monkeypatch.setattr(
+        dataflow_transfer, "load_status_snapshot", lambda snapshot, run_dirs: None
+    )
+    monkeypatch.setattr(
+        dataflow_transfer,
+        "log_cycle_summary",
+        lambda results, elapsed: summaries.append(results),
+    )
+    dataflow_transfer.transfer_runs(config)
+
+    assert len(processed) == 8
+    results = summaries[0]
+    assert len(results) == 8
+    failed = [result for result in results if result.error]
+    assert len(failed) == 2
+    assert all(
+        result.run_dir.endswith(run_id(result.sequencer, 1)) for result in failed
+    )
+
+
+def test_process_runs_concurrently_respects_sequencer_limit(config, monkeypatch):
+    lock = threading.Lock()
+    active = {"NovaSeqXPlus": 0, "PromethION": 0}
+    peak = {"NovaSeqXPlus": 0, "PromethION": 0}
+
+    def mock_process_run(run_dir, sequencer, conf, **run_kwargs):
+        with lock:
+            active[sequencer] += 1
+            peak[sequencer] = max(peak[sequencer], active[sequencer])
+        time.sleep(0.01)
+        with lock:
+            active[sequencer] -= 1
+
+    monkeypatch.setattr(dataflow_transfer, "process_run", mock_process_run)
+    runs_per_sequencer = {
+        "NovaSeqXPlus": [f"nova{i}" for i in range(6)],
+        "PromethION": [f"prom{i}" for i in range(6)],
+    }
+    results = dataflow_transfer.process_runs_concurrently(
+        runs_per_sequencer, config, 4, {"NovaSeqXPlus": 4, "PromethION": 1}
+    )
+    assert len(results) == 12
+    assert peak["PromethION"] == 1
+
+
+def test_load_status_snapshot():
+    queried = []
+
+    class MockDB:
+        def get_events_for_runs(self, run_ids):
+            queried.append(run_ids)
+            return {run_id: {} for run_id in run_ids}
+
+    snapshot = StatusSnapshot(MockDB())
+    dataflow_transfer.load_status_snapshot(snapshot, ["/data/run1", "/data/run2"])
+    assert queried == [["run1", "run2"]]
+    assert snapshot.get("run1") == {}
+    assert snapshot.get("run3") is None
+
+
+def test_load_status_snapshot_failure_leaves_runs_out():
+    class MockDB:
+        def get_events_for_runs(self, run_ids):
+            raise ConnectionError("down")
+
+    snapshot = StatusSnapshot(MockDB())
+    dataflow_transfer.load_status_snapshot(snapshot, ["/data/run1"])
+    assert snapshot.get("run1") is None
+
+
+def test_with_status_snapshot_loads_in_batches():
+    events = []
+
+    class MockDB:
+        def get_events_for_runs(self, run_ids):
+            events.append(("load", list(run_ids)))
+            return {run_id: {} for run_id in run_ids}
+
+    def run_dirs():
+        for i in range(5):
+            events.append(("found", f"run{i}"))
+            yield f"/data/run{i}"
+
+    snapshot = StatusSnapshot(MockDB())
+    for run_dir in dataflow_transfer.with_status_snapshot(
+        run_dirs(), snapshot, batch_size=2
+    ):
+        events.append(("process", run_dir))
+    assert events == [
+        ("found", "run0"),
+        ("found", "run1"),
+        ("load", ["run0", "run1"]),
+        ("process", "/data/run0"),
+        ("process", "/data/run1"),
+        ("found", "run2"),
+        ("found", "run3"),
+        ("load", ["run2", "run3"]),
+        ("process", "/data/run2"),
+        ("process", "/data/run3"),
+        ("found", "run4"),
+        ("load", ["run4"]),
+        ("process", "/data/run4"),
+    ]
+
+
+def test_transfer_all_runs_passes_over_non_run_folders(config, tmp_path, monkeypatch):
+    created = []
+    monkeypatch.setattr(
+        dataflow_transfer,
+        "get_run_object",
+        lambda run_dir, *args, **kwargs: created.append(run_dir),
+    )
+    monkeypatch.setattr(
+        dataflow_transfer, "load_status_snapshot", lambda snapshot, run_dirs: None
+    )
+    (tmp_path / "NovaSeqXPlus" / "nosync").mkdir()
+    (tmp_path / "PromethION" / "not_a_run").mkdir()
+
+    results, _ = dataflow_transfer.transfer_all_runs(config, None)
+    assert len(results) == 8
+    assert not any(run_dir.endswith(("nosync", "not_a_run")) for run_dir in created)
+
+
+def test_transfer_all_runs_skips_finished_runs(config, tmp_path, monkeypatch):
+    processed = []
+    monkeypatch.setattr(
+        dataflow_transfer,
+        "process_run",
+        lambda run_dir, sequencer, conf, **kwargs: processed.append(run_dir),
+    )
+    monkeypatch.setattr(
+        dataflow_transfer, "load_status_snapshot", lambda snapshot, run_dirs: None
+    )
+    state_index = RunStateIndex(str(tmp_path / "state.sqlite"))
+    finished_run = str(tmp_path / "NovaSeqXPlus" / run_id("NovaSeqXPlus", 0))
+    state_index.mark_finished(finished_run, "NovaSeqXPlus")
+
+    results, skipped_runs = dataflow_transfer.transfer_all_runs(
+        config, None, state_index
+    )
+    assert len(results) == 7
+    assert skipped_runs == {"NovaSeqXPlus": 1, "PromethION": 0}
+    assert finished_run not in processed
+
+
+def test_transfer_all_runs_with_discovery_index_and_run_depth(
+    config, tmp_path, monkeypatch
+):
+    processed = []
+    monkeypatch.setattr(
+        dataflow_transfer,
+        "process_run",
+        lambda run_dir, sequencer, conf, **kwargs: processed.append(run_dir),
+    )
+    monkeypatch.setattr(
+        dataflow_transfer, "load_status_snapshot", lambda snapshot, run_dirs: None
+    )
+    ont_path = tmp_path / "ont"
+    ont_run = ont_path / "experiment" / "sample" / run_id("PromethION", 5)
+    ont_run.mkdir(parents=True)
+    config["sequencers"]["PromethION"] = {
+        "sequencing_path": str(ont_path),
+        "run_depth": 3,
+    }
+    discovery_index = DiscoveryIndex(str(tmp_path / "discovery.sqlite"))
+
+    results, _ = dataflow_transfer.transfer_all_runs(
+        config, None, discovery_index=discovery_index
+    )
+    assert len(results) == 5
+    assert str(ont_run) in processed
+    discovery_index.close()
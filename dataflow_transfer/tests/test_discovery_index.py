@@ -0,0 +1,117 @@
+import os
+
+from dataflow_transfer.utils.discovery_index import (
+    DiscoveryIndex,
+    open_discovery_index,
+)
+
+
+def make_ont_tree(base):
+    for experiment, sample, run in [
+        ("exp1", "sample1", "run_a"),
+        ("exp1", "sample2", "run_b"),
+        ("exp2", "sample1", "run_c"),
+    ]:
+        os.makedirs(os.path.join(base, experiment, sample, run))
+    open(os.path.join(base, "exp1", "notes.txt"), "w").close()
+
+
+def age(path, seconds=60):
+    """Set the mtime of path back, so that its listing is trusted."""
+    mtime = os.stat(path).st_mtime - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_find_runs_at_depth(tmp_path):
+    make_ont_tree(tmp_path)
+    index = DiscoveryIndex(str(tmp_path / "discovery.sqlite"))
+    runs = sorted(index.find_runs(str(tmp_path), ignore_folders=["sample2"], depth=3))
+    assert runs == [
+        str(tmp_path / "exp1" / "sample1" / "run_a"),
+        str(tmp_path / "exp2" / "sample1" / "run_c"),
+    ]
+    index.close()
+
+
+def test_unchanged_directories_are_not_listed_again(tmp_path, monkeypatch):
+    make_ont_tree(tmp_path / "seq")
+    for directory, _, _ in os.walk(tmp_path / "seq"):
+        age(directory)
+    path = str(tmp_path / "discovery.sqlite")
+    index = DiscoveryIndex(path)
+    assert len(list(index.find_runs(str(tmp_path / "seq"), depth=3))) == 3
+    index.close()
+
+    listed = []
+    original_scandir = os.scandir
+
+    def counting_scandir(path):
+        listed.append(os.fspath(path))
+        return original_scandir(path)
+
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+    index = DiscoveryIndex(path)
+    assert len(list(index.find_runs(str(tmp_path / "seq"), depth=3))) == 3
+    assert listed == []
+
+    # A new run only makes its sample directory be listed again
+    os.mkdir(tmp_path / "seq" / "exp2" / "sample1" / "run_d")
+    age(tmp_path / "seq" / "exp2" / "sample1")
+    assert len(list(index.find_runs(str(tmp_path / "seq"), depth=3))) == 4
+    assert listed == [str(tmp_path / "seq" / "exp2" / "sample1")]
+    index.close()
+
+
+def test_recently_changed_directories_are_listed_again(tmp_path):
+    make_ont_tree(tmp_path / "seq")
+    index = DiscoveryIndex(str(tmp_path / "discovery.sqlite"))
+    assert len(list(index.find_runs(str(tmp_path / "seq"), depth=3))) == 3
+    # Added in the same mtime tick as the listing above
+    sample_dir = tmp_path / "seq" / "exp1" / "sample1"
+    mtime_ns = os.stat(sample_dir).st_mtime_ns
+    os.mkdir(sample_dir / "run_e")
+    os.utime(sample_dir, ns=(mtime_ns, mtime_ns))
+    assert len(list(index.find_runs(str(tmp_path / "seq"), depth=3))) == 4
+    index.close()
+
+
+def test_run_id_format_and_unreadable_subdirectories(tmp_path, caplog):
+    make_ont_tree(tmp_path / "seq")
+    index = DiscoveryIndex(str(tmp_path / "discovery.sqlite"))
+    original_subdirs = index.subdirs
+
+    def subdirs(path):
+        if path.endswith("exp2"):
+            raise PermissionError("denied")
+        return original_subdirs(path)
+
+    index.subdirs = subdirs
+    runs = list(index.find_runs(str(tmp_path / "seq"), run_id_format="run_a", depth=3))
+    assert runs == [str(tmp_path / "seq" / "exp1" / "sample1" / "run_a")]
+    assert "Could not list" in caplog.text
+    index.close()
+
+
+def test_prune_drops_directories_not_visited(tmp_path):
+    make_ont_tree(tmp_path / "seq")
+    path = str(tmp_path / "discovery.sqlite")
+    index = open_discovery_index({"discovery_index": {"path": path}})
+    list(index.find_runs(str(tmp_path / "seq"), depth=3))
+    index.close()
+
+    index = DiscoveryIndex(path)
+    list(index.find_runs(str(tmp_path / "seq" / "exp1"), depth=2))
+    index.prune()
+    recorded = {
+        row[0] for row in index._connection.execute("SELECT path FROM listings")
+    }
+    assert recorded == {
+        str(tmp_path / "seq" / "exp1"),
+        str(tmp_path / "seq" / "exp1" / "sample1"),
+        str(tmp_path / "seq" / "exp1" / "sample2"),
+    }
+    index.close()
+
+
+def test_open_discovery_index_not_configured():
+    assert open_discovery_index({}) is None
@@ -5,13 +5,23 @@ from subprocess import CalledProcessError
 from unittest.mock import patch
 
 import pytest
+import xmltodict
 
+from dataflow_transfer.run_classes.illumina_runs import NovaSeqXPlusRun
+from dataflow_transfer.utils import filesystem
 from dataflow_transfer.utils.filesystem import (
+    MetadataCache,
+    RsyncProcessIndex,
     check_exit_status,
     find_runs,
     get_run_dir,
     locate_metadata,
+    metadata_projections,
+    parse_bwlimit,
+    parse_changed_metadata_files,
+    parse_metadata_file,
     parse_metadata_files,
+    project_dict,
     rsync_is_running,
     submit_background_process,
 )
@@ -42,7 +52,7 @@ class TestFindRuns:
         with tempfile.TemporaryDirectory() as tmpdir:
             os.mkdir(os.path.join(tmpdir, "run1"))
             os.mkdir(os.path.join(tmpdir, "run2"))
-            runs = find_runs(tmpdir)
+            runs = list(find_runs(tmpdir))
             assert os.path.join(tmpdir, "run1") in runs
             assert os.path.join(tmpdir, "run2") in runs
 
@@ -51,7 +61,7 @@ class TestFindRuns:
             os.mkdir(os.path.join(tmpdir, "run1"))
             os.mkdir(os.path.join(tmpdir, "run2"))
             os.mkdir(os.path.join(tmpdir, "ignore_me"))
-            runs = find_runs(tmpdir, ignore_folders=["ignore_me"])
+            runs = list(find_runs(tmpdir, ignore_folders=["ignore_me"]))
             assert os.path.join(tmpdir, "run1") in runs
             assert os.path.join(tmpdir, "run2") in runs
             assert os.path.join(tmpdir, "ignore_me") not in runs
@@ -60,21 +70,147 @@ class TestFindRuns:
         with tempfile.TemporaryDirectory() as tmpdir:
             os.mkdir(os.path.join(tmpdir, "run1"))
             open(os.path.join(tmpdir, "file.txt"), "w").close()
-            runs = find_runs(tmpdir)
+            runs = list(find_runs(tmpdir))
             assert os.path.join(tmpdir, "run1") in runs
             assert os.path.join(tmpdir, "file.txt") not in runs
 
+    def test_find_runs_with_run_id_format(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(os.path.join(tmpdir, "20251010_LH00202_0284_B22CVHTLT1"))
+            os.mkdir(os.path.join(tmpdir, "nosync"))
+            open(os.path.join(tmpdir, "20251010_LH00202_0285_B22CVHTLT2"), "w").close()
+            runs = list(find_runs(tmpdir, run_id_format=NovaSeqXPlusRun.run_id_format))
+            assert runs == [os.path.join(tmpdir, "20251010_LH00202_0284_B22CVHTLT1")]
+
+    def test_find_runs_is_lazy(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(os.path.join(tmpdir, "run1"))
+            os.mkdir(os.path.join(tmpdir, "run2"))
+            runs = find_runs(tmpdir)
+            assert next(runs) in {
+                os.path.join(tmpdir, "run1"),
+                os.path.join(tmpdir, "run2"),
+            }
+
+    def test_find_runs_at_depth(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "exp1", "sample1", "run1"))
+            os.makedirs(os.path.join(tmpdir, "exp1", "nosync", "run2"))
+            os.makedirs(os.path.join(tmpdir, "exp2", "sample1", "run3"))
+            open(os.path.join(tmpdir, "exp2", "report.txt"), "w").close()
+            runs = sorted(find_runs(tmpdir, ignore_folders=["nosync"], depth=3))
+            assert runs == [
+                os.path.join(tmpdir, "exp1", "sample1", "run1"),
+                os.path.join(tmpdir, "exp2", "sample1", "run3"),
+            ]
+
+    def test_find_runs_run_id_format_applies_to_run_level(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "exp1", "run1"))
+            os.makedirs(os.path.join(tmpdir, "exp1", "other"))
+            runs = list(find_runs(tmpdir, run_id_format="run", depth=2))
+            assert runs == [os.path.join(tmpdir, "exp1", "run1")]
+
+
+def make_fake_proc(proc_root, processes):
+    """Create a fake /proc with the given {pid: argv} processes."""
+    with open(os.path.join(proc_root, "stat"), "w") as f:
+        f.write("cpu  1 2 3 4\nbtime 1700000000\n")
+    for pid, argv in processes.items():
+        pid_dir = os.path.join(proc_root, str(pid))
+        os.mkdir(pid_dir)
+        with open(os.path.join(pid_dir, "cmdline"), "wb") as f:
+            f.write(b"\0".join(arg.encode() for arg in argv) + b"\0")
+        with open(os.path.join(pid_dir, "stat"), "w") as f:
+            fields = ["S"] + ["0"] * 18 + [str(100 * os.sysconf("SC_CLK_TCK"))]
+            f.write(f"{pid} (rsync) " + " ".join(fields) + "\n")
+
 
 class TestRsyncIsRunning:
+    processes = {
+        100: [
+            "run-one",
+            "rsync",
+            "-au",
+            "--log-file=/seq/run.1/rsync_remote_log.txt",
+            "--chmod=Dg+s,g+rw",
+            "/seq/run.1",
+            "user@host:/remote/NovaSeqXPlus",
+        ],
+        101: ["rsync", "-au", "--exclude", "*", "/seq/run.1/", "/archive/run.1/"],
+        102: ["rsync", "--server", "-logDtpre.iLsfxCIvu", ".", "/remote/NovaSeqXPlus"],
+        103: ["/bin/bash", "-c", "sleep 100"],
+    }
+
+    def test_rsync_running(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            make_fake_proc(tmpdir, self.processes)
+            assert rsync_is_running("/seq/run.1", "/remote/NovaSeqXPlus", tmpdir)
+            assert rsync_is_running("/seq/run.1", "/archive/run.1", tmpdir)
+
+    def test_rsync_not_running(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            make_fake_proc(tmpdir, self.processes)
+            assert not rsync_is_running("/seq/run.2", "/remote/NovaSeqXPlus", tmpdir)
+            # Paths are compared literally, not as patterns
+            assert not rsync_is_running("/seq/run_1", "/remote/NovaSeqXPlus", tmpdir)
+            assert not rsync_is_running("/seq/run.1", "/remote/MiSeq", tmpdir)
+
+    def test_process_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            make_fake_proc(tmpdir, self.processes)
+            index = RsyncProcessIndex(tmpdir)
+            (process,) = index.find("/seq/run.1/", "/remote/NovaSeqXPlus")
+            assert process.pid == 100
+            assert process.start_time == 1700000100
+            assert not index.is_running("/seq/run.2", "/remote/NovaSeqXPlus")
+            index.add("/seq/run.2", "user@host:/remote/NovaSeqXPlus", pid=200)
+            assert index.is_running("/seq/run.2", "/remote/NovaSeqXPlus")
+
+    def test_process_index_reads_bwlimit(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            processes = {
+                100: self.processes[100][:2]
+                + ["--bwlimit=2m"]
+                + self.processes[100][2:]
+            }
+            make_fake_proc(tmpdir, processes)
+            index = RsyncProcessIndex(tmpdir)
+            (process,) = index.find("/seq/run.1", "/remote/NovaSeqXPlus")
+            assert process.bwlimit == 2048
+            index.remove("/seq/run.1", "/remote/NovaSeqXPlus")
+            assert not index.is_running("/seq/run.1", "/remote/NovaSeqXPlus")
+
+    @pytest.mark.parametrize(
+        "argv, expected",
+        [
+            (["rsync", "-au", "src", "dst"], None),
+            (["rsync", "--bwlimit=1000", "src", "dst"], 1000),
+            (["rsync", "--bwlimit", "1.5M", "src", "dst"], 1536),
+            (["rsync", "--bwlimit=100", "--bwlimit=0", "src", "dst"], None),
+        ],
+    )
+    def test_parse_bwlimit(self, argv, expected):
+        assert parse_bwlimit(argv) == expected
+
     @patch("subprocess.check_output")
-    def test_rsync_running(self, mock_check_output):
+    def test_rsync_running_without_proc(self, mock_check_output):
         mock_check_output.return_value = b"12345"
-        assert rsync_is_running("/some/path", "/dst/path") is True
+        assert rsync_is_running("/some/path", "/dst/path", "/nonexistent") is True
+        mock_check_output.side_effect = CalledProcessError(1, "pgrep")
+        assert rsync_is_running("/some/path", "/dst/path", "/nonexistent") is False
 
     @patch("subprocess.check_output")
-    def test_rsync_not_running(self, mock_check_output):
+    def test_index_without_proc_falls_back_to_pgrep(self, mock_check_output):
+        index = RsyncProcessIndex("/nonexistent")
+        assert not index.scanned
+        mock_check_output.return_value = b"12345"
+        assert index.is_running("/some/path", "/dst/path") is True
         mock_check_output.side_effect = CalledProcessError(1, "pgrep")
-        assert rsync_is_running("/some/path", "/dst/path") is False
+        assert index.is_running("/some/path", "/dst/path") is False
+        # Rsyncs started in this cycle are still known without pgrep
+        index.add("/some/path", "/dst/path")
+        assert index.is_running("/some/path", "/dst/path") is True
 
 
 class TestSubmitBackgroundProcess:
@@ -116,6 +252,153 @@ class TestParseMetadataFiles:
         assert metadata == {}
 
 
+class TestMetadataCache:
+    def test_parse_only_when_content_changes(self, monkeypatch):
+        parsed = []
+        parse_metadata_file = filesystem.parse_metadata_file
+
+        def counting_parse(file_path, projection=None):
+            parsed.append(file_path)
+            return parse_metadata_file(file_path, projection)
+
+        monkeypatch.setattr(filesystem, "parse_metadata_file", counting_parse)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            xml_file = os.path.join(tmpdir, "RunInfo.xml")
+            with open(xml_file, "w") as f:
+                f.write("<root><key>value</key></root>")
+            cache = MetadataCache()
+            assert cache.parse(xml_file) == {"root": {"key": "value"}}
+            assert cache.parse(xml_file) == {"root": {"key": "value"}}
+            # Touched but same content, not parsed again
+            os.utime(xml_file, ns=(0, 0))
+            assert cache.parse(xml_file) == {"root": {"key": "value"}}
+            assert len(parsed) == 1
+            with open(xml_file, "w") as f:
+                f.write("<root><key>other</key></root>")
+            os.utime(xml_file, ns=(1, 1))
+            assert cache.parse(xml_file) == {"root": {"key": "other"}}
+            assert len(parsed) == 2
+
+    def test_cache_is_bounded_and_forgets_finished_runs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = []
+            for run in ["run1", "run2"]:
+                os.mkdir(os.path.join(tmpdir, run))
+                for name in ["a.json", "b.json"]:
+                    files.append(os.path.join(tmpdir, run, name))
+                    with open(files[-1], "w") as f:
+                        json.dump({"name": name}, f)
+            cache = MetadataCache(max_entries=3)
+            for file_path in files:
+                cache.checksum(file_path)
+            # The least recently used file is dropped
+            assert list(cache._entries) == files[1:]
+            cache.forget(os.path.join(tmpdir, "run2"))
+            assert list(cache._entries) == files[1:2]
+
+    def test_parse_changed_metadata_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_file = os.path.join(tmpdir, "metadata.json")
+            with open(json_file, "w") as f:
+                json.dump({"key": "value"}, f)
+            cache = MetadataCache()
+            metadata, checksums = parse_changed_metadata_files([json_file], {}, cache)
+            assert metadata == {"metadata.json": {"key": "value"}}
+            assert set(checksums) == {"metadata.json"}
+            assert parse_changed_metadata_files([json_file], checksums, cache) == (
+                {},
+                {},
+            )
+
+
+class TestMetadataProjection:
+    xml = (
+        '<?xml version="1.0"?>'
+        '<RunParameters xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+        "<Side>A</Side>"
+        "<FlowCellSerialNumber>22CVHTLT1</FlowCellSerialNumber>"
+        '<Reads><Read Number="1" Cycles="151"/><Read Number="2" Cycles="151"/></Reads>'
+        '<ConsumableInfo xsi:type="Flowcell"><Mode>10B</Mode> <Lot>1</Lot></ConsumableInfo>'
+        "<Large>" + "<Tile>1_1101</Tile>" * 100 + "</Large>"
+        "</RunParameters>"
+    )
+
+    def test_projection_matches_full_parse(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            xml_file = os.path.join(tmpdir, "RunParameters.xml")
+            with open(xml_file, "w") as f:
+                f.write(self.xml)
+            full = parse_metadata_file(xml_file)["RunParameters"]
+            projected = parse_metadata_file(
+                xml_file,
+                [
+                    "RunParameters/Side",
+                    "RunParameters/Reads/Read",
+                    "RunParameters/ConsumableInfo",
+                    "RunParameters/Missing",
+                ],
+            )
+            assert projected == {
+                "RunParameters": {
+                    "Side": full["Side"],
+                    "Reads": {"Read": full["Reads"]["Read"]},
+                    "ConsumableInfo": full["ConsumableInfo"],
+                }
+            }
+            assert projected["RunParameters"]["ConsumableInfo"]["xsi:type"] == (
+                "Flowcell"
+            )
+
+    def test_empty_elements_match_dict_projection(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            xml_file = os.path.join(tmpdir, "RunParameters.xml")
+            with open(xml_file, "w") as f:
+                f.write(
+                    "<RunParameters><Side>A</Side><Empty/><Empty></Empty>"
+                    "<Reads><Read/><Read Number='1'/></Reads></RunParameters>"
+                )
+            projection = [
+                "RunParameters/Side",
+                "RunParameters/Empty",
+                "RunParameters/Reads/Read",
+            ]
+            with open(xml_file, "rb") as f:
+                full = xmltodict.parse(f, attr_prefix="", cdata_key="text")
+            streamed = parse_metadata_file(xml_file, projection)
+            assert streamed == project_dict(full, projection)
+            assert streamed == {
+                "RunParameters": {"Side": "A", "Reads": {"Read": {"Number": "1"}}}
+            }
+
+    def test_json_projection(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_file = os.path.join(tmpdir, "RunParameters.json")
+            with open(json_file, "w") as f:
+                json.dump(
+                    {"RunName": "run", "Cycles": {"R1": 151}, "Big": [1] * 100}, f
+                )
+            assert parse_metadata_file(json_file, ["Cycles/R1", "RunName"]) == {
+                "Cycles": {"R1": 151},
+                "RunName": "run",
+            }
+
+    def test_locate_metadata_and_projections_from_config(self):
+        metadata_list = [
+            "RunInfo.xml",
+            {"RunParameters.xml": ["RunParameters/Side"]},
+        ]
+        assert metadata_projections(metadata_list) == {
+            "RunParameters.xml": ["RunParameters/Side"]
+        }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ["RunInfo.xml", "RunParameters.xml"]:
+                open(os.path.join(tmpdir, name), "w").close()
+            assert locate_metadata(metadata_list, tmpdir) == [
+                os.path.join(tmpdir, "RunInfo.xml"),
+                os.path.join(tmpdir, "RunParameters.xml"),
+            ]
+
+
 class TestCheckExitStatus:
     def test_exit_status_zero(self):
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from dataflow_transfer.utils.manifest import RunManifest
+
+
+@pytest.fixture
+def run_dir(tmp_path):
+    run_dir = tmp_path / "run1"
+    (run_dir / "pod5").mkdir(parents=True)
+    (run_dir / "pod5" / "batch_0.pod5").write_bytes(b"x" * 10)
+    (run_dir / "report.json").write_text("{}")
+    (run_dir / "rsync_remote_log.txt").write_text("log")
+    return run_dir
+
+
+def listed_files(manifest):
+    with open(manifest.file_list, "rb") as f:
+        return sorted(path.decode() for path in f.read().split(b"\0") if path)
+
+
+def finish_sync(manifest, exit_code):
+    with open(manifest.exit_code_file, "w") as f:
+        f.write(f"{exit_code}\n")
+
+
+def test_only_new_and_changed_files_are_listed(run_dir):
+    manifest = RunManifest(str(run_dir))
+    assert manifest.prepare() == 2
+    assert listed_files(manifest) == ["pod5/batch_0.pod5", "report.json"]
+    finish_sync(manifest, 0)
+
+    (run_dir / "pod5" / "batch_1.pod5").write_bytes(b"y")
+    (run_dir / "report.json").write_text('{"changed": true}')
+    assert manifest.prepare() == 2
+    assert listed_files(manifest) == ["pod5/batch_1.pod5", "report.json"]
+    finish_sync(manifest, 0)
+
+    assert manifest.prepare() == 0
+    assert set(manifest.load()) == {
+        "pod5/batch_0.pod5",
+        "pod5/batch_1.pod5",
+        "report.json",
+    }
+    assert not os.path.exists(manifest.exit_code_file)
+
+
+@pytest.mark.parametrize("exit_code", [12, None])
+def test_files_of_failed_sync_are_listed_again(run_dir, exit_code):
+    manifest = RunManifest(str(run_dir))
+    manifest.prepare()
+    if exit_code is not None:
+        finish_sync(manifest, exit_code)
+    assert manifest.prepare() == 2
+    assert manifest.load() == {}
+
+
+def test_internal_files_are_not_listed(run_dir):
+    (run_dir / ".rsync_progress.json").write_text("{}")
+    (run_dir / ".rsync_progress.json.tmp").write_text("{")
+    manifest = RunManifest(str(run_dir), exclude=(".rsync_progress.json*",))
+    assert manifest.prepare() == 2
+    assert listed_files(manifest) == ["pod5/batch_0.pod5", "report.json"]
@@ -0,0 +1,73 @@
+import os
+
+from dataflow_transfer.dataflow_transfer import RunResult, record_cycle_metrics
+from dataflow_transfer.utils.metrics import METRICS, Metrics
+
+
+def test_render_counter_and_gauge():
+    metrics = Metrics()
+    metrics.inc(
+        "dataflow_transfer_statusdb_requests_total",
+        {"operation": "get_db_doc", "outcome": "ok"},
+    )
+    metrics.inc(
+        "dataflow_transfer_statusdb_requests_total",
+        {"outcome": "ok", "operation": "get_db_doc"},
+    )
+    metrics.set("dataflow_transfer_cycle_duration_seconds", 1.5)
+    text = metrics.render()
+    assert "# TYPE dataflow_transfer_statusdb_requests_total counter" in text
+    assert (
+        'dataflow_transfer_statusdb_requests_total{operation="get_db_doc",outcome="ok"} 2'
+        in text
+    )
+    assert "dataflow_transfer_cycle_duration_seconds 1.5" in text
+    # Metrics without samples are left out
+    assert "dataflow_transfer_rsync_started_total" not in text
+
+
+def test_render_histogram():
+    metrics = Metrics()
+    name = "dataflow_transfer_statusdb_request_duration_seconds"
+    metrics.observe(name, 0.03, {"operation": "get_events"})
+    metrics.observe(name, 3, {"operation": "get_events"})
+    lines = metrics.render().splitlines()
+    assert f'{name}_bucket{{operation="get_events",le="0.01"}} 0' in lines
+    assert f'{name}_bucket{{operation="get_events",le="0.05"}} 1' in lines
+    assert f'{name}_bucket{{operation="get_events",le="5"}} 2' in lines
+    assert f'{name}_bucket{{operation="get_events",le="+Inf"}} 2' in lines
+    assert f'{name}_sum{{operation="get_events"}} 3.03' in lines
+    assert f'{name}_count{{operation="get_events"}} 2' in lines
+
+
+def test_write_textfile_replaces_file(tmp_path):
+    path = tmp_path / "dataflow_transfer.prom"
+    path.write_text("old\n")
+    metrics = Metrics()
+    metrics.set("dataflow_transfer_cycle_duration_seconds", 2)
+    metrics.write_textfile(str(path))
+    assert "dataflow_transfer_cycle_duration_seconds 2" in path.read_text()
+    assert os.listdir(tmp_path) == ["dataflow_transfer.prom"]
+
+
+def test_record_cycle_metrics(tmp_path):
+    path = tmp_path / "metrics.prom"
+    conf = {"metrics": {"textfile": str(path)}}
+    results = [
+        RunResult("/data/run1", "NovaSeqXPlus", 0.1, state="sequencing"),
+        RunResult("/data/run2", "NovaSeqXPlus", 0.1, state="sequencing"),
+        RunResult("/data/run3", "NovaSeqXPlus", 0.1, RuntimeError(), "failed"),
+    ]
+    record_cycle_metrics(conf, results, {"NovaSeqXPlus": 4}, 12.5)
+    text = path.read_text()
+    assert "dataflow_transfer_cycle_duration_seconds 12.5" in text
+    assert 'dataflow_transfer_runs{sequencer="NovaSeqXPlus",state="finished"} 4' in text
+    assert (
+        'dataflow_transfer_runs{sequencer="NovaSeqXPlus",state="sequencing"} 2' in text
+    )
+    assert 'dataflow_transfer_runs{sequencer="NovaSeqXPlus",state="failed"} 1' in text
+
+    # Run counts are replaced, not added to, by the next cycle
+    record_cycle_metrics(conf, results[:1], {}, 1)
+    assert 'state="finished"' not in path.read_text()
+    METRICS.clear("dataflow_transfer_runs")
@@ -0,0 +1,166 @@
+import cProfile
+import json
+import pstats
+import threading
+import time
+
+import pytest
+from click.testing import CliRunner
+
+from dataflow_transfer import dataflow_transfer
+from dataflow_transfer.cli import cli
+from dataflow_transfer.utils import profiling
+from dataflow_transfer.utils.profiling import CYCLE, PROFILER, Profiler, profiled
+
+
+@profiled("test.stage")
+def _stage(value):
+    return value * 2
+
+
+def test_spans_are_attributed_to_runs_and_cycle():
+    profiler = Profiler()
+    profiler.enable()
+    with profiler.span("discovery"):
+        pass
+    with profiler.run("/data/run1", "NovaSeqXPlus"):
+        with profiler.span("statusdb.get_events"):
+            pass
+        with profiler.span("statusdb.get_events"):
+            pass
+    report = profiler.report()
+    assert report[CYCLE]["discovery"]["count"] == 1
+    run = report["runs"]["/data/run1"]
+    assert run["sequencer"] == "NovaSeqXPlus"
+    assert run["stages"]["statusdb.get_events"]["count"] == 2
+    assert run["total_seconds"] >= run["stages"]["statusdb.get_events"]["seconds"]
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = Profiler()
+    with profiler.run("/data/run1", "NovaSeqXPlus"):
+        with profiler.span("statusdb.get_events"):
+            pass
+    assert profiler.report() == {CYCLE: {}, "runs": {}}
+
+
+def test_runs_in_threads_are_kept_apart():
+    profiler = Profiler()
+    profiler.enable()
+
+    def process(run_dir):
+        with profiler.run(run_dir, "MiSeq"):
+            with profiler.span(f"stage.{run_dir}"):
+                pass
+
+    threads = [
+        threading.Thread(target=process, args=(f"/data/run{i}",)) for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    runs = profiler.report()["runs"]
+    assert len(runs) == 4
+    for run_dir, run in runs.items():
+        assert list(run["stages"]) == [f"stage.{run_dir}"]
+
+
+def test_session_writes_report_and_stats(tmp_path):
+    report_file = tmp_path / "profile.json"
+    stats_file = tmp_path / "profile.pstats"
+    with PROFILER.session(str(report_file), str(stats_file)):
+        with PROFILER.run("/data/run1", "AVITI"):
+            assert _stage(2) == 4
+    assert not PROFILER.enabled
+    report = json.loads(report_file.read_text())
+    assert report["runs"]["/data/run1"]["stages"]["test.stage"]["count"] == 1
+    functions = {function for _, _, function in pstats.Stats(str(stats_file)).stats}
+    assert "_stage" in functions
+    # Once the session is over the decorator no longer records anything
+    _stage(1)
+    assert PROFILER.report()["runs"]["/data/run1"]["stages"]["test.stage"] == {
+        "count": 1,
+        "seconds": report["runs"]["/data/run1"]["stages"]["test.stage"]["seconds"],
+    }
+
+
+class SingleActiveProfile(cProfile.Profile):
+    """cProfile.Profile that, like on Python 3.12+, allows one active profiler."""
+
+    active = 0
+
+    def enable(self, *args, **kwargs):
+        if SingleActiveProfile.active:
+            raise ValueError("Another profiling tool is already active")
+        SingleActiveProfile.active += 1
+        super().enable(*args, **kwargs)
+
+    def disable(self):
+        SingleActiveProfile.active -= 1
+        super().disable()
+
+
+@pytest.mark.parametrize("process_wide", [False, True])
+def test_profile_stats_with_concurrent_workers(tmp_path, monkeypatch, process_wide):
+    if process_wide:
+        monkeypatch.setattr(profiling, "_PROCESS_WIDE_STATS", True)
+        monkeypatch.setattr(profiling.cProfile, "Profile", SingleActiveProfile)
+    sequencing_path = tmp_path / "NovaSeqXPlus"
+    for i in range(8):
+        (sequencing_path / f"20251010_LH00202_028{i}_B22CVHTLT{i}").mkdir(parents=True)
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        json.dumps(
+            {
+                "concurrency": {"workers": 4},
+                "sequencers": {
+                    "NovaSeqXPlus": {"sequencing_path": str(sequencing_path)}
+                },
+            }
+        )
+    )
+
+    class MockDB:
+        def flush(self):
+            return {}
+
+        def write_counts(self):
+            return {"written": 0, "skipped": 0}
+
+    def mock_process_run(run_dir, sequencer, conf, **kwargs):
+        time.sleep(0.01)
+        return _stage(1)
+
+    results = []
+    monkeypatch.setattr(
+        dataflow_transfer, "get_statusdb_session", lambda config: MockDB()
+    )
+    monkeypatch.setattr(dataflow_transfer, "process_run", mock_process_run)
+    monkeypatch.setattr(
+        dataflow_transfer, "load_status_snapshot", lambda snapshot, run_dirs: None
+    )
+    monkeypatch.setattr(
+        dataflow_transfer,
+        "log_cycle_summary",
+        lambda cycle_results, elapsed: results.extend(cycle_results),
+    )
+    report_file = tmp_path / "profile.json"
+    stats_file = tmp_path / "profile.pstats"
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "-c",
+            str(config_file),
+            "--profile",
+            str(report_file),
+            "--profile-stats",
+            str(stats_file),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert len(results) == 8
+    assert all(run_result.error is None for run_result in results)
+    assert len(json.loads(report_file.read_text())["runs"]) == 8
+    assert pstats.Stats(str(stats_file)).stats
@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+from dataflow_transfer.utils.manifest import PENDING_MANIFEST_FILE
+from dataflow_transfer.utils.progress import ProgressCollector, parse_rsync_log_line
+
+
+@pytest.mark.parametrize(
+    "line, expected",
+    [
+        (
+            "2025/10/10 12:00:01 [123] <f+++++++++ 1048576 Data/L001/1.cbcl",
+            ("file", 1048576, "Data/L001/1.cbcl"),
+        ),
+        (
+            "2025/10/10 12:00:01 [123] <f+++++++++ Data/L001/1.cbcl",
+            ("file", None, "Data/L001/1.cbcl"),
+        ),
+        (
+            "2025/10/10 12:00:02 [123] sent 2,097,152 bytes  received 35 bytes  total size 4,194,304",
+            ("summary", 2097152, None),
+        ),
+        ("2025/10/10 12:00:01 [123] cd+++++++++ Data/L001/", None),
+        ("2025/10/10 12:00:01 [123] building file list", None),
+        ("not a log line", None),
+    ],
+)
+def test_parse_rsync_log_line(line, expected):
+    assert parse_rsync_log_line(line) == expected
+
+
+def write_log(path, lines, mode="a"):
+    with open(path, mode) as f:
+        for line in lines:
+            f.write(f"2025/10/10 12:00:01 [123] {line}\n")
+
+
+def test_collect_reads_log_incrementally(tmp_path):
+    log_file = tmp_path / "rsync_remote_log.txt"
+    write_log(log_file, ["<f+++++++++ 100 a", "<f+++++++++ 300 b"])
+    collector = ProgressCollector(str(tmp_path))
+    summary = collector.collect(now=1000)
+    assert (summary["files_sent"], summary["bytes_sent"]) == (2, 400)
+
+    # A partly written line is left for the next call
+    write_log(log_file, ["<f+++++++++ 500 c"])
+    with open(log_file, "a") as f:
+        f.write("2025/10/10 12:00:01 [123] <f+++++++++ 70")
+    summary = collector.collect(now=1010)
+    assert (summary["files_sent"], summary["bytes_sent"]) == (3, 900)
+    assert summary["throughput_bytes_per_second"] == 50
+    with open(log_file, "a") as f:
+        f.write("0 d\n")
+    assert collector.collect(now=1020)["bytes_sent"] == 1600
+
+    # Summary lines are ignored when the bytes are counted per file
+    write_log(log_file, ["sent 1,000 bytes  received 10 bytes  total size 1,000"])
+    assert collector.collect(now=1030)["bytes_sent"] == 1600
+
+
+def test_collect_counts_summary_bytes_without_per_file_bytes(tmp_path):
+    log_file = tmp_path / "rsync_remote_log.txt"
+    write_log(log_file, ["<f+++++++++ a", "sent 1,000 bytes  received 10 bytes"])
+    summary = ProgressCollector(str(tmp_path)).collect(now=1000)
+    assert (summary["files_sent"], summary["bytes_sent"]) == (1, 1000)
+
+
+def test_collect_starts_over_on_truncated_log(tmp_path):
+    log_file = tmp_path / "rsync_remote_log.txt"
+    write_log(log_file, ["<f+++++++++ 100 a", "<f+++++++++ 100 b"])
+    collector = ProgressCollector(str(tmp_path))
+    collector.collect(now=1000)
+    write_log(log_file, ["<f+++++++++ 5 c"], mode="w")
+    assert collector.collect(now=1010)["bytes_sent"] == 205
+
+
+def test_eta_from_pending_manifest(tmp_path):
+    log_file = tmp_path / "rsync_remote_log.txt"
+    write_log(log_file, ["<f+++++++++ 1000 old"])
+    collector = ProgressCollector(str(tmp_path))
+    assert collector.collect(now=1000)["eta_seconds"] is None
+    with open(tmp_path / PENDING_MANIFEST_FILE, "w") as f:
+        json.dump({"a": [600, 1], "b": [400, 1]}, f)
+    collector.collect(now=1010)
+    write_log(log_file, ["<f+++++++++ 600 a"])
+    summary = collector.collect(now=1020)
+    # 400 bytes left at 60 bytes/s
+    assert summary["eta_seconds"] == 7
+
+
+def test_should_write(tmp_path):
+    collector = ProgressCollector(str(tmp_path))
+    assert collector.should_write(300, now=1000)
+    collector.mark_written(now=1000)
+    assert not collector.should_write(300, now=1200)
+    assert collector.should_write(300, now=1300)
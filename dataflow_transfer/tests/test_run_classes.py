@@ -1,8 +1,11 @@
 import os
+import subprocess
+from pathlib import Path
 
 import pytest
 
 from dataflow_transfer.run_classes import generic_runs, illumina_runs
+from dataflow_transfer.utils.statusdb import StatusSnapshot
 
 # TODO: add tests for ONT and ELEMENT runs when those are implemented
 
@@ -144,7 +147,7 @@ def mock_statusdbsession(monkeypatch):
         def get_db_doc(self, ddoc, view, run_id):
             return None
 
-        def update_db_doc(self, doc):
+        def update_db_doc(self, doc, status=None):
             pass
 
     monkeypatch.setattr(generic_runs, "StatusdbSession", MockStatusdbSession)
@@ -232,6 +235,16 @@ def test_generate_rsync_command(
     assert run_obj.run_dir in rsync_command
     if with_exit_code_file:
         assert "; echo $? >" in rsync_command
+    if not metadata_only:
+        # The tool's own files in the run folder are not sent to remote storage
+        for pattern in [
+            ".rsync_shard_*.files",
+            ".rsync_manifest*",
+            ".rsync_incremental.files",
+            ".intermediate_rsync_exitcode",
+            ".rsync_progress.json*",
+        ]:
+            assert f"--exclude='{pattern}'" in rsync_command
 
 
 @pytest.mark.parametrize(
@@ -289,6 +302,89 @@ def test_start_transfer(run_fixture, rsync_running, final, request, monkeypatch)
             assert mock_update_statusdb.status == "transfer_started"
 
 
+def test_start_transfer_queued_by_scheduler(novaseqxplus_testobj, monkeypatch):
+    run_obj = novaseqxplus_testobj
+    statuses = []
+    submitted = []
+
+    class MockScheduler:
+        def __init__(self):
+            self.queued = set()
+
+        def is_queued(self, run_dir):
+            return run_dir in self.queued
+
+        def request_slot(self, run_dir, sequencer, final):
+            assert sequencer == "NovaSeqXPlus"
+            self.queued.add(run_dir)
+            return False
+
+    monkeypatch.setattr(generic_runs.fs, "rsync_is_running", lambda src, dst: False)
+    monkeypatch.setattr(generic_runs.fs, "submit_background_process", submitted.append)
+    monkeypatch.setattr(
+        run_obj,
+        "update_statusdb",
+        lambda status, additional_info=None: statuses.append(status),
+    )
+    run_obj.scheduler = MockScheduler()
+    run_obj.start_transfer(final=True)
+    run_obj.start_transfer(final=True)
+    assert submitted == []
+    # Only set when the run is first queued
+    assert statuses == ["transfer_queued"]
+
+
+def test_queued_incremental_sync_leaves_no_pending_manifest(
+    novaseqxplus_testobj, monkeypatch, caplog
+):
+    run_obj = novaseqxplus_testobj
+    run_obj.incremental_sync = True
+    (Path(run_obj.run_dir) / "RunInfo.xml").write_text("<RunInfo/>")
+
+    class MockScheduler:
+        def is_queued(self, run_dir):
+            return True
+
+        def request_slot(self, run_dir, sequencer, final):
+            return False
+
+    monkeypatch.setattr(generic_runs.fs, "rsync_is_running", lambda src, dst: False)
+    run_obj.scheduler = MockScheduler()
+    with caplog.at_level("INFO"):
+        run_obj.start_transfer(final=False)
+        run_obj.start_transfer(final=False)
+    assert not os.path.exists(
+        os.path.join(run_obj.run_dir, ".rsync_manifest.pending.json")
+    )
+    assert not os.path.exists(os.path.join(run_obj.run_dir, ".rsync_incremental.files"))
+    assert "did not succeed" not in caplog.text
+
+
+def test_start_transfer_releases_slot_on_failure(novaseqxplus_testobj, monkeypatch):
+    run_obj = novaseqxplus_testobj
+    released = []
+
+    class MockScheduler:
+        def is_queued(self, run_dir):
+            return False
+
+        def request_slot(self, run_dir, sequencer, final):
+            return True
+
+        def release_slot(self, run_dir, sequencer):
+            released.append((run_dir, sequencer))
+
+    def failing_submit(command):
+        raise OSError("fork failed")
+
+    monkeypatch.setattr(generic_runs.fs, "rsync_is_running", lambda src, dst: False)
+    monkeypatch.setattr(generic_runs.fs, "submit_background_process", failing_submit)
+    run_obj.scheduler = MockScheduler()
+    with pytest.raises(OSError):
+        run_obj.start_transfer(final=True)
+    assert released == [(run_obj.run_dir, "NovaSeqXPlus")]
+
+
 @pytest.mark.parametrize(
     "run_fixture, sync_successful",
     [
@@ -410,6 +506,47 @@ def test_has_status(run_fixture, status_to_check, expected_result, request):
     assert run_obj.has_status(status_to_check) == expected_result
 
 
+@pytest.mark.parametrize(
+    "run_fixture",
+    [
+        "novaseqxplus_testobj",
+        "nextseq_testobj",
+        "miseqseq_testobj",
+        "miseqseqi100_testobj",
+    ],
+)
+def test_has_status_uses_snapshot(run_fixture, request):
+    run_obj = request.getfixturevalue(run_fixture)
+
+    class MockDB:
+        def __init__(self):
+            self.calls = 0
+
+        def get_events(self, run_id):
+            self.calls += 1
+            return {"rows": [{"value": {"sequencing_finished": True}}]}
+
+        def get_db_doc(self, ddoc, view, run_id):
+            return {"events": [], "files": {}}
+
+        def update_db_doc(self, doc, status=None):
+            pass
+
+    mock_db = MockDB()
+    run_obj.db = mock_db
+    run_obj.status_snapshot = StatusSnapshot(mock_db)
+    run_obj.status_snapshot.set(run_obj.run_id, {"sequencing_started": True})
+    assert run_obj.has_status("sequencing_started") is True
+    assert run_obj.has_status("sequencing_finished") is False
+    assert mock_db.calls == 0
+
+    # A status write drops the run from the snapshot, so it is read again once
+    run_obj.update_statusdb(status="transfer_started")
+    assert run_obj.has_status("sequencing_finished") is True
+    assert run_obj.has_status("sequencing_started") is False
+    assert mock_db.calls == 1
+
+
 @pytest.mark.parametrize(
     "run_fixture, existing_statuses, status_to_update",
     [
@@ -456,6 +593,7 @@ def test_update_statusdb(
     existing_statuses,
     status_to_update,
     request,
+    monkeypatch,
 ):
     run_obj = request.getfixturevalue(run_fixture)
 
@@ -466,20 +604,217 @@ def test_update_statusdb(
         def get_db_doc(self, ddoc, view, run_id):
             return {"events": existing_statuses, "files": {}}
 
-        def update_db_doc(self, doc):
+        def update_db_doc(self, doc, status=None):
             self.updated_doc = doc
 
     import dataflow_transfer.utils.filesystem as fs
 
+    run_info = os.path.join(run_obj.run_dir, "RunInfo.xml")
+    parse_calls = []
+
     def mock_locate_metadata(metadata_list, run_dir):
-        return []
+        return [run_info]
 
-    def mock_parse_metadata_files(files):
-        return {}
+    def mock_parse_changed_metadata_files(files, known_checksums, **kwargs):
+        parse_calls.append((files, known_checksums))
+        return {"RunInfo.xml": {"Run": "info"}}, {"RunInfo.xml": "checksum"}
 
-    fs.locate_metadata = mock_locate_metadata
-    fs.parse_metadata_files = mock_parse_metadata_files
+    monkeypatch.setattr(fs, "locate_metadata", mock_locate_metadata)
+    monkeypatch.setattr(
+        fs, "parse_changed_metadata_files", mock_parse_changed_metadata_files
+    )
     mock_db = MockDB()
     run_obj.db = mock_db
     run_obj.update_statusdb(status=status_to_update)
     assert mock_db.updated_doc["events"][-1]["event_type"] == status_to_update
+    assert parse_calls == [([run_info], {})]
+    assert mock_db.updated_doc["files"] == {"RunInfo.xml": {"Run": "info"}}
+    assert mock_db.updated_doc["file_checksums"] == {"RunInfo.xml": "checksum"}
+
+
+def test_update_statusdb_skips_unchanged_writes(novaseqxplus_testobj):
+    run_obj = novaseqxplus_testobj
+    run_obj.configuration["statusdb"]["dedup_window"] = 3600
+
+    class MockDB:
+        def __init__(self):
+            self.doc = None
+            self.writes = 0
+            self.skipped = 0
+
+        def get_db_doc(self, ddoc, view, run_id):
+            return self.doc
+
+        def update_db_doc(self, doc, status=None):
+            self.doc = doc
+            self.writes += 1
+
+        def count_write(self, outcome):
+            self.skipped += 1
+
+    run_obj.db = MockDB()
+    rsync_info = {"command": "rsync a b", "destination_path": "/data"}
+    run_obj.update_statusdb("transfer_started", additional_info=rsync_info)
+    run_obj.update_statusdb("transfer_started", additional_info=rsync_info)
+    assert (run_obj.db.writes, run_obj.db.skipped) == (1, 1)
+
+    # Changed event data, or a changed metadata file, is written
+    run_obj.update_statusdb("transfer_started", additional_info={"command": "x"})
+    (Path(run_obj.run_dir) / "RunInfo.xml").write_text("<RunInfo/>")
+    run_obj.update_statusdb("transfer_started", additional_info={"command": "x"})
+    assert (run_obj.db.writes, run_obj.db.skipped) == (3, 1)
+
+    # Outside the window the same content is written again
+    run_obj.db.doc["events"][-1]["timestamp"] = "2000-01-01T00:00:00Z"
+    run_obj.update_statusdb("transfer_started", additional_info={"command": "x"})
+    assert (run_obj.db.writes, run_obj.db.skipped) == (4, 1)
+
+
+@pytest.mark.parametrize("failing_shard, expected_exit_code", [(None, "0"), (1, "23")])
+def test_sharded_final_transfer(
+    novaseqxplus_testobj, tmp_path, monkeypatch, failing_shard, expected_exit_code
+):
+    run_obj = novaseqxplus_testobj
+    run_dir = Path(run_obj.run_dir)
+    for lane, size in [("L001", 300), ("L002", 200), ("L003", 100)]:
+        (run_dir / "Data" / lane).mkdir(parents=True)
+        (run_dir / "Data" / lane / "1.cbcl").write_bytes(b"x" * size)
+    (run_dir / "RunInfo.xml").write_text("<RunInfo/>")
+    run_obj.rsync_shards = 2
+
+    # Fake rsync that logs its file list and fails for the chosen shard
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls = tmp_path / "calls.txt"
+    (bin_dir / "rsync").write_text(
+        "#!/bin/sh\n"
+        f'echo "$*" >> {calls}\n'
+        f'case "$*" in *rsync_shard_{failing_shard}*) exit 23;; esac\n'
+    )
+    (bin_dir / "rsync").chmod(0o755)
+    (bin_dir / "run-one").write_text('#!/bin/sh\n"$@"\n')
+    (bin_dir / "run-one").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+
+    command = run_obj.generate_sharded_rsync_command(bwlimit=1000)
+    subprocess.run(command, shell=True, check=True)
+
+    shards = [
+        sorted((run_dir / f".rsync_shard_{index}.files").read_text().split("\0"))
+        for index in range(2)
+    ]
+    assert shards == [
+        ["", "Data/L001/1.cbcl", "RunInfo.xml"],
+        ["", "Data/L002/1.cbcl", "Data/L003/1.cbcl"],
+    ]
+    call_lines = calls.read_text().splitlines()
+    assert all("--bwlimit=500" in line for line in call_lines[:2])
+    # The file lists are not sent to remote storage
+    assert all("--exclude=.rsync_shard_*.files" in line for line in call_lines)
+    if failing_shard is None:
+        # The whole run is synced once more after the shards
+        assert len(call_lines) == 3
+        assert "--files-from" not in call_lines[2]
+    else:
+        assert len(call_lines) == 2
+    with open(run_obj.final_rsync_exitcode_file) as f:
+        assert f.read().strip() == expected_exit_code
+    assert run_obj.final_sync_successful == (failing_shard is None)
+
+
+def test_incremental_intermediate_sync(novaseqxplus_testobj, monkeypatch):
+    run_obj = novaseqxplus_testobj
+    run_obj.incremental_sync = True
+    (Path(run_obj.run_dir) / "RunInfo.xml").write_text("<RunInfo/>")
+    submitted = []
+    statuses = []
+    monkeypatch.setattr(generic_runs.fs, "rsync_is_running", lambda src, dst: False)
+    monkeypatch.setattr(generic_runs.fs, "submit_background_process", submitted.append)
+    monkeypatch.setattr(
+        run_obj,
+        "update_statusdb",
+        lambda status, additional_info=None: statuses.append(status),
+    )
+
+    # Written by the progress tracking while the sync runs
+    (Path(run_obj.run_dir) / ".rsync_progress.json.tmp").write_text("{")
+
+    run_obj.start_transfer(final=False)
+    (command,) = submitted
+    assert "--files-from=" in command
+    with open(os.path.join(run_obj.run_dir, ".rsync_incremental.files")) as f:
+        assert ".rsync_progress.json.tmp" not in f.read()
+    # Neither the manifest nor the file list are sent to remote storage
+    assert "--exclude='.rsync_manifest*'" in command
+    assert "--exclude='.rsync_incremental.files'" in command
+    assert command.endswith(".intermediate_rsync_exitcode")
+    with open(os.path.join(run_obj.run_dir, ".intermediate_rsync_exitcode"), "w") as f:
+        f.write("0")
+
+    # Everything was sent, so no rsync is started
+    run_obj.start_transfer(final=False)
+    assert len(submitted) == 1
+    assert statuses == ["transfer_started"]
+
+
+def test_record_progress_while_rsync_is_running(novaseqxplus_testobj, monkeypatch):
+    run_obj = novaseqxplus_testobj
+    run_obj.configuration["progress"] = {"enabled": True, "write_interval": 300}
+    assert "--log-file-format='%i %b %n%L'" in run_obj.generate_rsync_command()
+    with open(os.path.join(run_obj.run_dir, "rsync_remote_log.txt"), "w") as f:
+        f.write("2025/10/10 12:00:01 [123] <f+++++++++ 2048 RunInfo.xml\n")
+
+    class MockDB:
+        def __init__(self):
+            self.written = []
+
+        def get_db_doc(self, ddoc, view, run_id):
+            return {"runfolder_id": run_id, "events": []}
+
+        def update_db_doc(self, doc, status=None):
+            self.written.append(doc["transfer_progress"])
+
+    run_obj.db = MockDB()
+    monkeypatch.setattr(generic_runs.fs, "rsync_is_running", lambda src, dst: True)
+    run_obj.start_transfer(final=False)
+    run_obj.start_transfer(final=False)
+    # Written once, the second call is within the write interval
+    (progress,) = run_obj.db.written
+    assert (progress["files_sent"], progress["bytes_sent"]) == (1, 2048)
+
+
+def test_rsync_is_running_without_proc_uses_pgrep(novaseqxplus_testobj, monkeypatch):
+    from dataflow_transfer.utils.filesystem import RsyncProcessIndex
+
+    run_obj = novaseqxplus_testobj
+    run_obj.process_index = RsyncProcessIndex("/nonexistent")
+    patterns = []
+
+    def mock_check_output(command):
+        patterns.append(command[-1])
+        return b"12345"
+
+    monkeypatch.setattr(generic_runs.fs.subprocess, "check_output", mock_check_output)
+    assert run_obj.rsync_is_running("/data/NovaSeqXPlus")
+    assert len(patterns) == 1
+
+
+def test_registry_lists_every_run_class():
+    from dataflow_transfer.run_classes import element_runs, ont_runs
+    from dataflow_transfer.run_classes.registry import (
+        _RUN_CLASS_MODULES,
+        RUN_CLASS_REGISTRY,
+    )
+
+    run_classes = [
+        cls
+        for module in (element_runs, illumina_runs, ont_runs)
+        for cls in vars(module).values()
+        if isinstance(cls, type) and "run_type" in vars(cls)
+    ]
+    assert sorted(_RUN_CLASS_MODULES) == sorted(cls.run_type for cls in run_classes)
+    for cls in run_classes:
+        assert _RUN_CLASS_MODULES[cls.run_type] == (cls.__module__, cls.__name__)
+        assert RUN_CLASS_REGISTRY[cls.run_type] is cls
+    assert RUN_CLASS_REGISTRY.get("Unknown") is None
+    assert "Unknown" not in RUN_CLASS_REGISTRY
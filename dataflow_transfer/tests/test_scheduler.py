@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+from dataflow_transfer.utils.filesystem import RsyncProcessIndex
+from dataflow_transfer.utils.scheduler import (
+    TransferScheduler,
+    open_transfer_scheduler,
+)
+
+
+@pytest.fixture
+def conf(tmp_path):
+    return {
+        "scheduler": {
+            "max_rsyncs": 2,
+            "state_file": str(tmp_path / "transfer_queue.json"),
+        },
+        "sequencers": {
+            "NovaSeqXPlus": {
+                "sequencing_path": "/seq/nova",
+                "remote_destination": "/Illumina/NovaSeqXPlus",
+            },
+            "PromethION": {
+                "sequencing_path": "/seq/ont",
+                "remote_destination": "/ONT/PromethION",
+                "max_rsyncs": 1,
+            },
+        },
+    }
+
+
+@pytest.fixture
+def process_index(tmp_path):
+    # A proc root without processes, transfers are added by hand
+    return RsyncProcessIndex(proc_root=str(tmp_path / "proc"))
+
+
+def test_open_transfer_scheduler_without_limits(process_index):
+    conf = {"sequencers": {"NovaSeqXPlus": {"remote_destination": "/data"}}}
+    assert open_transfer_scheduler(conf, process_index) is None
+
+
+def test_request_slot_respects_limits(conf, process_index):
+    scheduler = TransferScheduler(conf, process_index)
+    assert scheduler.request_slot("/seq/ont/run1", "PromethION", final=False)
+    # Sequencer limit of 1 reached
+    assert not scheduler.request_slot("/seq/ont/run2", "PromethION", final=False)
+    assert scheduler.request_slot("/seq/nova/run1", "NovaSeqXPlus", final=False)
+    # Global limit of 2 reached
+    assert not scheduler.request_slot("/seq/nova/run2", "NovaSeqXPlus", final=True)
+    assert scheduler.is_queued("/seq/nova/run2")
+    assert not scheduler.is_queued("/seq/nova/run1")
+
+
+def test_request_slot_counts_wrapped_rsync_once(conf, process_index):
+    process_index.add(src="/seq/nova/run1", dst="user@host:/Illumina/NovaSeqXPlus")
+    process_index.add(src="/seq/nova/run1", dst="user@host:/Illumina/NovaSeqXPlus")
+    scheduler = TransferScheduler(conf, process_index)
+    assert scheduler.request_slot("/seq/nova/run2", "NovaSeqXPlus", final=False)
+
+
+def test_final_transfers_go_first_across_invocations(conf, tmp_path):
+    full_index = RsyncProcessIndex(proc_root=str(tmp_path / "proc"))
+    full_index.add(src="/seq/nova/run1", dst="/Illumina/NovaSeqXPlus")
+    full_index.add(src="/seq/nova/run2", dst="/Illumina/NovaSeqXPlus")
+    scheduler = TransferScheduler(conf, full_index)
+    assert not scheduler.request_slot("/seq/nova/run3", "NovaSeqXPlus", final=False)
+    assert not scheduler.request_slot("/seq/nova/run4", "NovaSeqXPlus", final=True)
+    with open(conf["scheduler"]["state_file"]) as f:
+        assert set(json.load(f)) == {"/seq/nova/run3", "/seq/nova/run4"}
+
+    # Next invocation, one rsync has finished. The queued final transfer
+    # gets the free slot even though the intermediate sync asks first.
+    index = RsyncProcessIndex(proc_root=str(tmp_path / "proc"))
+    index.add(src="/seq/nova/run1", dst="/Illumina/NovaSeqXPlus")
+    scheduler = TransferScheduler(conf, index)
+    assert not scheduler.request_slot("/seq/nova/run3", "NovaSeqXPlus", final=False)
+    assert scheduler.request_slot("/seq/nova/run4", "NovaSeqXPlus", final=True)
+    assert not scheduler.is_queued("/seq/nova/run4")
+
+
+def test_prune(conf, process_index):
+    scheduler = TransferScheduler(conf, process_index)
+    scheduler._queue = {
+        "/seq/gone": {"sequencer": "PromethION", "final": True, "queued_at": 1},
+        "/seq/here": {"sequencer": "PromethION", "final": True, "queued_at": 2},
+    }
+    scheduler.prune(["/seq/here"])
+    assert list(scheduler._queue) == ["/seq/here"]
+
+
+def test_shared_destination_is_counted_per_sequencer(conf, process_index):
+    conf["scheduler"]["max_rsyncs"] = None
+    conf["sequencers"]["NovaSeqXPlus"]["max_rsyncs"] = 1
+    conf["sequencers"]["MiSeq"] = {
+        "sequencing_path": "/seq/miseq",
+        "remote_destination": "/Illumina/NovaSeqXPlus",
+        "max_rsyncs": 1,
+    }
+    # A manual copy to the same destination is not a transfer of a run
+    process_index.add(src="/home/user/data", dst="/Illumina/NovaSeqXPlus")
+    scheduler = TransferScheduler(conf, process_index)
+    assert scheduler.request_slot("/seq/nova/run1", "NovaSeqXPlus", final=False)
+    assert scheduler.request_slot("/seq/miseq/run1", "MiSeq", final=False)
+    assert not scheduler.request_slot("/seq/miseq/run2", "MiSeq", final=False)
+
+
+def test_release_slot(conf, process_index):
+    scheduler = TransferScheduler(conf, process_index)
+    assert scheduler.request_slot("/seq/ont/run1", "PromethION", final=False)
+    scheduler.release_slot("/seq/ont/run1", "PromethION")
+    assert scheduler.request_slot("/seq/ont/run2", "PromethION", final=False)
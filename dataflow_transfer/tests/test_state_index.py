@@ -0,0 +1,45 @@
+import os
+
+from dataflow_transfer.utils.state_index import RunStateIndex, open_state_index
+
+
+def test_finished_run_is_skipped_until_directory_changes(tmp_path):
+    run_dir = tmp_path / "run1"
+    run_dir.mkdir()
+    exit_code_file = run_dir / ".final_rsync_exitcode"
+    exit_code_file.write_text("0")
+    index = RunStateIndex(str(tmp_path / "state.sqlite"))
+
+    assert not index.is_finished(str(run_dir))
+    index.mark_finished(str(run_dir), "NovaSeqXPlus")
+    assert index.is_finished(str(run_dir))
+
+    # Removing the exit code file restarts the transfer
+    os.remove(exit_code_file)
+    os.utime(run_dir, ns=(0, 0))
+    assert not index.is_finished(str(run_dir))
+    assert not index.is_finished(str(run_dir))
+    index.close()
+
+
+def test_state_index_persists_and_prunes(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    run_dirs = []
+    for name in ["run1", "run2"]:
+        (tmp_path / name).mkdir()
+        run_dirs.append(str(tmp_path / name))
+    index = open_state_index({"state_index": {"path": path}})
+    for run_dir in run_dirs:
+        index.mark_finished(run_dir, "PromethION")
+    index.close()
+
+    index = RunStateIndex(path)
+    assert index.is_finished(run_dirs[0])
+    index.prune([run_dirs[1]])
+    assert not index.is_finished(run_dirs[0])
+    assert index.is_finished(run_dirs[1])
+    index.close()
+
+
+def test_open_state_index_not_configured():
+    assert open_state_index({}) is None
@@ -0,0 +1,275 @@
+import pytest
+
+from dataflow_transfer.utils import statusdb
+
+
+class MockResponse:
+    def __init__(self, result):
+        self.result = result
+
+    def get_result(self):
+        return self.result
+
+
+class MockCloudant:
+    """Minimal stand-in for cloudant_v1.CloudantV1 backed by a dict of documents."""
+
+    instances = 0
+
+    def __init__(self, authenticator=None):
+        MockCloudant.instances += 1
+        self.docs = {}
+        self.calls = []
+
+    def set_service_url(self, url):
+        pass
+
+    def get_http_client(self):
+        class Adapter:
+            def init_poolmanager(self, connections, maxsize):
+                pass
+
+        class Client:
+            def get_adapter(self, url):
+                return Adapter()
+
+        return Client()
+
+    def get_server_information(self):
+        return MockResponse({"couchdb": "Welcome"})
+
+    def post_view(self, db, ddoc, view, key=None, keys=None, **kwargs):
+        self.calls.append(("post_view", view, kwargs))
+        keys = [key] if keys is None else keys
+        rows = []
+        for run_id in keys:
+            for doc_id, doc in self.docs.items():
+                if doc["runfolder_id"] != run_id:
+                    continue
+                if view == "current_status_per_runfolder":
+                    value = {event["event_type"]: True for event in doc["events"]}
+                    rows.append({"id": doc_id, "key": run_id, "value": value})
+                else:
+                    row = {"id": doc_id, "key": run_id, "value": None}
+                    if kwargs.get("include_docs"):
+                        row["doc"] = dict(doc)
+                    rows.append(row)
+        return MockResponse({"rows": rows})
+
+    def get_document(self, db, doc_id):
+        self.calls.append(("get_document", doc_id))
+        return MockResponse(dict(self.docs[doc_id]))
+
+    def post_document(self, db, document):
+        self.calls.append(("post_document", document.get("runfolder_id")))
+        doc_id = document.get("_id", f"doc{len(self.docs) + 1}")
+        self.docs[doc_id] = dict(document, _id=doc_id)
+        return MockResponse({"ok": True, "id": doc_id})
+
+    def post_bulk_docs(self, db, bulk_docs):
+        self.calls.append(("post_bulk_docs", len(bulk_docs.docs)))
+        results = []
+        for document in bulk_docs.docs:
+            doc_id = document.get("_id", f"doc{len(self.docs) + 1}")
+            stored = self.docs.get(doc_id)
+            if stored and stored.get("_rev") != document.get("_rev"):
+                results.append({"id": doc_id, "error": "conflict"})
+                continue
+            revision = int(stored["_rev"].split("-")[0]) + 1 if stored else 1
+            self.docs[doc_id] = dict(document, _id=doc_id, _rev=f"{revision}-x")
+            results.append({"id": doc_id, "ok": True})
+        return MockResponse(results)
+
+
+@pytest.fixture
+def mock_cloudant(monkeypatch):
+    MockCloudant.instances = 0
+    monkeypatch.setattr(statusdb.cloudant_v1, "CloudantV1", MockCloudant)
+    monkeypatch.setattr(statusdb, "_SESSIONS", {})
+    return MockCloudant
+
+
+@pytest.fixture
+def session(mock_cloudant):
+    session = statusdb.StatusdbSession(
+        {"username": "u", "password": "p", "url": "dburl", "database": "dbname"}
+    )
+    session.connection.docs = {
+        "doc1": {
+            "_id": "doc1",
+            "_rev": "1-x",
+            "runfolder_id": "run1",
+            "events": [{"event_type": "sequencing_started"}],
+            "files": {},
+        },
+        "doc2": {
+            "_id": "doc2",
+            "_rev": "1-x",
+            "runfolder_id": "run2",
+            "events": [{"event_type": "transferred_to_hpc"}],
+            "files": {},
+        },
+    }
+    return session
+
+
+def test_get_statusdb_session_is_shared(mock_cloudant):
+    config = {"username": "u", "password": "p", "url": "dburl", "database": "dbname"}
+    first = statusdb.get_statusdb_session(config)
+    assert statusdb.get_statusdb_session(dict(config)) is first
+    assert mock_cloudant.instances == 1
+    other = statusdb.get_statusdb_session(dict(config, database="other"))
+    assert other is not first
+    assert mock_cloudant.instances == 2
+
+
+def test_get_events_for_runs(session):
+    statuses = session.get_events_for_runs(["run1", "run2", "run3"])
+    assert statuses == {
+        "run1": {"sequencing_started": True},
+        "run2": {"transferred_to_hpc": True},
+        "run3": {},
+    }
+    assert len(session.connection.calls) == 1
+
+
+def test_status_snapshot(session):
+    snapshot = statusdb.StatusSnapshot(session)
+    snapshot.load(["run1", "run2"])
+    snapshot.load(["run1", "run2"])
+    assert len(session.connection.calls) == 1
+    assert snapshot.get("run1") == {"sequencing_started": True}
+    snapshot.invalidate("run1")
+    assert snapshot.get("run1") is None
+
+
+def test_get_db_doc_single_round_trip(session):
+    doc = session.get_db_doc(ddoc="lookup", view="runfolder_id", run_id="run1")
+    assert doc["_id"] == "doc1"
+    assert [call[0] for call in session.connection.calls] == ["post_view"]
+    assert session.get_db_doc(ddoc="lookup", view="runfolder_id", run_id="run3") is None
+
+
+def test_get_db_docs(session):
+    docs = session.get_db_docs(
+        ddoc="lookup", view="runfolder_id", run_ids=["run1", "run2", "run3"]
+    )
+    assert {run_id: doc["_id"] for run_id, doc in docs.items()} == {
+        "run1": "doc1",
+        "run2": "doc2",
+    }
+    assert len(session.connection.calls) == 1
+
+
+def test_write_behind_flush(session):
+    session.write_behind = True
+    for run_id in ["run1", "run3"]:
+        doc = session.get_db_doc(ddoc="lookup", view="runfolder_id", run_id=run_id) or {
+            "runfolder_id": run_id,
+            "events": [],
+            "files": {},
+        }
+        doc["events"].append({"event_type": "transfer_started", "timestamp": "t1"})
+        session.update_db_doc(doc)
+    # Queued documents are visible to later reads but not yet written
+    assert session.get_events("run3")["rows"][0]["value"] == {"transfer_started": "t1"}
+    assert not [call for call in session.connection.calls if call[0] != "post_view"]
+
+    # Someone else writes run1 in the meantime, causing a conflict
+    session.connection.docs["doc1"]["_rev"] = "2-y"
+    session.connection.docs["doc1"]["events"] = [
+        {"event_type": "sequencing_started"},
+        {"event_type": "sequencing_finished"},
+    ]
+    results = session.flush()
+
+    assert results == {"run1": "ok", "run3": "ok"}
+    bulk_calls = [
+        call for call in session.connection.calls if call[0] == "post_bulk_docs"
+    ]
+    assert bulk_calls == [("post_bulk_docs", 2), ("post_bulk_docs", 1)]
+    assert [
+        event["event_type"] for event in session.connection.docs["doc1"]["events"]
+    ] == [
+        "sequencing_started",
+        "sequencing_finished",
+        "transfer_started",
+    ]
+    assert session.flush() == {}
+
+
+def test_write_behind_flush_falls_back_to_single_writes(session, monkeypatch, caplog):
+    session.write_behind = True
+    session._RETRY_BACKOFF_SECONDS = 0
+    session.update_db_doc(
+        {"runfolder_id": "run3", "events": [{"event_type": "sequencing_started"}]}
+    )
+
+    def failing_bulk_docs(db, bulk_docs):
+        raise ConnectionError("connection reset")
+
+    monkeypatch.setattr(session.connection, "post_bulk_docs", failing_bulk_docs)
+    assert session.flush() == {"run3": "ok"}
+    assert ("post_document", "run3") in session.connection.calls
+
+
+def test_compact_events_keeps_first_and_latest_of_each_type():
+    events = [
+        {"event_type": "sequencing_started", "timestamp": "t0"},
+        *(
+            {"event_type": "transfer_started", "timestamp": f"t{i}"}
+            for i in range(1, 7)
+        ),
+        {"event_type": "sequencing_finished", "timestamp": "t7"},
+        {"event_type": "final_transfer_started", "timestamp": "t8"},
+    ]
+    kept, summary = statusdb.compact_events(events, max_events=2)
+    assert [event["timestamp"] for event in kept] == ["t0", "t1", "t6", "t7", "t8"]
+    assert summary == {
+        "transfer_started": {
+            "count": 4,
+            "first_timestamp": "t2",
+            "last_timestamp": "t5",
+        }
+    }
+    # Compacting again keeps the summary and adds to it
+    kept, summary = statusdb.compact_events(
+        kept + [{"event_type": "transfer_started", "timestamp": "t9"}],
+        max_events=2,
+        summary=summary,
+    )
+    assert [event["timestamp"] for event in kept] == ["t0", "t1", "t7", "t8", "t9"]
+    assert summary["transfer_started"] == {
+        "count": 5,
+        "first_timestamp": "t2",
+        "last_timestamp": "t6",
+    }
+
+
+def test_update_db_doc_compacts_events(session):
+    session.max_events = 1
+    doc = session.get_db_doc(ddoc="lookup", view="runfolder_id", run_id="run1")
+    for timestamp in ["t1", "t2", "t3"]:
+        doc["events"].append({"event_type": "transfer_started", "timestamp": timestamp})
+    session.update_db_doc(doc)
+    stored = session.connection.docs["doc1"]
+    assert [event.get("timestamp") for event in stored["events"]] == [None, "t1", "t3"]
+    assert stored["event_summary"]["transfer_started"]["count"] == 1
+    statuses = session.get_events("run1")["rows"][0]["value"]
+    assert statuses == {"sequencing_started": True, "transfer_started": True}
+
+
+def test_write_behind_progress_update_adds_no_status(session, caplog):
+    session.write_behind = True
+    doc = {"runfolder_id": "run3", "events": [], "files": {}}
+    doc["events"].append({"event_type": "transfer_started", "timestamp": "t1"})
+    session.update_db_doc(doc, status="transfer_started")
+    doc = session.get_db_doc(ddoc="lookup", view="runfolder_id", run_id="run3")
+    doc["transfer_progress"] = {"files_sent": 10, "bytes_sent": 2048}
+    session.update_db_doc(doc)
+
+    assert session._pending["run3"]["statuses"] == ["transfer_started"]
+    assert session.get_events("run3")["rows"][0]["value"] == {"transfer_started": "t1"}
+    assert session.get_db_doc(ddoc="lookup", view="runfolder_id", run_id="run3")[
+        "transfer_progress"
+    ] == {"files_sent": 10, "bytes_sent": 2048}
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from dataflow_transfer.utils.watcher import RunWatcher
+
+
+@pytest.fixture(params=[True, False], ids=["inotify", "poll"])
+def watcher(request):
+    watcher = RunWatcher(use_inotify=request.param, poll_interval=0.05)
+    if request.param and watcher.inotify is None:
+        pytest.skip("inotify is not available")
+    yield watcher
+    watcher.close()
+
+
+def test_new_run_folder_triggers(watcher, tmp_path):
+    watcher.watch_sequencing_dir(str(tmp_path), "NovaSeqXPlus")
+    assert watcher.wait(0.1) == set()
+    (tmp_path / "run1").mkdir()
+    (tmp_path / "file.txt").write_text("not a run")
+    assert watcher.wait(1) == {(str(tmp_path / "run1"), "NovaSeqXPlus")}
+
+
+def test_final_file_triggers(watcher, tmp_path):
+    run_dir = tmp_path / "run1"
+    run_dir.mkdir()
+    watcher.watch_run(str(run_dir), "NovaSeqXPlus", ["CopyComplete.txt"])
+    (run_dir / "RunInfo.xml").write_text("<RunInfo/>")
+    assert watcher.wait(0.1) == set()
+    (run_dir / "CopyComplete.txt").write_text("")
+    assert watcher.wait(1) == {(str(run_dir), "NovaSeqXPlus")}
+
+    watcher.unwatch(str(run_dir))
+    os.remove(run_dir / "CopyComplete.txt")
+    (run_dir / "CopyComplete.txt").write_text("")
+    assert watcher.wait(0.1) == set()
@@ -0,0 +1,141 @@
+import logging
+import os
+import signal
+import threading
+
+from dataflow_transfer.utils.filesystem import normalize_rsync_path, run_dir_sequencer
+
+logger = logging.getLogger(__name__)
+
+
+class BandwidthManager:
+    """Share a link bandwidth budget between the rsyncs to remote storage.
+
+    Each new rsync gets a --bwlimit of its weighted share of
+    `bandwidth.link_budget` (KiB/s), counting the transfers that are already
+    running. Final transfers weigh `final_weight` and intermediate syncs
+    `intermediate_weight`. A running transfer counts as final once the final
+    file of its run exists.
+
+    Running intermediate syncs whose limit is too far from their current
+    share are stopped by rebalance(), and started again with a new limit by
+    the same cycle. rsync -a picks up where it was stopped, so this only
+    costs the file list scan. Final transfers are never stopped.
+
+    Only rsyncs of a run folder below the sequencing_path of the sequencer
+    with that remote destination are counted and stopped, so that e.g. a
+    manual copy to the same destination is left alone.
+    """
+
+    def __init__(self, conf, process_index, run_classes):
+        bandwidth_config = conf.get("bandwidth", {})
+        self.link_budget = float(bandwidth_config["link_budget"])
+        self.final_weight = float(bandwidth_config.get("final_weight", 2))
+        self.intermediate_weight = float(bandwidth_config.get("intermediate_weight", 1))
+        self.rebalance_tolerance = float(
+            bandwidth_config.get("rebalance_tolerance", 0.25)
+        )
+        self.process_index = process_index
+        self.sequencers = conf.get("sequencers", {})
+        self.destinations = {
+            sequencer: sequencer_config.get("remote_destination")
+            for sequencer, sequencer_config in conf.get("sequencers", {}).items()
+            if sequencer_config.get("remote_destination")
+        }
+        self.final_files = {
+            sequencer: getattr(run_classes.get(sequencer), "final_file", "")
+            for sequencer in self.destinations
+        }
+        self._lock = threading.Lock()
+
+    def _weight(self, final):
+        return self.final_weight if final else self.intermediate_weight
+
+    def _is_final(self, source, sequencer):
+        final_file = self.final_files.get(sequencer)
+        return bool(final_file) and os.path.exists(os.path.join(source, final_file))
+
+    def active_transfers(self):
+        """Return the running transfers to remote storage, keyed by source."""
+        transfers = {}
+        for sequencer, destination in self.destinations.items():
+            for process in self.process_index.copying_to(destination):
+                if run_dir_sequencer(process.source, self.sequencers) != sequencer:
+                    continue
+                transfer = transfers.setdefault(
+                    process.source,
+                    {
+                        "sequencer": sequencer,
+                        "destination": destination,
+                        "final": self._is_final(process.source, sequencer),
+                        "processes": [],
+                    },
+                )
+                transfer["processes"].append(process)
+        return transfers
+
+    def _share(self, final, total_weight):
+        return max(1, int(self.link_budget * self._weight(final) / total_weight))
+
+    def allocate(self, run_dir, final):
+        """Return the --bwlimit in KiB/s for a new transfer of run_dir."""
+        with self._lock:
+            transfers = self.active_transfers()
+            transfers.pop(normalize_rsync_path(run_dir), None)
+            total_weight = self._weight(final) + sum(
+                self._weight(transfer["final"]) for transfer in transfers.values()
+            )
+            return self._share(final, total_weight)
+
+    def rebalance(self):
+        """Stop intermediate syncs whose limit is off from their share by too much.
+
+        Returns the sources of the stopped transfers.
+        """
+        with self._lock:
+            transfers = self.active_transfers()
+            if not transfers:
+                return []
+            total_weight = sum(
+                self._weight(transfer["final"]) for transfer in transfers.values()
+            )
+            stopped = []
+            for source, transfer in transfers.items():
+                if transfer["final"]:
+                    continue
+                pids = [p.pid for p in transfer["processes"] if p.pid is not None]
+                limits = [p.bwlimit for p in transfer["processes"] if p.bwlimit]
+                if not pids:
+                    continue
+                share = self._share(False, total_weight)
+                current = min(limits) if limits else None
+                if (
+                    current is not None
+                    and abs(current - share) / share <= self.rebalance_tolerance
+                ):
+                    continue
+                logger.info(
+                    f"Restarting intermediate sync of {source} to change its "
+                    f"bandwidth limit from {current or 'unlimited'} to {share} KiB/s"
+                )
+                self._stop(pids)
+                self.process_index.remove(source, transfer["destination"])
+                stopped.append(source)
+            return stopped
+
+    @staticmethod
+    def _stop(pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass  # Already exited
+            except PermissionError as e:
+                logger.warning(f"Could not stop rsync process {pid}: {e}")
+
+
+def open_bandwidth_manager(conf, process_index, run_classes):
+    """Create a BandwidthManager if `bandwidth.link_budget` is configured."""
+    if not conf.get("bandwidth", {}).get("link_budget"):
+        return None
+    return BandwidthManager(conf, process_index, run_classes)
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Listings taken this close to the directory's mtime are not trusted, since
+# an entry added in the same mtime tick would not change the mtime again
+_RACY_SECONDS = 2
+_COMMIT_EVERY = 500
+
+
+class DiscoveryIndex:
+    """Local SQLite record of the directory listings above the run folders.
+
+    For every directory between a sequencing path and its run folders, the
+    names of its subdirectories are stored together with the mtime of the
+    directory. Adding, removing or renaming an entry changes the mtime of
+    the directory it is in, so as long as the mtime is unchanged the stored
+    listing is used instead of reading the directory again. A cycle then
+    only stats the directories above the run folders and lists the ones
+    that changed, which costs far less than listing the whole tree on NFS.
+    Run folders themselves are not looked at.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._visited = set()
+        self._uncommitted = 0
+        with self._lock, self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS listings (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER,
+                    listed_at_ns INTEGER,
+                    subdirs TEXT
+                )"""
+            )
+
+    def find_runs(self, base_dir, ignore_folders=(), run_id_format=None, depth=1):
+        """Yield the run directories depth levels below base_dir.
+
+        Works like filesystem.find_runs, with ignore_folders applied on
+        every level and run_id_format on the level of the run folders.
+        """
+        pattern = re.compile(run_id_format) if run_id_format else None
+        yield from self._find_runs(base_dir, ignore_folders, pattern, depth, True)
+
+    def _find_runs(self, path, ignore_folders, pattern, depth, is_base):
+        try:
+            subdirs = self.subdirs(path)
+        except OSError as e:
+            if is_base:
+                raise
+            logger.warning(f"Could not list {path}, skipping it: {e}")
+            return
+        for name in subdirs:
+            if name in ignore_folders:
+                continue
+            subdir = os.path.join(path, name)
+            if depth > 1:
+                yield from self._find_runs(
+                    subdir, ignore_folders, pattern, depth - 1, False
+                )
+            elif not pattern or pattern.match(name):
+                yield subdir
+
+    def subdirs(self, path):
+        """Return the names of the subdirectories of path, listing it only if it changed."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        self._visited.add(path)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT mtime_ns, listed_at_ns, subdirs FROM listings WHERE path = ?",
+                (path,),
+            ).fetchone()
+        if (
+            row is not None
+            and row[0] == mtime_ns
+            and row[1] - mtime_ns > _RACY_SECONDS * 10**9
+        ):
+            return json.loads(row[2])
+        listed_at_ns = time.time_ns()
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                except OSError:
+                    continue  # Removed since it was listed
+        subdirs.sort()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                (path, mtime_ns, listed_at_ns, json.dumps(subdirs)),
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= _COMMIT_EVERY:
+                self._connection.commit()
+                self._uncommitted = 0
+        return subdirs
+
+    def prune(self):
+        """Drop the listings of directories not visited since the index was opened.
+
+        Only call this after a full discovery of all sequencing directories.
+        """
+        with self._lock, self._connection:
+            recorded = [
+                row[0] for row in self._connection.execute("SELECT path FROM listings")
+            ]
+            self._connection.executemany(
+                "DELETE FROM listings WHERE path = ?",
+                [(path,) for path in recorded if path not in self._visited],
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+
+def open_discovery_index(conf):
+    """Open the discovery index configured in `discovery_index.path`, if any."""
+    path = conf.get("discovery_index", {}).get("path")
+    if not path:
+        return None
+    try:
+        return DiscoveryIndex(path)
+    except sqlite3.Error as e:
+        logger.warning(f"Could not open discovery index {path}, not using it: {e}")
+        return None
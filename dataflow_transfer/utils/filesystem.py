@@ -1,9 +1,17 @@
+import fnmatch
+import hashlib
+import heapq
 import json
 import logging
 import os
+import re
 import subprocess
+import threading
+import xml.etree.ElementTree as ElementTree
+from collections import OrderedDict
+from typing import NamedTuple
 
-import xmltodict
+from dataflow_transfer.utils.profiling import profiled
 
 logger = logging.getLogger(__name__)
 
@@ -18,19 +26,321 @@ def get_run_dir(run):
         raise ValueError(f"Provided run path is not a valid directory: {run}")
 
 
-def find_runs(base_dir, ignore_folders=[]):
-    """Find run directories in the given base directory, ignoring specified folders."""
-    runs = []
-    for entry in os.listdir(base_dir):
-        entry_path = os.path.join(base_dir, entry)
-        if os.path.isdir(entry_path) and entry not in ignore_folders:
-            runs.append(entry_path)
-    return runs
+def find_runs(base_dir, ignore_folders=[], run_id_format=None, depth=1):
+    """Yield the run directories in the given base directory, ignoring specified folders.
 
+    Entries are read with os.scandir, whose file type information saves a
+    stat() per entry on most filesystems. With run_id_format, folders whose
+    name does not match it are passed over before anything else is done
+    with them. Runs are yielded as they are found, so that processing can
+    start before the whole directory has been read.
 
-def rsync_is_running(src, dst):
+    With depth larger than 1, the run folders are that many levels below
+    base_dir, e.g. 3 for `experiment/sample/run_id`. ignore_folders applies
+    on every level.
+    """
+    pattern = re.compile(run_id_format) if run_id_format else None
+    yield from _find_runs(base_dir, ignore_folders, pattern, depth, is_base=True)
+
+
+def _find_runs(path, ignore_folders, pattern, depth, is_base=False):
+    try:
+        entries = os.scandir(path)
+    except OSError as e:
+        if is_base:
+            raise
+        logger.warning(f"Could not list {path}, skipping it: {e}")
+        return
+    with entries:
+        for entry in entries:
+            if entry.name in ignore_folders:
+                continue
+            if depth == 1 and pattern and not pattern.match(entry.name):
+                logger.debug(f"Skipping {entry.path}, not a run folder name")
+                continue
+            try:
+                if not entry.is_dir():
+                    continue
+            except OSError:
+                continue  # Removed since it was listed
+            if depth > 1:
+                yield from _find_runs(entry.path, ignore_folders, pattern, depth - 1)
+            else:
+                yield entry.path
+
+
+class RsyncProcess(NamedTuple):
+    pid: int | None
+    start_time: float | None
+    source: str
+    destination: str
+    bwlimit: float | None = None  # KiB/s, None if unlimited
+
+
+# rsync options that take their value as a separate argument
+_RSYNC_OPTIONS_WITH_VALUE = {
+    "-e",
+    "--rsh",
+    "-T",
+    "--temp-dir",
+    "-f",
+    "--filter",
+    "--files-from",
+    "--exclude",
+    "--exclude-from",
+    "--include",
+    "--include-from",
+    "--log-file",
+    "--log-file-format",
+    "--partial-dir",
+    "--compare-dest",
+    "--copy-dest",
+    "--link-dest",
+    "--bwlimit",
+    "--chmod",
+}
+
+
+def normalize_rsync_path(path):
+    """Normalize an rsync source or destination for comparison.
+
+    Surrounding quotes, a remote `user@host:` prefix and trailing slashes are
+    removed, so that e.g. `user@host:/data/run/` and `/data/run` compare equal.
+    """
+    path = path.strip("'\"")
+    host, sep, remote_path = path.partition(":")
+    if sep and "/" not in host:
+        path = remote_path
+    return path.rstrip("/") or "/"
+
+
+def run_dir_sequencer(path, sequencers):
+    """Return the sequencer that path is a run folder of, or None.
+
+    path has to be `run_depth` levels below the sequencing_path of the
+    sequencer in sequencers (the `sequencers` section of the config). This
+    tells the transfers of this tool apart from other rsyncs, e.g. a manual
+    copy, to the same remote destination, and sequencers sharing a remote
+    destination apart from each other.
+    """
+    path = normalize_rsync_path(path)
+    for sequencer, sequencer_config in sequencers.items():
+        sequencing_path = (sequencer_config or {}).get("sequencing_path")
+        if not sequencing_path:
+            continue
+        relative = os.path.relpath(path, normalize_rsync_path(sequencing_path))
+        if relative == os.curdir or relative.split(os.sep)[0] == os.pardir:
+            continue
+        if len(relative.split(os.sep)) == int(sequencer_config.get("run_depth", 1)):
+            return sequencer
+    return None
+
+
+def parse_rsync_command_line(argv):
+    """Return (sources, destination) from an argv containing an rsync call.
+
+    Returns None if argv does not run rsync, or if it is the server side of
+    an rsync started over ssh.
+    """
+    for i, arg in enumerate(argv):
+        if os.path.basename(arg) == "rsync":
+            args = argv[i + 1 :]
+            break
+    else:
+        return None
+    if "--server" in args:
+        return None
+    operands = []
+    skip_next = False
+    for arg in args:
+        if skip_next:
+            skip_next = False
+        elif arg in _RSYNC_OPTIONS_WITH_VALUE:
+            skip_next = True
+        elif not arg.startswith("-"):
+            operands.append(arg)
+    if len(operands) < 2:
+        return None
+    return operands[:-1], operands[-1]
+
+
+_BWLIMIT_UNITS = {"": 1, "b": 1 / 1024, "k": 1, "m": 1024, "g": 1024**2}
+
+
+def parse_bwlimit(argv):
+    """Return the --bwlimit of an rsync argv in KiB/s, or None if there is none.
+
+    The last --bwlimit wins, as for rsync itself. A limit of 0 means no limit.
+    """
+    bwlimit = None
+    for i, arg in enumerate(argv):
+        if arg.startswith("--bwlimit="):
+            value = arg.split("=", 1)[1]
+        elif arg == "--bwlimit" and i + 1 < len(argv):
+            value = argv[i + 1]
+        else:
+            continue
+        match = re.fullmatch(r"([0-9.]+)([bkmg]?)i?b?", value.strip().lower())
+        if match:
+            number = float(match.group(1)) * _BWLIMIT_UNITS[match.group(2)]
+            bwlimit = number or None
+    return bwlimit
+
+
+class RsyncProcessIndex:
+    """Index of the running rsync processes, keyed by (source, destination).
+
+    The index is built from a single scan of `<proc_root>/*/cmdline`, so that
+    every run in a cycle can check for its own rsync without forking pgrep.
+    If the process table cannot be scanned, e.g. on a host without /proc,
+    is_running falls back to pgrep. A fake proc root can be given for testing.
+    """
+
+    def __init__(self, proc_root="/proc"):
+        self.proc_root = proc_root
+        self.scanned = False
+        self._processes = {}
+        self._lock = threading.Lock()
+        self.refresh()
+
+    @profiled("filesystem.scan_processes")
+    def refresh(self):
+        """Rescan the process table."""
+        processes = {}
+        boot_time = self._boot_time()
+        try:
+            entries = [
+                entry for entry in os.scandir(self.proc_root) if entry.name.isdigit()
+            ]
+        except OSError as e:
+            logger.warning(f"Could not scan processes in {self.proc_root}: {e}")
+            with self._lock:
+                self.scanned = False
+            return
+        for entry in entries:
+            try:
+                with open(os.path.join(entry.path, "cmdline"), "rb") as f:
+                    cmdline = f.read()
+            except OSError:
+                continue  # The process exited during the scan
+            argv = [arg.decode(errors="replace") for arg in cmdline.split(b"\0") if arg]
+            parsed = parse_rsync_command_line(argv)
+            if not parsed:
+                continue
+            sources, destination = parsed
+            start_time = self._start_time(entry.path, boot_time)
+            bwlimit = parse_bwlimit(argv)
+            for source in sources:
+                process = RsyncProcess(
+                    int(entry.name),
+                    start_time,
+                    normalize_rsync_path(source),
+                    normalize_rsync_path(destination),
+                    bwlimit,
+                )
+                processes.setdefault(process.source, []).append(process)
+        with self._lock:
+            self._processes = processes
+            self.scanned = True
+
+    def find(self, src, dst):
+        """Return the rsync processes copying src to dst, or to a path below dst."""
+        src = normalize_rsync_path(src)
+        dst = normalize_rsync_path(dst)
+        with self._lock:
+            candidates = list(self._processes.get(src, []))
+        return [
+            process
+            for process in candidates
+            if process.destination == dst
+            or process.destination.startswith(dst.rstrip("/") + "/")
+        ]
+
+    def is_running(self, src, dst):
+        if self.find(src, dst):
+            return True
+        if not self.scanned:
+            # Only the rsyncs started in this cycle are known, ask pgrep
+            return _pgrep_rsync(src, dst)
+        return False
+
+    def copying_to(self, dst):
+        """Return the rsync processes copying to dst or to a path below it."""
+        dst = normalize_rsync_path(dst)
+        with self._lock:
+            processes = [p for procs in self._processes.values() for p in procs]
+        return [
+            process
+            for process in processes
+            if process.destination == dst
+            or process.destination.startswith(dst.rstrip("/") + "/")
+        ]
+
+    def sources_copied_to(self, dst):
+        """Return the set of sources being copied to dst or to a path below it.
+
+        A wrapped rsync (e.g. started through run-one) shows up as more than
+        one process, but its source is only included once.
+        """
+        return {process.source for process in self.copying_to(dst)}
+
+    def add(self, src, dst, pid=None, start_time=None, bwlimit=None):
+        """Record an rsync started after the last scan."""
+        process = RsyncProcess(
+            pid,
+            start_time,
+            normalize_rsync_path(src),
+            normalize_rsync_path(dst),
+            bwlimit,
+        )
+        with self._lock:
+            self._processes.setdefault(process.source, []).append(process)
+
+    def remove(self, src, dst):
+        """Forget the rsyncs copying src to dst, e.g. after stopping them."""
+        found = self.find(src, dst)
+        with self._lock:
+            source = normalize_rsync_path(src)
+            self._processes[source] = [
+                process
+                for process in self._processes.get(source, [])
+                if process not in found
+            ]
+
+    def _boot_time(self):
+        try:
+            with open(os.path.join(self.proc_root, "stat")) as f:
+                for line in f:
+                    if line.startswith("btime"):
+                        return int(line.split()[1])
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def _start_time(self, process_dir, boot_time):
+        """Return the start time of a process as a unix timestamp, if known."""
+        if boot_time is None:
+            return None
+        try:
+            with open(os.path.join(process_dir, "stat")) as f:
+                stat = f.read()
+            # Fields after the command name, starttime is field 22 of the file
+            start_ticks = int(stat.rsplit(")", 1)[1].split()[19])
+        except (OSError, ValueError, IndexError):
+            return None
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def rsync_is_running(src, dst, proc_root="/proc"):
     """Check if rsync is already running for given src and destination."""
-    pattern = f"rsync.*{src}.*{dst}"
+    if os.path.isdir(proc_root):
+        return RsyncProcessIndex(proc_root).is_running(src, dst)
+    # No proc filesystem on this host, fall back to pgrep
+    return _pgrep_rsync(src, dst)
+
+
+def _pgrep_rsync(src, dst):
+    pattern = f"rsync.*{re.escape(src)}.*{re.escape(dst)}"
     try:
         subprocess.check_output(["pgrep", "-f", pattern])
         return True
@@ -38,37 +348,324 @@ def rsync_is_running(src, dst):
         return False
 
 
+@profiled("filesystem.submit_background_process")
 def submit_background_process(command_str: str):
     """Submit a command string as a background process."""
 
-    subprocess.Popen(command_str, stdout=subprocess.PIPE, shell=True)
+    return subprocess.Popen(command_str, stdout=subprocess.PIPE, shell=True)
 
 
+@profiled("filesystem.walk_files")
+def walk_files(run_dir, exclude=()):
+    """Return {path relative to run_dir: [size, mtime_ns]} for all files in run_dir.
+
+    Names matching a shell pattern in exclude are skipped anywhere in the tree.
+    """
+    excluded = re.compile(
+        "|".join(fnmatch.translate(pattern) for pattern in exclude) or "(?!)"
+    ).match
+    files = {}
+    for dir_path, dir_names, file_names in os.walk(run_dir):
+        dir_names[:] = [name for name in dir_names if not excluded(name)]
+        for name in file_names:
+            if excluded(name):
+                continue
+            path = os.path.join(dir_path, name)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue  # Removed while walking
+            files[os.path.relpath(path, run_dir)] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+@profiled("filesystem.split_into_shards")
+def split_into_shards(run_dir, shard_count, exclude=()):
+    """Split the files of a run directory into shard_count sets of similar size.
+
+    Files are assigned largest first to the currently smallest shard.
+    Returns a list of shards, each a sorted list of paths relative to run_dir.
+    Directories are not listed, and names in exclude are skipped anywhere in
+    the tree.
+    """
+    files = [
+        (size, relative_path)
+        for relative_path, (size, _) in walk_files(run_dir, exclude).items()
+    ]
+    shards = [[] for _ in range(max(1, shard_count))]
+    heap = [(0, index) for index in range(len(shards))]
+    for size, relative_path in sorted(files, reverse=True):
+        shard_size, index = heapq.heappop(heap)
+        shards[index].append(relative_path)
+        heapq.heappush(heap, (shard_size + size, index))
+    return [sorted(shard) for shard in shards]
+
+
+def write_file_list(file_path, relative_paths):
+    """Write a NUL separated file list for rsync --files-from with --from0."""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        for relative_path in relative_paths:
+            f.write(os.fsencode(relative_path) + b"\0")
+    os.replace(tmp_path, file_path)
+
+
+def parse_metadata_file(file_path, projection=None):
+    """Read the content of a .json or .xml metadata file into a dict.
+
+    With a projection (a list of slash separated element paths, e.g.
+    `RunParameters/Side`), only those parts of the file are returned, in the
+    same nested layout as the full dict. Returns None for unsupported file types.
+    """
+    if file_path.endswith(".json"):
+        with open(file_path) as f:
+            content = json.load(f)
+        return project_dict(content, projection) if projection else content
+    elif file_path.endswith(".xml"):
+        if projection:
+            return parse_xml_projection(file_path, projection)
+        # Imported here since it takes longer to import than the rest of
+        # the tool, and is only needed for XML files stored in full
+        import xmltodict
+
+        # Pass the file object so that expat reads it in chunks
+        with open(file_path, "rb") as f:
+            return xmltodict.parse(f, attr_prefix="", cdata_key="text")
+    logger.warning(
+        f"Unsupported metadata file type for {file_path}. Only .json and .xml are supported."
+    )
+    return None
+
+
+def _add_projected_value(result, path, value):
+    """Insert value at path in result, turning repeated paths into lists."""
+    for key in path[:-1]:
+        result = result.setdefault(key, {})
+    key = path[-1]
+    if key not in result:
+        result[key] = value
+    elif isinstance(result[key], list):
+        result[key].append(value)
+    else:
+        result[key] = [result[key], value]
+
+
+def project_dict(content, projection):
+    """Return only the parts of a parsed metadata dict selected by projection.
+
+    Missing and empty values are left out, as by parse_xml_projection.
+    """
+    result = {}
+    for projection_path in projection:
+        path = projection_path.strip("/").split("/")
+        values = [content]
+        for key in path:
+            next_values = []
+            for value in values:
+                value = value.get(key) if isinstance(value, dict) else None
+                if isinstance(value, list):
+                    next_values.extend(item for item in value if item is not None)
+                elif value is not None:
+                    next_values.append(value)
+            values = next_values
+        for value in values:
+            _add_projected_value(result, path, value)
+    return result
+
+
+def _element_to_dict(element, tag_name):
+    """Convert an element to the layout of xmltodict(attr_prefix="", cdata_key="text")."""
+    result = {tag_name(key): value for key, value in element.attrib.items()}
+    for child in element:
+        _add_projected_value(
+            result, [tag_name(child.tag)], _element_to_dict(child, tag_name)
+        )
+    text = (
+        (element.text or "") + "".join(child.tail or "" for child in element)
+    ).strip()
+    if not result:
+        return text or None
+    if text:
+        result["text"] = text
+    return result
+
+
+def parse_xml_projection(file_path, projection):
+    """Stream an XML file and return only the elements selected by projection.
+
+    The file is read with iterparse and every element outside the selected
+    paths is discarded as soon as it has been read, so memory use is bounded
+    by the size of the selected elements rather than the whole file.
+    Empty elements without attributes are left out, as by project_dict.
+    """
+    selected_paths = {tuple(path.strip("/").split("/")) for path in projection}
+    namespaces = {}
+
+    def tag_name(tag):
+        # Render {uri}name as prefix:name, like xmltodict does for the raw names
+        if tag.startswith("{"):
+            uri, name = tag[1:].split("}", 1)
+            prefix = namespaces.get(uri)
+            return f"{prefix}:{name}" if prefix else name
+        return tag
+
+    result = {}
+    path = []
+    parents = []
+    capture_depth = None
+    for event, item in ElementTree.iterparse(
+        file_path, events=("start-ns", "start", "end")
+    ):
+        if event == "start-ns":
+            prefix, uri = item
+            namespaces.setdefault(uri, prefix)
+            continue
+        if event == "start":
+            path.append(tag_name(item.tag))
+            if capture_depth is None and tuple(path) in selected_paths:
+                capture_depth = len(path)
+            parents.append(item)
+            continue
+        parents.pop()
+        if capture_depth == len(path):
+            value = _element_to_dict(item, tag_name)
+            if value is not None:
+                _add_projected_value(result, list(path), value)
+            capture_depth = None
+        if capture_depth is None and parents:
+            # Not needed anymore, drop it from the tree that is being built
+            parents[-1].remove(item)
+        path.pop()
+    return result
+
+
+@profiled("filesystem.parse_metadata_files")
 def parse_metadata_files(files):
     """Given a list of files, read the content into a dict.
     Handle .json and .xml files differently."""
     metadata = {}
     for file_path in files:
         try:
-            if file_path.endswith(".json"):
-                with open(file_path) as f:
-                    metadata[os.path.basename(file_path)] = json.load(f)
-            elif file_path.endswith(".xml"):
-                with open(file_path) as f:
-                    xml_content = xmltodict.parse(
-                        f.read(), attr_prefix="", cdata_key="text"
-                    )
-                    metadata[os.path.basename(file_path)] = xml_content
-            else:
-                logger.warning(
-                    f"Unsupported metadata file type for {file_path}. Only .json and .xml are supported."
-                )
-                continue
+            content = parse_metadata_file(file_path)
         except Exception as e:
             logger.error(f"Error reading metadata file {file_path}: {e}")
+            continue
+        if content is not None:
+            metadata[os.path.basename(file_path)] = content
     return metadata
 
 
+@profiled("filesystem.file_checksum")
+def file_checksum(file_path):
+    """Return the sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MetadataCache:
+    """Cache of parsed metadata files keyed on path, size, mtime and content hash.
+
+    A file whose size and mtime are unchanged is neither read nor parsed
+    again. If they changed but the content hash did not, the cached parse is
+    reused without parsing the file again. At most max_entries files are
+    kept, dropping the least recently used, and forget() drops the files of
+    a run once its transfer is finished.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def forget(self, run_dir):
+        """Drop the cached files below run_dir."""
+        prefix = run_dir.rstrip("/") + "/"
+        with self._lock:
+            for file_path in [
+                path for path in self._entries if path.startswith(prefix)
+            ]:
+                del self._entries[file_path]
+
+    def checksum(self, file_path):
+        """Return the content hash of a file, only reading it if its stat changed."""
+        return self._entry(file_path)["checksum"]
+
+    def parse(self, file_path, projection=None):
+        """Return the parsed content of a file, only parsing it if its content changed."""
+        entry = self._entry(file_path)
+        contents = entry.setdefault("contents", {})
+        projection_key = tuple(projection) if projection else None
+        if projection_key not in contents:
+            contents[projection_key] = parse_metadata_file(file_path, projection)
+        return contents[projection_key]
+
+    def _entry(self, file_path):
+        stat = os.stat(file_path)
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry:
+                self._entries.move_to_end(file_path)
+        if entry and (entry["size"], entry["mtime_ns"]) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            return entry
+        checksum = file_checksum(file_path)
+        if not entry or entry["checksum"] != checksum:
+            entry = {"checksum": checksum}
+        entry = dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        with self._lock:
+            self._entries[file_path] = entry
+            self._entries.move_to_end(file_path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+
+# Shared by all runs in the process, so a daemon keeps it between cycles
+METADATA_CACHE = MetadataCache()
+
+
+@profiled("filesystem.parse_changed_metadata_files")
+def parse_changed_metadata_files(
+    files, known_checksums, cache=METADATA_CACHE, projections=None
+):
+    """Parse the metadata files whose content differs from known_checksums.
+
+    known_checksums maps file names to the content hashes of the versions
+    already stored. Returns (metadata, checksums) for the changed files only,
+    so unchanged files are neither parsed nor written again. projections maps
+    file names to the element paths to extract, see metadata_projections().
+    """
+    projections = projections or {}
+    metadata = {}
+    checksums = {}
+    for file_path in files:
+        file_name = os.path.basename(file_path)
+        projection = projections.get(file_name)
+        try:
+            checksum = cache.checksum(file_path)
+            if projection:
+                # A changed projection has to update the stored content as well
+                checksum = hashlib.sha256(
+                    (checksum + json.dumps(projection)).encode()
+                ).hexdigest()
+            if known_checksums.get(file_name) == checksum:
+                continue
+            content = cache.parse(file_path, projection)
+        except Exception as e:
+            logger.error(f"Error reading metadata file {file_path}: {e}")
+            continue
+        if content is not None:
+            metadata[file_name] = content
+            checksums[file_name] = checksum
+    return metadata, checksums
+
+
+@profiled("filesystem.check_exit_status")
 def check_exit_status(file_path):
     """Check the exit status from a given file.
     Return True if exit code is 0, else False."""
@@ -80,11 +677,29 @@ def check_exit_status(file_path):
     return False
 
 
+def metadata_projections(metadata_list):
+    """Return the projections in a metadata_for_statusdb list, by file name.
+
+    Entries are either a file name, for which the whole file is stored, or a
+    mapping from a file name to the element paths to extract from it, e.g.
+    `{"RunParameters.xml": ["RunParameters/Side", "RunParameters/RunId"]}`.
+    """
+    projections = {}
+    for entry in metadata_list:
+        if isinstance(entry, dict):
+            for file_name, paths in entry.items():
+                projections[file_name] = list(paths or [])
+    return projections
+
+
+@profiled("filesystem.locate_metadata")
 def locate_metadata(metadata_list, run_dir):
     """Locate metadata in the given run directory."""
     located_paths = []
-    for pattern in metadata_list:
-        metadata_path = os.path.join(run_dir, pattern)
-        if os.path.exists(metadata_path):
-            located_paths.append(metadata_path)
+    for entry in metadata_list:
+        patterns = list(entry) if isinstance(entry, dict) else [entry]
+        for pattern in patterns:
+            metadata_path = os.path.join(run_dir, pattern)
+            if os.path.exists(metadata_path):
+                located_paths.append(metadata_path)
     return located_paths
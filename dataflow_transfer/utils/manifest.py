@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+
+from dataflow_transfer.utils import filesystem as fs
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = ".rsync_manifest.json"
+PENDING_MANIFEST_FILE = ".rsync_manifest.pending.json"
+FILE_LIST_FILE = ".rsync_incremental.files"
+INTERMEDIATE_EXITCODE_FILE = ".intermediate_rsync_exitcode"
+# rsync --exclude patterns for the files above, temporary files included
+MANIFEST_FILE_PATTERNS = (
+    ".rsync_manifest*",
+    FILE_LIST_FILE,
+    INTERMEDIATE_EXITCODE_FILE,
+)
+
+# rsync exit codes after which the listed files count as sent. 24 means some
+# files vanished before they could be sent, which only affects those files.
+_SENT_EXIT_CODES = {0, 24}
+
+
+class RunManifest:
+    """Record of the files of a run already sent by intermediate syncs.
+
+    Every file is stored with its size and mtime. prepare() lists the files
+    that are new or changed since they were sent, for rsync --files-from. The
+    listed files are kept as pending and only added to the manifest once
+    the rsync has written a successful exit code, which settle() checks at
+    the start of the next sync.
+
+    Files matching the shell patterns in exclude, e.g. other files written
+    by this tool, are never listed.
+    """
+
+    def __init__(self, run_dir, exclude=()):
+        self.run_dir = run_dir
+        self.manifest_file = os.path.join(run_dir, MANIFEST_FILE)
+        self.pending_file = os.path.join(run_dir, PENDING_MANIFEST_FILE)
+        self.file_list = os.path.join(run_dir, FILE_LIST_FILE)
+        self.exit_code_file = os.path.join(run_dir, INTERMEDIATE_EXITCODE_FILE)
+        # Written by this tool or by rsync while syncing, left to the final sync
+        self.exclude = {*MANIFEST_FILE_PATTERNS, "rsync_remote_log.txt", *exclude}
+
+    def _read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read {path}, ignoring it: {e}")
+            return {}
+
+    def _write_json(self, path, content):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(content, f)
+        os.replace(tmp_path, path)
+
+    def load(self):
+        return self._read_json(self.manifest_file)
+
+    def settle(self):
+        """Add the files of the last intermediate sync to the manifest if it succeeded.
+
+        Must only be called when no intermediate sync of the run is running.
+        """
+        if not os.path.exists(self.pending_file):
+            return
+        try:
+            with open(self.exit_code_file) as f:
+                exit_code = int(f.read().strip())
+        except (OSError, ValueError):
+            exit_code = None  # The sync never finished, send the files again
+        if exit_code in _SENT_EXIT_CODES:
+            manifest = self.load()
+            manifest.update(self._read_json(self.pending_file))
+            self._write_json(self.manifest_file, manifest)
+        else:
+            logger.info(
+                f"Last intermediate sync of {self.run_dir} did not succeed "
+                f"(exit code {exit_code}), its files will be sent again"
+            )
+        for path in (self.pending_file, self.exit_code_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def discard(self):
+        """Remove the file list of a sync that was prepared but not started."""
+        for path in (self.pending_file, self.file_list):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def prepare(self):
+        """Write the list of new and changed files for the next intermediate sync.
+
+        Returns the number of listed files, 0 if there is nothing to send.
+        """
+        self.settle()
+        manifest = self.load()
+        changed = {
+            path: stat
+            for path, stat in fs.walk_files(self.run_dir, self.exclude).items()
+            if manifest.get(path) != stat
+        }
+        if not changed:
+            return 0
+        fs.write_file_list(self.file_list, sorted(changed))
+        self._write_json(self.pending_file, changed)
+        return len(changed)
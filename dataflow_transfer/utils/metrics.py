@@ -0,0 +1,165 @@
+import logging
+import math
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+_TRANSFER_BUCKETS = (300, 900, 1800, 3600, 7200, 14400, 28800, 86400, 172800)
+
+# name: (type, help, histogram buckets)
+METRIC_DEFINITIONS = {
+    "dataflow_transfer_cycle_duration_seconds": (
+        "gauge",
+        "Duration of the last transfer cycle.",
+        None,
+    ),
+    "dataflow_transfer_last_cycle_timestamp_seconds": (
+        "gauge",
+        "Unix time at which the last transfer cycle ended.",
+        None,
+    ),
+    "dataflow_transfer_runs": (
+        "gauge",
+        "Runs seen in the last cycle, per sequencer and state.",
+        None,
+    ),
+    "dataflow_transfer_statusdb_requests_total": (
+        "counter",
+        "Requests to statusdb, per operation and outcome.",
+        None,
+    ),
+    "dataflow_transfer_statusdb_retries_total": (
+        "counter",
+        "Retried requests to statusdb, per operation.",
+        None,
+    ),
+    "dataflow_transfer_statusdb_request_duration_seconds": (
+        "histogram",
+        "Duration of requests to statusdb, per operation.",
+        _LATENCY_BUCKETS,
+    ),
+    "dataflow_transfer_rsync_started_total": (
+        "counter",
+        "Rsyncs started, per sequencer and kind of transfer.",
+        None,
+    ),
+    "dataflow_transfer_final_file_to_transferred_seconds": (
+        "histogram",
+        "Time from the final file of a run to its transferred_to_hpc status.",
+        _TRANSFER_BUCKETS,
+    ),
+}
+
+
+def _format_labels(labels, extra=None):
+    items = sorted((labels or {}).items()) + list((extra or {}).items())
+    if not items:
+        return ""
+    escaped = [
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in items
+    ]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """In-process metrics, written in the node_exporter textfile format.
+
+    Only the metrics in METRIC_DEFINITIONS can be used. Samples are keyed by
+    their labels, given as a dict.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {name: {} for name in METRIC_DEFINITIONS}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        with self._lock:
+            samples = self._samples[name]
+            key = self._key(labels)
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self._samples[name][self._key(labels)] = value
+
+    def clear(self, name):
+        with self._lock:
+            self._samples[name] = {}
+
+    def observe(self, name, value, labels=None):
+        buckets = METRIC_DEFINITIONS[name][2]
+        with self._lock:
+            samples = self._samples[name]
+            key = self._key(labels)
+            sample = samples.setdefault(
+                key, {"buckets": [0] * len(buckets), "sum": 0, "count": 0}
+            )
+            for index, upper_bound in enumerate(buckets):
+                if value <= upper_bound:
+                    sample["buckets"][index] += 1
+            sample["sum"] += value
+            sample["count"] += 1
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text, buckets) in METRIC_DEFINITIONS.items():
+                samples = self._samples[name]
+                if not samples:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for key, value in sorted(samples.items()):
+                    labels = dict(key)
+                    if metric_type != "histogram":
+                        lines.append(
+                            f"{name}{_format_labels(labels)} {_format_value(value)}"
+                        )
+                        continue
+                    for upper_bound, count in zip(
+                        (*buckets, math.inf), (*value["buckets"], value["count"])
+                    ):
+                        le = {"le": _format_value(upper_bound)}
+                        lines.append(
+                            f"{name}_bucket{_format_labels(labels, le)} {count}"
+                        )
+                    lines.append(
+                        f"{name}_sum{_format_labels(labels)} {_format_value(value['sum'])}"
+                    )
+                    lines.append(
+                        f"{name}_count{_format_labels(labels)} {value['count']}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write the metrics to path, replacing it atomically.
+
+        The file is written next to path and renamed, so node_exporter never
+        reads a partly written file.
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+METRICS = Metrics()
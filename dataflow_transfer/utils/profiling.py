@@ -0,0 +1,207 @@
+import cProfile
+import functools
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CYCLE = "cycle"  # Spans recorded outside of any run
+
+# From Python 3.12 cProfile uses sys.monitoring, which sees every thread but
+# allows only one active profiler per process. Before that, a profiler only
+# sees the thread that enabled it.
+_PROCESS_WIDE_STATS = sys.version_info >= (3, 12)
+
+
+class Profiler:
+    """Record how long each stage of a transfer cycle takes, per run.
+
+    Stages are timed with span() or the profiled() decorator, and are added
+    to the run processed by the current thread, or to the cycle as a whole
+    outside of a run. The time of a stage includes the stages nested in it,
+    e.g. run.has_status includes statusdb.get_events. Nothing is recorded
+    unless the profiler is enabled.
+
+    With collect_stats, the cycle is also profiled with cProfile and written
+    as a single pstats file. On Python 3.12 and later one profiler covers
+    all threads. On older versions every run processed in a worker thread
+    gets its own profiler, and the results are merged.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.collect_stats = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._runs = {}
+        self._cycle = {}
+        self._stats_profiles = []
+
+    def enable(self, collect_stats=False):
+        with self._lock:
+            self._runs = {}
+            self._cycle = {}
+            self._stats_profiles = []
+        self.collect_stats = collect_stats
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.collect_stats = False
+
+    @contextmanager
+    def run(self, run_dir, sequencer):
+        """Attribute the spans of the current thread to run_dir."""
+        if not self.enabled:
+            yield
+            return
+        stats_profile = None
+        if not _PROCESS_WIDE_STATS:
+            stats_profile = self._start_stats_profile()
+        previous_run = getattr(self._local, "run", None)
+        self._local.run = run_dir
+        with self._lock:
+            self._runs.setdefault(
+                run_dir, {"sequencer": sequencer, "total_seconds": 0.0, "stages": {}}
+            )
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self._local.run = previous_run
+            with self._lock:
+                self._runs[run_dir]["total_seconds"] += elapsed
+            self._stop_stats_profile(stats_profile)
+
+    @contextmanager
+    def span(self, stage):
+        """Time the enclosed block as stage."""
+        if not self.enabled:
+            yield
+            return
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(stage, time.perf_counter() - start_time)
+
+    def _record(self, stage, elapsed):
+        run_dir = getattr(self._local, "run", None)
+        with self._lock:
+            if run_dir is None:
+                stages = self._cycle
+            else:
+                stages = self._runs[run_dir]["stages"]
+            entry = stages.setdefault(stage, {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += elapsed
+
+    def _start_stats_profile(self):
+        # A thread can only run one cProfile profiler at a time
+        if not self.collect_stats or getattr(self._local, "stats_profile", None):
+            return None
+        stats_profile = cProfile.Profile()
+        self._local.stats_profile = stats_profile
+        stats_profile.enable()
+        return stats_profile
+
+    def _stop_stats_profile(self, stats_profile):
+        if stats_profile is None:
+            return
+        stats_profile.disable()
+        self._local.stats_profile = None
+        with self._lock:
+            self._stats_profiles.append(stats_profile)
+
+    @contextmanager
+    def session(self, report_file, stats_file=None):
+        """Profile the enclosed block and write the report when it ends.
+
+        The per-run breakdown is written to report_file as JSON, and the
+        merged cProfile statistics to stats_file if given. The statistics can
+        be read with pstats, snakeviz or flameprof.
+        """
+        self.enable(collect_stats=bool(stats_file))
+        stats_profile = self._start_stats_profile()
+        try:
+            yield
+        finally:
+            self._stop_stats_profile(stats_profile)
+            self.write_report(report_file)
+            if stats_file:
+                self.write_stats(stats_file)
+            self.disable()
+
+    def report(self):
+        """Return the recorded spans, slowest stages first."""
+
+        def sort_stages(stages):
+            return dict(
+                sorted(
+                    (
+                        (
+                            stage,
+                            {"count": e["count"], "seconds": round(e["seconds"], 6)},
+                        )
+                        for stage, e in stages.items()
+                    ),
+                    key=lambda item: item[1]["seconds"],
+                    reverse=True,
+                )
+            )
+
+        with self._lock:
+            runs = {
+                run_dir: {
+                    "sequencer": run["sequencer"],
+                    "total_seconds": round(run["total_seconds"], 6),
+                    "stages": sort_stages(run["stages"]),
+                }
+                for run_dir, run in sorted(
+                    self._runs.items(),
+                    key=lambda item: item[1]["total_seconds"],
+                    reverse=True,
+                )
+            }
+            return {CYCLE: sort_stages(self._cycle), "runs": runs}
+
+    def write_report(self, file_path):
+        with open(file_path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        logger.info(f"Wrote profile of the transfer cycle to {file_path}")
+
+    def write_stats(self, file_path):
+        with self._lock:
+            stats_profiles = list(self._stats_profiles)
+        if not stats_profiles:
+            return
+        stats = pstats.Stats(stats_profiles[0])
+        for stats_profile in stats_profiles[1:]:
+            stats.add(stats_profile)
+        stats.dump_stats(file_path)
+        logger.info(f"Wrote cProfile statistics to {file_path}")
+
+
+PROFILER = Profiler()
+
+
+def profiled(stage):
+    """Decorate a function to time each of its calls as stage."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            with PROFILER.span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
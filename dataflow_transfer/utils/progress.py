@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import re
+import time
+
+from dataflow_transfer.utils.manifest import PENDING_MANIFEST_FILE
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_STATE_FILE = ".rsync_progress.json"
+# rsync --exclude pattern for the state file and its temporary file
+PROGRESS_FILE_PATTERN = f"{PROGRESS_STATE_FILE}*"
+# Per-file log lines with the number of bytes sent, read by parse_rsync_log_line
+RSYNC_LOG_FILE_FORMAT = "--log-file-format='%i %b %n%L'"
+DEFAULT_WRITE_INTERVAL_SECONDS = 300
+
+# "2025/10/10 12:00:01 [12345] <rest of the line>"
+_LOG_LINE = re.compile(r"^\d{4}/\d\d/\d\d \d\d:\d\d:\d\d \[\d+\] (.*)$")
+_SENT_SUMMARY = re.compile(r"^sent ([\d,]+) bytes\s+received ([\d,]+) bytes")
+
+
+def parse_rsync_log_line(line):
+    """Parse a line of an rsync --log-file.
+
+    Returns ("file", bytes_sent, name) for a file sent to the remote side,
+    where bytes_sent is None unless the log format includes %b, ("summary",
+    bytes_sent, None) for the closing "sent ... bytes" line of an rsync, or
+    None for any other line.
+    """
+    match = _LOG_LINE.match(line.rstrip("\n"))
+    if not match:
+        return None
+    message = match.group(1)
+    summary = _SENT_SUMMARY.match(message)
+    if summary:
+        return ("summary", int(summary.group(1).replace(",", "")), None)
+    parts = message.split(" ", 2)
+    # Itemized changes of a sent regular file start with "<f"
+    if not parts[0].startswith("<f") or len(parts) < 2:
+        return None
+    if len(parts) == 3 and parts[1].isdigit():
+        return ("file", int(parts[1]), parts[2])
+    return ("file", None, " ".join(parts[1:]))
+
+
+class ProgressCollector:
+    """Follow the rsync log of a run and summarize how its transfer is going.
+
+    The log is read from where the previous call stopped, which is kept in
+    a small state file in the run directory together with the counters. Bytes
+    are counted per file when the log includes them (see
+    RSYNC_LOG_FILE_FORMAT), and otherwise from the summary line an rsync
+    writes when it ends. Throughput is the number of bytes sent since the
+    previous call divided by the time in between. The ETA is only known for
+    incremental intermediate syncs, whose pending manifest lists the size of
+    every file to send.
+    """
+
+    def __init__(self, run_dir, log_file="rsync_remote_log.txt"):
+        self.run_dir = run_dir
+        self.log_file = os.path.join(run_dir, log_file)
+        self.state_file = os.path.join(run_dir, PROGRESS_STATE_FILE)
+
+    def _load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state):
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_file)
+
+    def collect(self, now=None):
+        """Read new log lines and return the progress summary of the run."""
+        now = time.time() if now is None else now
+        state = self._load_state()
+        try:
+            stat = os.stat(self.log_file)
+        except OSError:
+            return None
+        offset = state.get("offset", 0)
+        if stat.st_ino != state.get("inode") or stat.st_size < offset:
+            offset = 0  # The log was replaced or truncated, start over
+        bytes_sent = state.get("bytes_sent", 0)
+        files_sent = state.get("files_sent", 0)
+        per_file_bytes = state.get("per_file_bytes", False)
+        with open(self.log_file, "rb") as f:
+            f.seek(offset)
+            for raw_line in f:
+                if not raw_line.endswith(b"\n"):
+                    break  # Still being written, read it next time
+                offset += len(raw_line)
+                parsed = parse_rsync_log_line(raw_line.decode(errors="replace"))
+                if parsed is None:
+                    continue
+                kind, size, _ = parsed
+                if kind == "file":
+                    files_sent += 1
+                    if size is not None:
+                        per_file_bytes = True
+                        bytes_sent += size
+                elif not per_file_bytes:
+                    bytes_sent += size
+
+        previous_bytes = state.get("bytes_sent", 0)
+        elapsed = now - state.get("collected_at", now)
+        throughput = state.get("throughput", 0.0)
+        if elapsed > 0:
+            throughput = max(0, bytes_sent - previous_bytes) / elapsed
+        state.update(
+            offset=offset,
+            inode=stat.st_ino,
+            bytes_sent=bytes_sent,
+            files_sent=files_sent,
+            per_file_bytes=per_file_bytes,
+            throughput=throughput,
+            collected_at=now,
+        )
+        eta = self._eta(state, throughput)
+        self._save_state(state)
+        return {
+            "bytes_sent": bytes_sent,
+            "files_sent": files_sent,
+            "throughput_bytes_per_second": round(throughput, 1),
+            "eta_seconds": eta,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.localtime(now)),
+        }
+
+    def _eta(self, state, throughput):
+        pending_file = os.path.join(self.run_dir, PENDING_MANIFEST_FILE)
+        try:
+            pending_mtime = os.stat(pending_file).st_mtime_ns
+        except OSError:
+            return None
+        if state.get("pending_mtime") != pending_mtime:
+            # A new incremental sync, count its bytes from here
+            try:
+                with open(pending_file) as f:
+                    pending = json.load(f)
+            except (OSError, ValueError):
+                return None
+            state["pending_mtime"] = pending_mtime
+            state["pending_bytes"] = sum(size for size, _ in pending.values())
+            state["pending_start_bytes"] = state["bytes_sent"]
+        remaining = state["pending_bytes"] - (
+            state["bytes_sent"] - state["pending_start_bytes"]
+        )
+        if throughput <= 0:
+            return None
+        return round(max(0, remaining) / throughput)
+
+    def should_write(self, interval, now=None):
+        """Check if the summary was last written to statusdb interval seconds ago."""
+        now = time.time() if now is None else now
+        return now - self._load_state().get("written_at", 0) >= interval
+
+    def mark_written(self, now=None):
+        state = self._load_state()
+        state["written_at"] = time.time() if now is None else now
+        self._save_state(state)
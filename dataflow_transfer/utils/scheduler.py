@@ -0,0 +1,162 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from dataflow_transfer.utils.filesystem import run_dir_sequencer
+
+logger = logging.getLogger(__name__)
+
+
+class TransferScheduler:
+    """Cap the number of concurrent transfers, globally and per sequencer.
+
+    Running transfers are counted from the process index, so rsyncs started
+    by earlier invocations count as well. A transfer counts for the
+    sequencer whose sequencing_path its source is a run folder of, so that
+    sequencers sharing a remote destination have their own limits, and
+    rsyncs of other directories are not counted. A run that can not get a slot is
+    queued. Final transfers go before intermediate syncs, and within the same
+    kind the run that has waited longest goes first, so an earlier queued
+    run will usually have started sequencing first and be closest to done.
+
+    The queue is kept in `scheduler.state_file` when set, so that the order
+    holds across invocations.
+    """
+
+    def __init__(self, conf, process_index):
+        scheduler_config = conf.get("scheduler", {})
+        self.process_index = process_index
+        self.state_file = scheduler_config.get("state_file")
+        self.max_rsyncs = scheduler_config.get("max_rsyncs")
+        self.sequencers = conf.get("sequencers", {})
+        self._lock = threading.Lock()
+        self._queue = self._load()
+
+    def _load(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"Could not read transfer queue {self.state_file}, starting empty: {e}"
+            )
+            return {}
+
+    def _save(self):
+        if not self.state_file:
+            return
+        tmp_file = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(self._queue, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            logger.warning(f"Could not save transfer queue {self.state_file}: {e}")
+
+    def _limit(self, sequencer):
+        limit = self.sequencers.get(sequencer, {}).get("max_rsyncs")
+        global_limit = self.max_rsyncs if self.max_rsyncs is not None else math.inf
+        return min(global_limit, limit if limit is not None else math.inf)
+
+    def _destination(self, sequencer):
+        return self.sequencers.get(sequencer, {}).get("remote_destination")
+
+    def _running(self):
+        """Return the sources transferring per sequencer and in total."""
+        per_sequencer = {}
+        for sequencer in self.sequencers:
+            destination = self._destination(sequencer)
+            if destination:
+                per_sequencer[sequencer] = {
+                    source
+                    for source in self.process_index.sources_copied_to(destination)
+                    if run_dir_sequencer(source, self.sequencers) == sequencer
+                }
+        return per_sequencer, set().union(*per_sequencer.values())
+
+    @staticmethod
+    def _priority(entry):
+        return (0 if entry["final"] else 1, entry["queued_at"])
+
+    def is_queued(self, run_dir):
+        with self._lock:
+            return run_dir in self._queue
+
+    def request_slot(self, run_dir, sequencer, final):
+        """Return True if the transfer of run_dir can start now, else queue it.
+
+        A granted transfer is added to the process index right away, so it is
+        counted by the next request in the same cycle.
+        """
+        with self._lock:
+            entry = dict(
+                self._queue.get(run_dir, {"queued_at": time.time()}),
+                sequencer=sequencer,
+                final=final,
+            )
+            running, running_total = self._running()
+            # Queued runs with a higher priority, which could start themselves
+            ahead = [
+                other
+                for other_run_dir, other in self._queue.items()
+                if other_run_dir != run_dir
+                and self._priority(other) < self._priority(entry)
+                and other_run_dir not in running.get(other["sequencer"], ())
+                and len(running.get(other["sequencer"], ()))
+                < self._limit(other["sequencer"])
+            ]
+            free_total = (
+                (self.max_rsyncs if self.max_rsyncs is not None else math.inf)
+                - len(running_total)
+                - len(ahead)
+            )
+            free_sequencer = (
+                self._limit(sequencer)
+                - len(running.get(sequencer, ()))
+                - len([other for other in ahead if other["sequencer"] == sequencer])
+            )
+            if free_total > 0 and free_sequencer > 0:
+                if self._queue.pop(run_dir, None) is not None:
+                    self._save()
+                destination = self._destination(sequencer)
+                if destination:
+                    self.process_index.add(src=run_dir, dst=destination)
+                return True
+            self._queue[run_dir] = entry
+            self._save()
+            return False
+
+    def release_slot(self, run_dir, sequencer):
+        """Give back a slot granted by request_slot for a transfer that did not start."""
+        destination = self._destination(sequencer)
+        if destination:
+            with self._lock:
+                self.process_index.remove(run_dir, destination)
+
+    def prune(self, existing_run_dirs):
+        """Drop queued runs that are no longer found in the sequencing directories."""
+        existing_run_dirs = set(existing_run_dirs)
+        with self._lock:
+            removed = [
+                run_dir for run_dir in self._queue if run_dir not in existing_run_dirs
+            ]
+            for run_dir in removed:
+                del self._queue[run_dir]
+            if removed:
+                self._save()
+
+
+def open_transfer_scheduler(conf, process_index):
+    """Create a TransferScheduler if any transfer limit is configured."""
+    has_limit = conf.get("scheduler", {}).get("max_rsyncs") is not None or any(
+        (sequencer_config or {}).get("max_rsyncs") is not None
+        for sequencer_config in conf.get("sequencers", {}).values()
+    )
+    if not has_limit:
+        return None
+    return TransferScheduler(conf, process_index)
@@ -0,0 +1,101 @@
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class RunStateIndex:
+    """Local SQLite record of runs whose transfer is finished.
+
+    A finished run is stored with the mtime of its run directory. As long as
+    the mtime is unchanged the run can be skipped without creating a Run,
+    reading its exit code files or querying statusdb. Adding, removing or
+    renaming a file in the run directory changes its mtime, so removing an
+    exit code file to restart a transfer also drops the run from the index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS finished_runs (
+                    run_dir TEXT PRIMARY KEY,
+                    sequencer TEXT,
+                    run_dir_mtime_ns INTEGER,
+                    recorded_at TEXT
+                )"""
+            )
+
+    def is_finished(self, run_dir):
+        """Check if run_dir is recorded as finished and unchanged since then."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT run_dir_mtime_ns FROM finished_runs WHERE run_dir = ?",
+                (run_dir,),
+            ).fetchone()
+        if row is None:
+            return False
+        try:
+            mtime = os.stat(run_dir).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != row[0]:
+            logger.info(f"{run_dir} changed since it was recorded as finished")
+            self.forget(run_dir)
+            return False
+        return True
+
+    def mark_finished(self, run_dir, sequencer):
+        try:
+            mtime = os.stat(run_dir).st_mtime_ns
+        except OSError:
+            return
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO finished_runs VALUES (?, ?, ?, ?)",
+                (run_dir, sequencer, mtime, datetime.now().isoformat()),
+            )
+
+    def forget(self, run_dir):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM finished_runs WHERE run_dir = ?", (run_dir,)
+            )
+
+    def prune(self, existing_run_dirs):
+        """Drop recorded runs that are no longer found in the sequencing directories."""
+        existing_run_dirs = set(existing_run_dirs)
+        with self._lock, self._connection:
+            recorded = [
+                row[0]
+                for row in self._connection.execute("SELECT run_dir FROM finished_runs")
+            ]
+            self._connection.executemany(
+                "DELETE FROM finished_runs WHERE run_dir = ?",
+                [
+                    (run_dir,)
+                    for run_dir in recorded
+                    if run_dir not in existing_run_dirs
+                ],
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def open_state_index(conf):
+    """Open the run state index configured in `state_index.path`, if any."""
+    path = conf.get("state_index", {}).get("path")
+    if not path:
+        return None
+    try:
+        return RunStateIndex(path)
+    except sqlite3.Error as e:
+        logger.warning(f"Could not open run state index {path}, not using it: {e}")
+        return None
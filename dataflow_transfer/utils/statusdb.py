@@ -1,16 +1,42 @@
+import hashlib
+import json
 import logging
+import threading
 import time
 
 from ibmcloudant import CouchDbSessionAuthenticator, cloudant_v1
 
+from dataflow_transfer.utils.metrics import METRICS
+from dataflow_transfer.utils.profiling import PROFILER
+
 logger = logging.getLogger(__name__)
 
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_statusdb_session(config):
+    """Return the process-wide StatusdbSession for config, creating it on first use.
+
+    The session keeps its HTTP connections open between requests and the
+    CouchDB session cookie is refreshed by the authenticator when it expires,
+    so a single login is shared by all runs of all cycles in this process.
+    """
+    key = json.dumps(config, sort_keys=True, default=str)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = StatusdbSession(config)
+            _SESSIONS[key] = session
+    return session
+
 
 class StatusdbSession:
     """Wrapper class for couchdb."""
 
     _RETRY_ATTEMPTS = 3
     _RETRY_BACKOFF_SECONDS = 0.5  # base backoff, multiplied by attempt number
+    _DEFAULT_POOL_SIZE = 10
 
     def __init__(self, config):
         user = config.get("username")
@@ -18,54 +44,123 @@ class StatusdbSession:
         url = config.get("url")
         display_url_string = f"https://{user}:********@{url}"
         self.db_name = config.get("database")
+        # In write-behind mode changed documents are queued and sent with flush()
+        self.write_behind = bool(config.get("write_behind", False))
+        # Older events are folded into event_summary beyond this many events
+        self.max_events = config.get("max_events")
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._write_counts = {"written": 0, "skipped": 0}
         self.connection = cloudant_v1.CloudantV1(
             authenticator=CouchDbSessionAuthenticator(user, password)
         )
         self.connection.set_service_url(f"https://{url}")
+        # Keep enough connections in the pool for all workers sharing the session
+        pool_size = int(config.get("pool_size", self._DEFAULT_POOL_SIZE))
+        self.connection.get_http_client().get_adapter(
+            f"https://{url}"
+        ).init_poolmanager(pool_size, pool_size)
         try:
             self._retry_call(
-                lambda: self.connection.get_server_information().get_result()
+                lambda: self.connection.get_server_information().get_result(),
+                operation="server_information",
             )
         except Exception as e:
             raise Exception(
                 f"Couchdb connection failed for URL {display_url_string} with error: {e}"
             )
 
-    def _retry_call(self, func):
+    def _retry_call(self, func, operation="request"):
         """Call func() and retry transient failures with backoff.
 
         func should be a zero-arg callable that executes the cloudant SDK call
-        and returns the .get_result() value (or raises).
+        and returns the .get_result() value (or raises). Every attempt is
+        counted and timed in the statusdb metrics under operation, and
+        profiled as the statusdb.<operation> stage.
         """
         attempts = self._RETRY_ATTEMPTS
         backoff = self._RETRY_BACKOFF_SECONDS
         last_exception = None
+        labels = {"operation": operation}
         for attempt in range(1, attempts + 1):
+            start_time = time.monotonic()
             try:
-                return func()
+                with PROFILER.span(f"statusdb.{operation}"):
+                    result = func()
             except Exception as e:
                 last_exception = e
+                self._record_request(labels, "error", start_time)
                 if attempt >= attempts:
                     logger.error(f"Operation failed after {attempt} attempts: {e}")
                     break
                 logger.warning(
                     f"An error occurred on attempt {attempt}/{attempts}: {e} — retrying after {backoff * (attempt)}s"
                 )
+                METRICS.inc("dataflow_transfer_statusdb_retries_total", labels)
                 time.sleep(backoff * attempt)
+            else:
+                self._record_request(labels, "ok", start_time)
+                return result
         # re-raise last exception for caller to handle
         raise last_exception
 
+    @staticmethod
+    def _record_request(labels, outcome, start_time):
+        METRICS.inc(
+            "dataflow_transfer_statusdb_requests_total", dict(labels, outcome=outcome)
+        )
+        METRICS.observe(
+            "dataflow_transfer_statusdb_request_duration_seconds",
+            time.monotonic() - start_time,
+            labels,
+        )
+
     def get_db_doc(self, ddoc, view, run_id):
-        """Retrieve a document from the database via retried call."""
-        doc_id = self.get_doc_id(ddoc, view, run_id)
-        if doc_id:
-            return self._retry_call(
-                lambda: self.connection.get_document(
-                    db=self.db_name, doc_id=doc_id
-                ).get_result()
-            )
+        """Retrieve a document from the database via retried call.
+
+        The view is queried with include_docs, so the document is returned
+        in the same round trip as the lookup of its ID. A document queued in
+        write-behind mode is returned as is, so later changes build on it.
+        """
+        with self._pending_lock:
+            pending = self._pending.get(run_id)
+        if pending is not None:
+            return pending["doc"]
+        result = self._retry_call(
+            lambda: self.connection.post_view(
+                db=self.db_name,
+                ddoc=ddoc,
+                view=view,
+                key=run_id,
+                include_docs=True,
+            ).get_result(),
+            operation="get_db_doc",
+        )
+        if result and "rows" in result and len(result["rows"]) > 0:
+            return result["rows"][0].get("doc")
         return None
 
+    def get_db_docs(self, ddoc, view, run_ids):
+        """Retrieve the documents of several runs with a single view query.
+
+        Returns a dict mapping run ID to document for the runs that were found.
+        """
+        result = self._retry_call(
+            lambda: self.connection.post_view(
+                db=self.db_name,
+                ddoc=ddoc,
+                view=view,
+                keys=list(run_ids),
+                include_docs=True,
+            ).get_result(),
+            operation="get_db_docs",
+        )
+        docs = {}
+        for row in result.get("rows", []):
+            if row["key"] not in docs and row.get("doc"):
+                docs[row["key"]] = row["doc"]
+        return docs
+
     def get_doc_id(self, ddoc, view, run_id):
         """Retrieve a document ID from the database via retried call."""
         result = self._retry_call(
@@ -74,7 +169,8 @@ class StatusdbSession:
                 ddoc=ddoc,
                 view=view,
                 key=run_id,
-            ).get_result()
+            ).get_result(),
+            operation="get_doc_id",
         )
         if result and "rows" in result and len(result["rows"]) > 0:
             return result["rows"][0]["id"]
@@ -83,22 +179,87 @@ class StatusdbSession:
 
     def get_events(self, run_id):
         """Retrieve events for a run from the database via retried call."""
-        return self._retry_call(
+        result = self._retry_call(
             lambda: self.connection.post_view(
                 db=self.db_name,
                 ddoc="events",
                 view="current_status_per_runfolder",
                 key=run_id,
-            ).get_result()
+            ).get_result(),
+            operation="get_events",
+        )
+        rows = result.get("rows", [])
+        current_statuses = rows[0].get("value") or {} if rows else {}
+        pending_statuses = self._add_pending_statuses(run_id, current_statuses)
+        if pending_statuses is not current_statuses:
+            result = dict(result, rows=[{"key": run_id, "value": pending_statuses}])
+        return result
+
+    def get_events_for_runs(self, run_ids):
+        """Retrieve the current statuses of several runs with a single view query.
+
+        Returns a dict mapping each requested run ID to its current statuses,
+        with an empty dict for runs that are not in the database.
+        """
+        result = self._retry_call(
+            lambda: self.connection.post_view(
+                db=self.db_name,
+                ddoc="events",
+                view="current_status_per_runfolder",
+                keys=list(run_ids),
+            ).get_result(),
+            operation="get_events_for_runs",
         )
+        statuses = {}
+        for row in result.get("rows", []):
+            # Same as for a single key lookup, the first row for a run wins
+            if row["key"] not in statuses:
+                statuses[row["key"]] = row.get("value") or {}
+        return {
+            run_id: self._add_pending_statuses(run_id, statuses.get(run_id, {}))
+            for run_id in run_ids
+        }
+
+    def _add_pending_statuses(self, run_id, statuses):
+        """Add the statuses of events queued for a run but not yet written."""
+        with self._pending_lock:
+            pending = self._pending.get(run_id)
+        if pending is None:
+            return statuses
+        statuses = dict(statuses)
+        for event in pending["doc"].get("events", []):
+            statuses.setdefault(event["event_type"], event.get("timestamp") or True)
+        return statuses
 
-    def update_db_doc(self, db_doc):
-        """Upload document to the database via retried call."""
+    def update_db_doc(self, db_doc, status=None):
+        """Upload document to the database via retried call.
+
+        In write-behind mode the document is queued instead, and written
+        together with the other changed documents by flush(). status is the
+        status event added by this update, if any, and is kept with the
+        queued document to be logged if it can not be written. Updates of
+        other fields, such as transfer_progress, do not add a status. With
+        max_events set, the events of the document are compacted before it
+        is written.
+        """
+        self._compact(db_doc)
+        self.count_write("written")
+        if self.write_behind:
+            run_id = db_doc.get("runfolder_id")
+            with self._pending_lock:
+                pending = self._pending.setdefault(
+                    run_id, {"doc": db_doc, "statuses": []}
+                )
+                pending["doc"] = db_doc
+                if status:
+                    pending["statuses"].append(status)
+            return
         try:
             self._retry_call(
                 lambda: self.connection.post_document(
                     db=self.db_name, document=db_doc
-                ).get_result()
+                ).get_result(),
+                operation="post_document",
             )
         except Exception as e:
             logger.error(
@@ -107,3 +268,217 @@ class StatusdbSession:
                 e,
             )
             raise
+
+    def count_write(self, outcome):
+        """Count a document write as "written" or "skipped" (unchanged content)."""
+        with self._pending_lock:
+            self._write_counts[outcome] += 1
+
+    def write_counts(self):
+        with self._pending_lock:
+            return dict(self._write_counts)
+
+    def flush(self):
+        """Write all documents queued in write-behind mode with _bulk_docs.
+
+        Documents that hit a conflict are merged into their latest revision and
+        sent again; only those are retried. If the bulk request itself fails,
+        the documents are written one by one instead. Every document that could
+        not be written is logged with its run and the statuses it carried.
+
+        Returns a dict mapping each run ID to "ok" or the error for its document.
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        results = {}
+        for attempt in range(1, self._RETRY_ATTEMPTS + 1):
+            if not pending:
+                break
+            run_ids = list(pending)
+            bulk_docs = cloudant_v1.BulkDocs(
+                docs=[pending[run_id]["doc"] for run_id in run_ids]
+            )
+            try:
+                doc_results = self._retry_call(
+                    lambda: self.connection.post_bulk_docs(
+                        db=self.db_name, bulk_docs=bulk_docs
+                    ).get_result(),
+                    operation="post_bulk_docs",
+                )
+            except Exception as e:
+                logger.error(
+                    f"Bulk write of {len(run_ids)} documents failed: {e}. "
+                    "Writing them one by one instead."
+                )
+                results.update(self._write_one_by_one(pending))
+                break
+            conflicts = {}
+            for run_id, doc_result in zip(run_ids, doc_results):
+                if doc_result.get("ok"):
+                    results[run_id] = "ok"
+                    continue
+                error = doc_result.get("error", "unknown error")
+                results[run_id] = error
+                if error == "conflict" and attempt < self._RETRY_ATTEMPTS:
+                    conflicts[run_id] = pending[run_id]
+                else:
+                    self._log_failed_write(
+                        run_id, pending[run_id], doc_result.get("reason", error)
+                    )
+            pending = self._merge_with_latest(conflicts) if conflicts else {}
+        if results:
+            failed = [run_id for run_id, result in results.items() if result != "ok"]
+            logger.info(
+                f"Wrote {len(results) - len(failed)} of {len(results)} queued "
+                f"documents to statusdb ({len(failed)} failed)."
+            )
+        return results
+
+    def _merge_with_latest(self, conflicts):
+        """Apply queued changes on top of the latest revision of each document."""
+        try:
+            latest_docs = self.get_db_docs("lookup", "runfolder_id", list(conflicts))
+        except Exception as e:
+            for run_id, pending in conflicts.items():
+                self._log_failed_write(run_id, pending, e)
+            return {}
+        merged = {}
+        for run_id, pending in conflicts.items():
+            doc = pending["doc"]
+            latest = latest_docs.get(run_id)
+            if latest is None:
+                self._log_failed_write(run_id, pending, "document no longer found")
+                continue
+            for key, value in doc.items():
+                if key not in ("_id", "_rev", "events", "files"):
+                    latest[key] = value
+            latest.setdefault("files", {}).update(doc.get("files", {}))
+            latest_events = latest.setdefault("events", [])
+            latest_events.extend(
+                event for event in doc.get("events", []) if event not in latest_events
+            )
+            self._compact(latest)
+            merged[run_id] = dict(pending, doc=latest)
+        return merged
+
+    def _compact(self, db_doc):
+        if self.max_events is None:
+            return
+        db_doc["events"], db_doc["event_summary"] = compact_events(
+            db_doc.get("events", []),
+            int(self.max_events),
+            db_doc.get("event_summary"),
+        )
+        if not db_doc["event_summary"]:
+            del db_doc["event_summary"]
+
+    def _write_one_by_one(self, pending):
+        results = {}
+        for run_id, queued in pending.items():
+            try:
+                self._retry_call(
+                    lambda: self.connection.post_document(
+                        db=self.db_name, document=queued["doc"]
+                    ).get_result(),
+                    operation="post_document",
+                )
+                results[run_id] = "ok"
+            except Exception as e:
+                results[run_id] = str(e)
+                self._log_failed_write(run_id, queued, e)
+        return results
+
+    def _log_failed_write(self, run_id, pending, error):
+        logger.error(
+            f"Failed to write statuses {', '.join(pending['statuses']) or 'none'} "
+            f"for {run_id} to statusdb: {error}"
+        )
+
+
+def content_hash(event_type, data, file_checksums):
+    """Hash of the content a status update writes to a run document."""
+    content = {
+        "event_type": event_type,
+        "data": data or {},
+        "file_checksums": file_checksums or {},
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def compact_events(events, max_events, summary=None):
+    """Keep a run's event list bounded by folding older events into a summary.
+
+    The first and the latest event of every event type are always kept, so
+    the statuses derived from the events by the current_status_per_runfolder
+    view stay the same. Of the remaining events only the max_events most
+    recent ones are kept. Each dropped event is counted in the summary, which
+    maps event type to its number of dropped events and their time range.
+
+    Returns the kept events, in their original order, and the updated summary.
+    """
+    summary = {key: dict(value) for key, value in (summary or {}).items()}
+    if len(events) <= max_events:
+        return events, summary
+    keep = set(range(len(events) - max_events, len(events)))
+    first_and_latest = {}
+    for index, event in enumerate(events):
+        first, _ = first_and_latest.get(event["event_type"], (index, index))
+        first_and_latest[event["event_type"]] = (first, index)
+    for first, latest in first_and_latest.values():
+        keep.update((first, latest))
+    kept = []
+    for index, event in enumerate(events):
+        if index in keep:
+            kept.append(event)
+            continue
+        timestamp = event.get("timestamp")
+        entry = summary.setdefault(
+            event["event_type"],
+            {"count": 0, "first_timestamp": timestamp, "last_timestamp": timestamp},
+        )
+        entry["count"] += 1
+        if timestamp:
+            if not entry["first_timestamp"] or timestamp < entry["first_timestamp"]:
+                entry["first_timestamp"] = timestamp
+            if not entry["last_timestamp"] or timestamp > entry["last_timestamp"]:
+                entry["last_timestamp"] = timestamp
+    return kept, summary
+
+
+class StatusSnapshot:
+    """In-memory copy of the current statuses of the runs seen in a cycle.
+
+    The statuses are loaded with one multi-key view query instead of one
+    query per run and status check. Entries are dropped with invalidate()
+    when a run's document is written, so the next lookup reads it again.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._statuses = {}
+        self._lock = threading.Lock()
+
+    def load(self, run_ids):
+        """Load the statuses of all given runs not already in the snapshot."""
+        with self._lock:
+            missing = [run_id for run_id in run_ids if run_id not in self._statuses]
+        if not missing:
+            return
+        statuses = self.db.get_events_for_runs(missing)
+        with self._lock:
+            self._statuses.update(statuses)
+
+    def get(self, run_id):
+        """Return the current statuses of a run, or None if not in the snapshot."""
+        with self._lock:
+            return self._statuses.get(run_id)
+
+    def set(self, run_id, statuses):
+        with self._lock:
+            self._statuses[run_id] = statuses
+
+    def invalidate(self, run_id):
+        with self._lock:
+            self._statuses.pop(run_id, None)
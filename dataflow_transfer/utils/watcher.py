@@ -0,0 +1,235 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal inotify(7) wrapper using libc through ctypes."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc not found, inotify is not available")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available on this platform")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"Could not watch {path}: {os.strerror(errno)}")
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """Wait up to timeout seconds and return a list of (wd, mask, name)."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class RunWatcher:
+    """Watch sequencing directories and active run folders for new files.
+
+    A sequencing directory triggers when a run folder is created in it, and a
+    run folder triggers when one of its trigger files (e.g. the final file)
+    is written. Paths are watched with inotify when possible; directories
+    added with poll=True, or all of them if inotify is not available, are
+    checked with stat polling instead, e.g. for NFS mounts where inotify
+    does not see changes made by other hosts.
+    """
+
+    def __init__(self, use_inotify=True, poll_interval=30):
+        self.poll_interval = poll_interval
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                logger.warning(f"inotify not available, falling back to polling: {e}")
+        self._watches = {}  # path -> watch info
+        self._wds = {}  # inotify watch descriptor -> path
+        self._last_poll = 0
+
+    def watch_sequencing_dir(self, path, sequencer, poll=False):
+        """Trigger when a new run folder appears in a sequencing directory."""
+        if path in self._watches:
+            return
+        watch = {"kind": "sequencing_dir", "sequencer": sequencer}
+        self._add(path, watch, IN_CREATE | IN_MOVED_TO | IN_ONLYDIR, poll)
+        if watch.get("wd") is None:
+            watch["mtime"] = self._mtime(path)
+            watch["entries"] = self._list_dirs(path)
+
+    def watch_run(self, run_dir, sequencer, trigger_files, poll=False):
+        """Trigger when one of trigger_files is written in a run folder."""
+        if run_dir in self._watches:
+            return
+        watch = {
+            "kind": "run",
+            "sequencer": sequencer,
+            "trigger_files": set(trigger_files),
+        }
+        self._add(run_dir, watch, IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR, poll)
+        if watch.get("wd") is None:
+            watch["present"] = self._present_files(run_dir, trigger_files)
+
+    def watched_runs(self):
+        """Return the run folders being watched."""
+        return [path for path, watch in self._watches.items() if watch["kind"] == "run"]
+
+    def unwatch(self, path):
+        watch = self._watches.pop(path, None)
+        if watch and watch.get("wd") is not None:
+            self._wds.pop(watch["wd"], None)
+            self.inotify.rm_watch(watch["wd"])
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds and return the triggered (run_dir, sequencer)."""
+        triggered = set()
+        deadline = time.monotonic() + timeout
+        while not triggered:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if time.monotonic() - self._last_poll >= self.poll_interval:
+                triggered |= self._poll()
+                self._last_poll = time.monotonic()
+            if triggered:
+                break
+            wait_time = min(remaining, self.poll_interval)
+            if self.inotify:
+                triggered |= self._read_inotify(wait_time)
+            else:
+                time.sleep(wait_time)
+        return triggered
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+        self._watches = {}
+        self._wds = {}
+
+    def _add(self, path, watch, mask, poll):
+        watch["wd"] = None
+        if self.inotify and not poll:
+            try:
+                watch["wd"] = self.inotify.add_watch(path, mask)
+                self._wds[watch["wd"]] = path
+            except OSError as e:
+                logger.warning(f"Polling {path} instead of using inotify: {e}")
+        self._watches[path] = watch
+
+    def _read_inotify(self, timeout):
+        triggered = set()
+        for wd, mask, name in self.inotify.read_events(timeout):
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, trigger all runs that have a trigger file.
+                # New run folders are picked up by the next cycle.
+                logger.warning("inotify queue overflow, checking all watched runs")
+                triggered |= {
+                    (path, watch["sequencer"])
+                    for path, watch in self._watches.items()
+                    if watch["kind"] == "run"
+                    and self._present_files(path, watch["trigger_files"])
+                }
+                continue
+            path = self._wds.get(wd)
+            if path is None:
+                continue
+            watch = self._watches[path]
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                self._watches.pop(path, None)
+                self._wds.pop(wd, None)
+            elif watch["kind"] == "sequencing_dir" and mask & IN_ISDIR:
+                triggered.add((os.path.join(path, name), watch["sequencer"]))
+            elif watch["kind"] == "run" and name in watch["trigger_files"]:
+                triggered.add((path, watch["sequencer"]))
+        return triggered
+
+    def _poll(self):
+        triggered = set()
+        for path, watch in list(self._watches.items()):
+            if watch["wd"] is not None:
+                continue
+            if watch["kind"] == "sequencing_dir":
+                # Only list the directory if an entry was added or removed
+                mtime = self._mtime(path)
+                if mtime == watch["mtime"]:
+                    continue
+                watch["mtime"] = mtime
+                entries = self._list_dirs(path)
+                for entry in entries - watch["entries"]:
+                    triggered.add((os.path.join(path, entry), watch["sequencer"]))
+                watch["entries"] = entries
+            else:
+                present = self._present_files(path, watch["trigger_files"])
+                if present - watch["present"]:
+                    triggered.add((path, watch["sequencer"]))
+                watch["present"] = present
+        return triggered
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def _list_dirs(path):
+        try:
+            with os.scandir(path) as entries:
+                return {entry.name for entry in entries if entry.is_dir()}
+        except OSError:
+            return set()
+
+    @staticmethod
+    def _present_files(run_dir, trigger_files):
+        return {
+            name
+            for name in trigger_files
+            if os.path.exists(os.path.join(run_dir, name))
+        }